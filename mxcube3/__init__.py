@@ -86,6 +86,15 @@ opt_parser.add_option(
     default=False,
 )
 
+opt_parser.add_option(
+    "-b",
+    "--dry-run-benchmark",
+    dest="dry_run_benchmark",
+    help="Dry-run the queue in the given file (NDJSON or CSV), print the "
+    "predicted timeline and the server overhead, and exit",
+    default="",
+)
+
 cmdline_options, args = opt_parser.parse_args()
 
 INIT_EVENT = gevent.event.Event()
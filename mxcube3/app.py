@@ -12,6 +12,12 @@ import sys
 import logging
 import atexit
 import json
+import gzip
+import io
+import tempfile
+import time
+
+import gevent
 
 from logging import StreamHandler, NullHandler
 from logging.handlers import TimedRotatingFileHandler
@@ -39,6 +45,10 @@ NODE_ID_TO_LIMS_ID = {}
 # run numbers
 INITIAL_FILE_LIST = []
 
+# Highest run number used for each prefix path (directory/prefix), on disk or
+# in the queue, for creating automatic run numbers (see qutils.get_run_number)
+RUN_NUMBER_INDEX = {}
+
 # Lookup table for sample changer location to data matrix or
 # data matrix to location
 SC_CONTENTS = {"FROM_CODE": {}, "FROM_LOCATION": {}}
@@ -66,6 +76,9 @@ TIMEOUT_GIVES_CONTROL = False
 # Enable automatic Mountie of sample when queue executed in
 # "automatic/pipeline" mode
 AUTO_MOUNT_SAMPLE = False
+# Prepare the sample changer for the next sample while the last task of the
+# current sample is executed (pipelined mounting)
+PREFETCH_NEXT_SAMPLE = False
 # Automatically add and execute diffraction plans coming from
 # characterizations
 AUTO_ADD_DIFFPLAN = False
@@ -74,6 +87,14 @@ NUM_SNAPSHOTS = 4
 
 CONFIG = None
 
+# Greenlet writing the application settings (see save_settings), None when
+# no write is pending
+SETTINGS_WRITE_TASK = None
+
+# Timing (seconds) and size (bytes) of the last restore of the application
+# settings, see load_settings
+SETTINGS_RESTORE_METRICS = {}
+
 
 def init(hwr, hwr_xml_dir, allow_remote, ra_timeout, video_device, log_fpath, cfg):
     """
@@ -222,9 +243,91 @@ def init_state_storage():
 
 def save_settings():
     """
-    Saves all application wide variables to disk, stored-mxcube-session.json
+    Saves all application wide variables to disk, APP.SETTINGS_FILE, in the
+    background. The write is delayed APP.SETTINGS_SAVE_DELAY seconds so that
+    consecutive calls result in a single write.
+    """
+    global SETTINGS_WRITE_TASK
+
+    if SETTINGS_WRITE_TASK is None:
+        SETTINGS_WRITE_TASK = gevent.spawn_later(
+            CONFIG.APP.SETTINGS_SAVE_DELAY, _write_settings_task
+        )
+
+
+def flush_settings():
+    """
+    Writes the pending application settings, if any, immediately
+    """
+    global SETTINGS_WRITE_TASK
+
+    if SETTINGS_WRITE_TASK is not None:
+        SETTINGS_WRITE_TASK.kill()
+        SETTINGS_WRITE_TASK = None
+        write_settings()
+
+
+def _write_settings_task():
+    global SETTINGS_WRITE_TASK
+    SETTINGS_WRITE_TASK = None
+
+    try:
+        write_settings()
+    except Exception:
+        logging.getLogger("MX3.HWR").exception("Could not save settings")
+
+
+def write_settings():
+    """
+    Writes all application wide variables to disk, APP.SETTINGS_FILE. The
+    file is replaced atomically and gzip compressed if
+    APP.SETTINGS_COMPRESS is set.
     """
+    from mxcube3.core import queue_view
 
+    data = queue_view.dumps(_settings()).encode("utf-8")
+    fpath = os.path.abspath(CONFIG.APP.SETTINGS_FILE)
+
+    gevent.get_hub().threadpool.apply(
+        _write_file_atomic, (fpath, data, CONFIG.APP.SETTINGS_COMPRESS)
+    )
+
+
+def _write_file_atomic(fpath, data, compress):
+    try:
+        mode = os.stat(fpath).st_mode & 0o777
+    except OSError:
+        mode = 0o644
+
+    fd, tmp_fpath = tempfile.mkstemp(dir=os.path.dirname(fpath), suffix=".tmp")
+
+    try:
+        # mkstemp creates the file with mode 0600, keep the mode of the file
+        os.fchmod(fd, mode)
+        fp = os.fdopen(fd, "wb")
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_fpath)
+        raise
+
+    try:
+        with fp:
+            if compress:
+                with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+                    gz.write(data)
+            else:
+                fp.write(data)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.rename(tmp_fpath, fpath)
+    except BaseException:
+        os.remove(tmp_fpath)
+        raise
+
+
+def _settings():
     from mxcube3.core import qutils
 
     queue = qutils.queue_to_dict(blcontrol.beamline.queue_model.get_model_root())
@@ -238,6 +341,7 @@ def save_settings():
         "CENTRING_METHOD": CENTRING_METHOD,
         "NODE_ID_TO_LIMS_ID": NODE_ID_TO_LIMS_ID,
         "INITIAL_FILE_LIST": INITIAL_FILE_LIST,
+        "RUN_NUMBER_INDEX": RUN_NUMBER_INDEX,
         "SC_CONTENTS": SC_CONTENTS,
         "SAMPLE_LIST": SAMPLE_LIST,
         "TEMP_DISABLED": TEMP_DISABLED,
@@ -250,30 +354,45 @@ def save_settings():
         "UI_STATE": UI_STATE,
     }
 
-    with open("stored-mxcube-session.json", "w") as fp:
-        json.dump(data, fp)
+    return data
 
 
 def load_settings():
     """
-    Loads application wide variables from "stored-mxcube-session.json"
+    Loads application wide variables from APP.SETTINGS_FILE, the time spent
+    on each step is stored in SETTINGS_RESTORE_METRICS
     """
 
     global CURRENTLY_MOUNTED_SAMPLE, SAMPLE_TO_BE_MOUNTED, CENTRING_METHOD
     global NODE_ID_TO_LIMS_ID, SC_CONTENTS, SAMPLE_LIST
     global TEMP_DISABLED, USERS, ALLOW_REMOTE, TIMEOUT_GIVES_CONTROL
     global VIDEO_FORMAT, AUTO_MOUNT_SAMPLE, AUTO_ADD_DIFFPLAN, NUM_SNAPSHOTS
-    global UI_STATE
+    global UI_STATE, RUN_NUMBER_INDEX, SETTINGS_RESTORE_METRICS
+
+    t0 = time.time()
+
+    with open(CONFIG.APP.SETTINGS_FILE, "rb") as f:
+        raw_data = f.read()
+
+    t1 = time.time()
+
+    # Compressed or not, depending on APP.SETTINGS_COMPRESS when written
+    if raw_data[:2] == b"\x1f\x8b":
+        data = json.loads(gzip.GzipFile(fileobj=io.BytesIO(raw_data)).read())
+    else:
+        data = json.loads(raw_data)
 
-    with open("stored-mxcube-session.json", "r") as f:
-        data = json.load(f)
+    t2 = time.time()
 
     from mxcube3.core import qutils
 
     qutils.load_queue_from_dict(data.get("QUEUE", {}))
 
+    t3 = time.time()
+
     CENTRING_METHOD = data.get("CENTRING_METHOD", queue_entry.CENTRING_METHOD.LOOP)
     NODE_ID_TO_LIMS_ID = data.get("NODE_ID_TO_LIMS_ID", {})
+    RUN_NUMBER_INDEX = data.get("RUN_NUMBER_INDEX", {})
     SC_CONTENTS = data.get("SC_CONTENTS", {"FROM_CODE": {}, "FROM_LOCATION": {}})
     SAMPLE_LIST = data.get("SAMPLE_LIST", {"sampleList": {}, "sampleOrder": []})
     ALLOW_REMOTE = data.get("ALLOW_REMOTE", False)
@@ -283,6 +402,22 @@ def load_settings():
     NUM_SNAPSHOTS = data.get("NUM_SNAPSHOTS", False)
     UI_STATE = data.get("UI_STATE", {})
 
+    SETTINGS_RESTORE_METRICS = {
+        "bytes": len(raw_data),
+        "read": t1 - t0,
+        "decode": t2 - t1,
+        "queue": t3 - t2,
+        "total": time.time() - t0,
+    }
+
+    logging.getLogger("MX3.HWR").info(
+        "Settings restored in %.3f s (read %.3f s, decode %.3f s, queue %.3f s)",
+        SETTINGS_RESTORE_METRICS["total"],
+        SETTINGS_RESTORE_METRICS["read"],
+        SETTINGS_RESTORE_METRICS["decode"],
+        SETTINGS_RESTORE_METRICS["queue"],
+    )
+
 
 def app_atexit():
-    pass
+    flush_settings()
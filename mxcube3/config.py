@@ -13,6 +13,46 @@ class FlaskConfig:
 
 class AppConfig:
     VIDEO_FORMAT = "MPEG1"
+    # Number of entries kept in the queue journal
+    QUEUE_JOURNAL_SIZE = 10000
+    # Interval in seconds between rescans of the data directory, 0 to disable
+    DATA_DIR_SCAN_INTERVAL = 60
+    # Number of entries in the stored queue operation log before a new
+    # snapshot is stored
+    QUEUE_STORE_LOG_SIZE = 1000
+    # Restore the queue stored in redis when the operator logs in, and log
+    # the queue changes so that it can be restored after a server restart
+    QUEUE_STORE_RESTORE = True
+    # Application settings file, see app.save_settings, whether it is gzip
+    # compressed and the delay in seconds before pending changes are written
+    SETTINGS_FILE = "stored-mxcube-session.json"
+    SETTINGS_COMPRESS = False
+    SETTINGS_SAVE_DELAY = 2
+    # Sample changer cost model (seconds) used to schedule the sample order,
+    # see scutils.schedule_samples
+    SC_SCHEDULE_MOUNT_TIME = 60
+    SC_SCHEDULE_PUCK_SWITCH_TIME = 20
+    SC_SCHEDULE_CELL_SWITCH_TIME = 15
+    SC_SCHEDULE_PUCKS_PER_CELL = 3
+    # Time (s) the sample changer preparation takes when it is simulated,
+    # for sample changers without native support (mockup). With prefetch
+    # enabled, the simulated preparation is part of each mount that was not
+    # prepared in advance
+    SC_PREFETCH_SIMULATED_TIME = 5
+    # Time model of the queue dry-run (s), centring time per sample, time for
+    # taking the snapshots of a task, fixed time per task and time for tasks
+    # without images (workflows, XRF and energy scans)
+    DRY_RUN_CENTRING_TIME = 30
+    DRY_RUN_SNAPSHOT_TIME = 4
+    DRY_RUN_TASK_TIME = 5
+    DRY_RUN_WORKFLOW_TIME = 300
+    # Time (s) during which the Socket.IO messages are collected and sent as
+    # one frame (see emit_bus), 0 to send each message directly
+    EMIT_FRAME_WINDOW = 0.05
+    # Maximum number of pending hardware signal handler calls and number of
+    # greenlets calling them (see signal_dispatch), one keeps the call order
+    SIGNAL_DISPATCH_SIZE = 1000
+    SIGNAL_DISPATCH_WORKERS = 1
 
 
 class Config:
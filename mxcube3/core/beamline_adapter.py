@@ -31,6 +31,7 @@ from HardwareRepository.HardwareObjects.abstract import AbstractNState
 from HardwareRepository.BaseHardwareObjects import HardwareObjectState
 
 from . import utils
+from . import emit_bus
 
 from .statedefs import (
     INOUT_STATE,
@@ -123,14 +124,17 @@ class HOAdapterBase:
         socketIO.
         """
         data = {"name": self._name, "value": args[0]}
-        socketio.emit("beamline_value_change", data, namespace="/hwr")
+        emit_bus.emit("beamline_value_change", data, key=self._name)
 
     def state_change(self, *args, **kwargs):
         """
         Signal handler to be used for sending the state to the client via
         socketIO
         """
-        socketio.emit("beamline_value_change", self.dict_repr(), namespace="/hwr")
+        # Not coalesced with the value changes, which only contain the value
+        emit_bus.emit(
+            "beamline_value_change", self.dict_repr(), key=(self._name, "state")
+        )
 
     def _dict_repr(self):
         return {}
@@ -1108,10 +1112,10 @@ class DataPublisherHOAdapter(HOAdapterBase):
             self._available = True
 
     def _new_data_handler(self, data):
-        socketio.emit("data_publisher_new_data", data, namespace="/hwr")
+        emit_bus.emit("data_publisher_new_data", data)
 
     def _update_publisher_handler(self, data):
-        socketio.emit("data_publisher_update", data, namespace="/hwr")
+        emit_bus.emit("data_publisher_update", data)
 
     def state(self):
         return HardwareObjectState.READY.value
@@ -11,6 +11,7 @@ from mxcube3 import blcontrol
 from mxcube3 import mxcube
 
 from .qutils import READY
+from . import signal_dispatch
 
 
 from mxcube3.core.beamline_adapter import BeamlineAdapter
@@ -23,7 +24,9 @@ def init_signals():
         beamInfo = blcontrol.beamline.beam
         if beamInfo is not None:
             for sig in signals.beam_signals:
-                beamInfo.connect(beamInfo, sig, signals.beam_changed)
+                beamInfo.connect(
+                    beamInfo, sig, signal_dispatch.dispatcher(signals.beam_changed)
+                )
         else:
             logging.getLogger("MX3.HWR").error("beam_info is not defined")
     except Exception as ex:
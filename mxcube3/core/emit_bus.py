@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Batched emission of Socket.IO messages.
+
+Hardware events (motor positions and states, beamline values, task progress,
+log records) are emitted through emit instead of socketio.emit. The messages
+of a namespace are collected during APP.EMIT_FRAME_WINDOW seconds and sent as
+one "frame" message, a list of [event, data] pairs in emission order, which
+the client unpacks and dispatches to the handlers of each event (see
+ServerIO.unpackFrames). A message emitted with a key replaces the pending
+message with the same event and key, so that for instance only the last
+position of a moving motor is sent per frame.
+
+Messages emitted from another thread than the one of the gevent hub (for
+instance log records of code running in the hub threadpool) are handed over
+to the hub and emitted from there. The queue and sample changer updates also
+go through the bus, so that they stay ordered with the hardware events.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import threading
+from collections import OrderedDict
+
+import gevent
+
+from mxcube3 import mxcube
+from mxcube3 import socketio
+
+# Event of the messages containing a frame
+FRAME_EVENT = "frame"
+
+# Hub of the main thread, the messages are emitted from its thread
+HUB = gevent.get_hub()
+
+# Pending messages per namespace, {namespace: {slot: (event, data)}}, where
+# slot is (event, key) for keyed messages and a sequence number otherwise
+PENDING = {}
+SEQUENCE = itertools.count()
+
+# Greenlet sending the pending messages of each namespace
+FLUSH_TASKS = {}
+
+METRICS = {
+    "messagesIn": 0,
+    "messagesCoalesced": 0,
+    "messagesOut": 0,
+    "framesOut": 0,
+}
+
+
+def emit(event, data=None, namespace="/hwr", key=None):
+    """
+    Emits the message <event> with <data> to the clients connected to
+    <namespace>, with the next frame.
+
+    :param str event: Event
+    :param data: Message data
+    :param str namespace: Socket.IO namespace
+    :param key: Key identifying the subject of the message (for instance the
+                name of a motor), a pending message with the same event and
+                key is replaced. Messages without key are all sent.
+    """
+    # Greenlets can not be spawned (nor Socket.IO messages sent) from
+    # another thread
+    if threading.get_ident() != HUB.thread_ident:
+        HUB.loop.run_callback_threadsafe(emit, event, data, namespace, key)
+        return
+
+    METRICS["messagesIn"] += 1
+    window = mxcube.CONFIG.APP.EMIT_FRAME_WINDOW
+
+    if not window:
+        METRICS["messagesOut"] += 1
+        METRICS["framesOut"] += 1
+        socketio.emit(event, data, namespace=namespace)
+        return
+
+    pending = PENDING.setdefault(namespace, OrderedDict())
+
+    if key is None:
+        slot = next(SEQUENCE)
+    else:
+        slot = (event, key)
+
+        # Keep the order of the messages, the replacing message comes last
+        if pending.pop(slot, None) is not None:
+            METRICS["messagesCoalesced"] += 1
+
+    pending[slot] = (event, data)
+
+    if namespace not in FLUSH_TASKS:
+        FLUSH_TASKS[namespace] = gevent.spawn_later(window, flush, namespace)
+
+
+def flush(namespace="/hwr"):
+    """
+    Sends the pending messages of <namespace>, a single message is sent as
+    is, several messages as a frame.
+
+    :param str namespace: Socket.IO namespace
+    """
+    task = FLUSH_TASKS.pop(namespace, None)
+
+    if task is not None and task is not gevent.getcurrent():
+        task.kill(block=False)
+
+    pending = PENDING.pop(namespace, None)
+
+    if not pending:
+        return
+
+    METRICS["messagesOut"] += len(pending)
+    METRICS["framesOut"] += 1
+
+    if len(pending) == 1:
+        event, data = next(iter(pending.values()))
+        socketio.emit(event, data, namespace=namespace)
+    else:
+        frame = [[event, data] for event, data in pending.values()]
+        socketio.emit(FRAME_EVENT, frame, namespace=namespace)
+
+
+def get_metrics():
+    """
+    :returns: {messagesIn, messagesCoalesced, messagesOut, framesOut,
+              messagesPerFrame, frameWindow}
+    :rtype: dict
+    """
+    res = dict(METRICS)
+    res["messagesPerFrame"] = (
+        res["messagesOut"] / res["framesOut"] if res["framesOut"] else 0
+    )
+    res["frameWindow"] = mxcube.CONFIG.APP.EMIT_FRAME_WINDOW
+
+    return res
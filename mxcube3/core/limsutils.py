@@ -12,36 +12,193 @@ import io
 import math
 import re
 
+import gevent
+import gevent.event
+
 from scandir import scandir
 
 from HardwareRepository.HardwareObjects import queue_model_objects as qmo
 
 from mxcube3 import mxcube
 from mxcube3 import blcontrol
+from mxcube3 import socketio
 
 from flask import session
 
+from . import queue_view
+
 VALID_SAMPLE_NAME_REGEXP = re.compile("^[a-zA-Z0-9:+_-]+$")
 
-def scantree(path, include):
-    res = []
+# Contents of the scanned data directories, directory path ->
+# (mtime, [data files], [sub directories]), directories that were not
+# modified since the previous scan are not listed again.
+DATA_DIR_CACHE = {}
 
-    try:
-        res = _scantree_rec(path, include, [])
-    except OSError:
-        pass
+# Cleared while the initial scan of the data directory is in progress
+DATA_DIR_SCANNED = gevent.event.Event()
+DATA_DIR_SCANNED.set()
 
-    return res
+# Root directory, included file suffixes and greenlet of the running data
+# directory scan
+DATA_DIR_SCAN_ROOT = None
+DATA_DIR_SCAN_INCLUDE = []
+DATA_DIR_SCAN_TASK = None
+
+# Run numbers used while the initial scan is in progress, prefix path -> run
+# number, merged in to the run number index built from the scanned files
+# (see qutils.build_run_number_index)
+DATA_DIR_SCAN_RUN_NUMBERS = {}
+
+# Number of directories scanned between two progress updates
+DATA_DIR_SCAN_PROGRESS_STEP = 100
+
+
+def _list_data_dir(path, include, cached_mtime):
+    mtime = os.path.getmtime(path)
 
+    if mtime == cached_mtime:
+        return mtime, None, None
+
+    files, dirs = [], []
 
-def _scantree_rec(path, include=[], files=[]):
     for entry in scandir(path):
         if entry.is_dir(follow_symlinks=False):
-            _scantree_rec(entry.path, include, files)
+            dirs.append(entry.path)
         elif entry.is_file():
             if os.path.splitext(entry.path)[1][1:] in include:
                 files.append(entry.path)
 
+    return mtime, files, dirs
+
+
+def _scan_data_dir(path, include):
+    """
+    Lists the directory <path>, in the gevent thread pool so that the hub is
+    not blocked, the cached contents are used if <path> was not modified.
+
+    :returns: Tuple (files, sub directories, new files)
+    """
+    cached = DATA_DIR_CACHE.get(path)
+
+    try:
+        mtime, files, dirs = gevent.get_hub().threadpool.apply(
+            _list_data_dir, (path, include, cached[0] if cached else None)
+        )
+    except OSError:
+        return [], [], []
+
+    if files is None:
+        return cached[1], cached[2], []
+
+    DATA_DIR_CACHE[path] = (mtime, files, dirs)
+    new_files = set(files) - set(cached[1]) if cached else files
+
+    return files, dirs, list(new_files)
+
+
+def scan_data_directory(root_path, include):
+    """
+    Scans <root_path> recursively for files with one of the suffixes in
+    <include>, progress is reported with the "data_dir_scan" signal
+
+    :param str root_path: Directory to scan
+    :param list include: File suffixes to include
+    :returns: Tuple (all files, files that were not found by previous scans)
+    """
+    all_files, new_files, visited = [], [], set()
+    stack = [root_path]
+
+    while stack:
+        path = stack.pop()
+        files, dirs, new = _scan_data_dir(path, include)
+
+        visited.add(path)
+        all_files.extend(files)
+        new_files.extend(new)
+        stack.extend(dirs)
+
+        if len(visited) % DATA_DIR_SCAN_PROGRESS_STEP == 0:
+            _emit_data_dir_scan_progress(len(visited), len(all_files), False)
+
+    # Forget removed directories
+    for path in list(DATA_DIR_CACHE.keys()):
+        if path not in visited and path.startswith(root_path):
+            DATA_DIR_CACHE.pop(path)
+
+    _emit_data_dir_scan_progress(len(visited), len(all_files), True)
+
+    return all_files, new_files
+
+
+def _emit_data_dir_scan_progress(num_dirs, num_files, done):
+    socketio.emit(
+        "data_dir_scan",
+        {"directories": num_dirs, "files": num_files, "done": done},
+        namespace="/hwr",
+    )
+
+
+def _data_dir_scan_task(root_path, include):
+    from mxcube3.core import qutils
+
+    try:
+        files, new_files = scan_data_directory(root_path, include)
+        mxcube.INITIAL_FILE_LIST = files
+        qutils.build_run_number_index(files)
+    finally:
+        DATA_DIR_SCANNED.set()
+
+    # Pick up the files written since the previous scan
+    while mxcube.CONFIG.APP.DATA_DIR_SCAN_INTERVAL:
+        gevent.sleep(mxcube.CONFIG.APP.DATA_DIR_SCAN_INTERVAL)
+
+        files, new_files = scan_data_directory(root_path, include)
+        mxcube.INITIAL_FILE_LIST = files
+        qutils.update_run_number_index(new_files)
+
+
+def start_data_directory_scan(root_path, include):
+    """
+    Starts the scan of the data directory <root_path> in the background,
+    the directory is then rescanned every APP.DATA_DIR_SCAN_INTERVAL seconds.
+
+    :param str root_path: Directory to scan
+    :param list include: File suffixes to include
+    """
+    global DATA_DIR_SCAN_ROOT, DATA_DIR_SCAN_INCLUDE, DATA_DIR_SCAN_TASK
+
+    stop_data_directory_scan()
+
+    DATA_DIR_SCANNED.clear()
+    DATA_DIR_SCAN_ROOT = root_path
+    DATA_DIR_SCAN_INCLUDE = include
+    DATA_DIR_SCAN_TASK = gevent.spawn(_data_dir_scan_task, root_path, include)
+
+
+def stop_data_directory_scan():
+    """
+    Stops the scan, and the periodic rescans, of the data directory
+    """
+    global DATA_DIR_SCAN_ROOT, DATA_DIR_SCAN_TASK
+
+    if DATA_DIR_SCAN_TASK is not None:
+        DATA_DIR_SCAN_TASK.kill()
+
+    DATA_DIR_SCAN_ROOT = None
+    DATA_DIR_SCAN_TASK = None
+    DATA_DIR_SCAN_RUN_NUMBERS.clear()
+    DATA_DIR_SCANNED.set()
+
+
+def scan_task_directory(path):
+    """
+    Lists the data files in the directory <path> of a task, without waiting
+    for the scan of the data directory to finish.
+
+    :param str path: Directory to list
+    :returns: List of files
+    """
+    files, _, _ = _scan_data_dir(path, DATA_DIR_SCAN_INCLUDE)
     return files
 
 
@@ -55,6 +212,7 @@ def init_sample_list():
 
 def sample_list_set(sample_list):
     mxcube.SAMPLE_LIST = sample_list
+    mxcube.save_settings()
 
 
 def sample_list_set_order(sample_order):
@@ -100,7 +258,9 @@ def synch_sample_list_with_queue(current_queue=None):
 
     for loc, data in mxcube.SAMPLE_LIST["sampleList"].items():
         if loc in current_queue:
-            sample = current_queue[loc]
+            # The samples of the queue are the read-only views of the queue
+            # serialization cache, work on a copy.
+            sample = queue_view.to_dict(current_queue[loc])
 
             # Don't synchronize, lims attributes from queue sample, if
             # they are already set by sc or lims
@@ -119,6 +279,8 @@ def synch_sample_list_with_queue(current_queue=None):
 
             # Make sure that sample in queue is updated with lims information
             model, entry = qutils.get_entry(sample["queueID"])
+            signature = _sample_model_signature(model)
+            old_loc = model.loc_str
             model.set_from_dict(data)
 
             # Update sample location, location is Manual for free pin mode
@@ -126,9 +288,31 @@ def synch_sample_list_with_queue(current_queue=None):
             model.loc_str = data.get("sampleID", -1)
             model.free_pin_mode = data.get("location", "") == "Manual"
 
+            if signature != _sample_model_signature(model):
+                qutils.invalidate_node_dict(model, descendants=True)
+                removed = [old_loc] if old_loc != model.loc_str else []
+                qutils.queue_journal.record("update", [model], removed=removed)
+
             sample_list_update_sample(loc, sample)
 
 
+def _sample_model_signature(model):
+    """
+    :returns: The attributes of the sample model <model> that are part of its
+              dictionary representation and that can be updated from LIMS
+    :rtype: tuple
+    """
+    return (
+        model.loc_str,
+        model.free_pin_mode,
+        model.get_name(),
+        model.code,
+        model.location,
+        model.lims_id,
+        model.crystals[0].protein_acronym,
+    )
+
+
 def sample_list_update_sample(loc, sample):
     _sample = mxcube.SAMPLE_LIST["sampleList"].get(loc, {})
 
@@ -369,9 +553,9 @@ def select_proposal(proposal):
         # Get all the files in the root data dir for this user
         root_path = blcontrol.beamline.session.get_base_image_directory()
 
-        if not mxcube.INITIAL_FILE_LIST and os.path.isdir(root_path):
+        if DATA_DIR_SCAN_ROOT != root_path and os.path.isdir(root_path):
             ftype = blcontrol.beamline.detector.getProperty("file_suffix")
-            mxcube.INITIAL_FILE_LIST = scantree(root_path, [ftype])
+            start_data_directory_scan(root_path, [ftype])
 
         logging.getLogger("user_log").info("[LIMS] Proposal selected.")
 
@@ -21,6 +21,7 @@ from mxcube3 import socketio
 from . import limsutils
 from . import utils
 from . import qutils
+from . import queue_checkpoint
 from . import scutils
 
 
@@ -273,15 +274,21 @@ def login(login_id, password):
         if not scutils.get_current_sample() and address:
             scutils.get_sample_list()
 
-        # For the moment not loading queue from persistent storage (redis),
-        # uncomment to enable loading.
-        # qutils.load_queue(session)
-        # logging.getLogger('MX3.HWR').info('Loaded queue')
-        logging.getLogger("MX3.HWR").info("[QUEUE] %s " % qutils.queue_to_json())
-
         if not get_operator():
             set_operator(session.sid)
 
+            if mxcube.CONFIG.APP.QUEUE_STORE_RESTORE:
+                try:
+                    qutils.load_queue(session)
+                except Exception:
+                    logging.getLogger("MX3.HWR").exception(
+                        "[QUEUE] Could not load stored queue"
+                    )
+
+        logging.getLogger("MX3.HWR").info(
+            "[QUEUE] journal position %s", qutils.queue_journal.get_position()
+        )
+
         return login_res["status"]
 
 
@@ -292,8 +299,10 @@ def signout():
     if is_operator(session.sid):
         qutils.save_queue(session)
         qutils.clear_queue()
+        queue_checkpoint.clear()
         blcontrol.beamline.sample_view.clear_all()
         limsutils.init_sample_list()
+        limsutils.stop_data_directory_scan()
 
         qutils.init_queue_settings()
 
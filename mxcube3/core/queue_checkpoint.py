@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Named checkpoints of the queue.
+
+A checkpoint holds the representation of each sample of the queue, in queue
+order, and a copy of the sample list. The sample representations are the
+read-only views of the serialization cache (see queue_view), so creating a
+checkpoint only copies references. Restoring a checkpoint only rebuilds the
+samples that changed since the checkpoint was created, the samples that are
+unchanged (the same view) are kept as they are.
+
+The changed samples are rebuilt from their representation with the same code
+path as when they are added to the queue (qutils._queue_add_items), not by
+restoring the queue model nodes, which would require copying the nodes and
+queue entries of the hardware repository. Their queue ids change and their
+execution state is not restored.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+from HardwareRepository.HardwareObjects import queue_model_objects as qmo
+
+from mxcube3 import mxcube
+from mxcube3 import blcontrol
+
+from . import queue_journal
+from . import queue_store
+from . import queue_view
+
+# Checkpoints created in this session, name -> checkpoint (see create)
+CHECKPOINTS = {}
+
+
+def _info(checkpoint):
+    return {
+        "name": checkpoint["name"],
+        "timestamp": checkpoint["timestamp"],
+        "version": checkpoint["version"],
+        "samples": len(checkpoint["state"]["order"]),
+    }
+
+
+def get_queue_state():
+    """
+    :returns: The current queue on the form {"samples": {sid: sample},
+              "order": [sid, ...]}, see queue_journal.get_state, with the
+              cached sample representations
+    :rtype: dict
+    """
+    from . import qutils
+
+    root = blcontrol.beamline.queue_model.get_model_root()
+    samples, order = {}, []
+
+    with qutils.node_state_pass():
+        for node in root.get_children():
+            if isinstance(node, qmo.Sample):
+                sid = node.loc_str
+                samples[sid] = qutils._get_node_dict(
+                    node, qutils._handle_sample, node
+                )[sid]
+                order.append(sid)
+
+    return {"samples": samples, "order": order}
+
+
+def create(name, persist=False):
+    """
+    Creates the checkpoint <name> of the current queue and sample list,
+    replacing an existing checkpoint with the same name.
+
+    :param str name: Name of the checkpoint
+    :param bool persist: Also store the checkpoint in redis, with the queue
+                         of the current proposal (see queue_store)
+    :returns: {name, timestamp, version, samples}
+    :rtype: dict
+    :raises ValueError: If <name> is empty or if the checkpoint can not be
+                        persisted
+    """
+    if not name:
+        raise ValueError("Checkpoint name missing")
+
+    checkpoint = {
+        "name": name,
+        "timestamp": time.time(),
+        "version": queue_journal.get_position(),
+        "state": get_queue_state(),
+        "sampleList": queue_view.to_dict(mxcube.SAMPLE_LIST),
+    }
+
+    if persist:
+        queue_store.save_checkpoint(name, checkpoint)
+
+    CHECKPOINTS[name] = checkpoint
+
+    return _info(checkpoint)
+
+
+def _get(name):
+    checkpoint = CHECKPOINTS.get(name)
+
+    if checkpoint is None:
+        checkpoint = queue_store.load_checkpoint(name)
+
+        if checkpoint is None:
+            raise ValueError("Unknown checkpoint %s" % name)
+
+        # Compare and share the stored samples as views
+        checkpoint["state"]["samples"] = {
+            sid: queue_view.compact(sample)
+            for sid, sample in checkpoint["state"]["samples"].items()
+        }
+
+        CHECKPOINTS[name] = checkpoint
+
+    return checkpoint
+
+
+def restore_state(state, sample_list):
+    """
+    Restores the queue state <state> (see get_queue_state) and the sample
+    list <sample_list>. The samples that are unchanged are kept, the samples
+    that are not part of <state> or that changed are removed, and the
+    changed or removed samples of <state> are added (as one batch).
+
+    :param dict state: Queue state
+    :param dict sample_list: Sample list
+    :returns: (kept, restored, removed), the ids of the samples kept and
+              the numbers of samples added and removed
+    :rtype: tuple
+    """
+    from . import qutils
+    from . import queue_index
+
+    target = state["samples"]
+    current = get_queue_state()["samples"]
+    kept, removed, items = set(), [], []
+
+    with qutils.queue_batch_context():
+        for sid, sample in current.items():
+            if target.get(sid) is sample or target.get(sid) == sample:
+                kept.add(sid)
+            else:
+                _, entry = qutils.get_entry(sample["queueID"])
+                qutils.delete_entry(entry)
+                removed.append(sid)
+
+        for sid in state["order"]:
+            if sid not in kept:
+                # The queue ids of the state are no longer valid
+                items.append(qutils.new_queue_item(target[sid]))
+
+        if items:
+            qutils._queue_add_items(items)
+
+    # Samples are added enabled
+    for item in items:
+        if not item["checked"]:
+            qutils.set_enabled_entry(
+                queue_index.get_sample_queue_id(item["sampleID"]), False
+            )
+
+    qutils.set_sample_order(state["order"])
+    mxcube.SAMPLE_LIST = queue_view.to_dict(sample_list)
+
+    return kept, len(items), removed
+
+
+def restore(name):
+    """
+    Restores the queue and the sample list of checkpoint <name>, see
+    restore_state
+
+    :param str name: Name of the checkpoint
+    :returns: {name, timestamp, version, samples, kept, restored, removed}
+    :rtype: dict
+    :raises ValueError: If there is no checkpoint <name> or if the queue is
+                        running
+    """
+    if blcontrol.beamline.queue_manager.is_executing():
+        raise ValueError("Can not restore checkpoint %s, queue running" % name)
+
+    t0 = time.time()
+    checkpoint = _get(name)
+    kept, restored, removed = restore_state(
+        checkpoint["state"], checkpoint["sampleList"]
+    )
+
+    logging.getLogger("MX3.HWR").info(
+        "[QUEUE] Restored checkpoint %s (%s samples kept, %s restored) in "
+        "%.3f s",
+        name,
+        len(kept),
+        restored,
+        time.time() - t0,
+    )
+
+    res = _info(checkpoint)
+    res.update({"kept": len(kept), "restored": restored, "removed": removed})
+
+    return res
+
+
+def get_checkpoints():
+    """
+    :returns: The checkpoints of this session, [{name, timestamp, version,
+              samples}, ...], oldest first
+    :rtype: list
+    """
+    res = [_info(checkpoint) for checkpoint in CHECKPOINTS.values()]
+
+    return sorted(res, key=lambda info: info["timestamp"])
+
+
+def delete(name):
+    """
+    Deletes the checkpoint <name>, also from redis
+
+    :param str name: Name of the checkpoint
+    :raises ValueError: If there is no checkpoint <name>
+    """
+    persisted = queue_store.delete_checkpoint(name)
+
+    if CHECKPOINTS.pop(name, None) is None and not persisted:
+        raise ValueError("Unknown checkpoint %s" % name)
+
+
+def clear():
+    """
+    Forgets the checkpoints of this session, the persisted checkpoints are
+    kept
+    """
+    CHECKPOINTS.clear()
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Dry-run of the queue.
+
+The queue is walked in the order queue_manager.execute would execute it and
+the duration of each step (mount, centring, snapshots, exposure) is predicted
+with a time model, so that the time a queue takes can be estimated without
+beam. For each task, the server side work done when the task is started and
+finished (signal handling, serialization of the queue and the emitted
+messages) is performed and timed, to benchmark the overhead of the server.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import time
+
+from HardwareRepository.HardwareObjects import queue_model_objects as qmo
+
+from mxcube3 import mxcube
+from mxcube3 import blcontrol
+
+from . import qutils
+from . import scutils
+
+
+def get_time_model(time_model=None):
+    """
+    :param dict time_model: Values overriding the configured time model
+    :returns: The time model on the form:
+              {
+                mount: time (s) for mounting a sample, None to use the sample
+                       changer model (APP.SC_SCHEDULE_*),
+                centring: time (s) for centring a sample,
+                snapshots: time (s) for taking the snapshots of a task,
+                task: fixed time (s) per task, for instance for moving motors,
+                workflow: time (s) for tasks without images (workflows,
+                          XRF and energy scans)
+              }
+    :rtype: dict
+    """
+    cfg = mxcube.CONFIG.APP
+
+    res = {
+        "mount": None,
+        "centring": cfg.DRY_RUN_CENTRING_TIME,
+        "snapshots": cfg.DRY_RUN_SNAPSHOT_TIME,
+        "task": cfg.DRY_RUN_TASK_TIME,
+        "workflow": cfg.DRY_RUN_WORKFLOW_TIME,
+    }
+
+    for key, value in (time_model or {}).items():
+        if key not in res:
+            raise ValueError("Unknown time model parameter %s" % key)
+
+        if value is not None and (not isinstance(value, (int, float)) or value < 0):
+            raise ValueError("Invalid value %s for %s" % (value, key))
+
+        res[key] = value
+
+    return res
+
+
+def _acquisition_time(acq, time_model):
+    params = acq.acquisition_parameters
+    t = params.exp_time * params.num_images
+
+    if params.take_snapshots:
+        t += time_model["snapshots"]
+
+    return t
+
+
+def task_time(model, time_model):
+    """
+    :param TaskNode model: Task
+    :param dict time_model: Time model, see get_time_model
+    :returns: Predicted time (s) for executing the task <model>
+    :rtype: float
+    """
+    t = time_model["task"]
+
+    if isinstance(model, qmo.DataCollection):
+        t += sum(_acquisition_time(acq, time_model) for acq in model.acquisitions)
+    elif isinstance(model, qmo.Characterisation):
+        ref = model.reference_image_collection
+        t += sum(_acquisition_time(acq, time_model) for acq in ref.acquisitions)
+    else:
+        t += time_model["workflow"]
+
+    return t
+
+
+def _tasks(node):
+    """
+    :returns: The enabled tasks of <node> in execution order, the tasks of
+              task groups (for instance interleaved collections) are
+              executed in turn
+    """
+    res = []
+
+    for child in node.get_children():
+        if not child.is_enabled():
+            continue
+
+        if isinstance(child, qmo.TaskGroup):
+            res.extend(_tasks(child))
+        else:
+            res.append(child)
+
+    return res
+
+
+def _step(steps, start, name, duration, queue_id):
+    steps.append(
+        {"name": name, "queueID": queue_id, "start": start, "duration": duration}
+    )
+
+    return start + duration
+
+
+def _timed(func, *args):
+    t0 = time.time()
+    res = func(*args)
+
+    return res, time.time() - t0
+
+
+def _entry_overhead(model, overhead):
+    """
+    Performs the server side work done when the task <model> is started or
+    finished (see signals.queue_execution_entry_started), the messages are
+    encoded but not emitted. The representations of the queue are rebuilt
+    in a copy of the serialization cache, the cache is left as it is.
+    """
+    from mxcube3.routes import signals
+
+    sample = qutils.get_sample_node(model)
+    _, entry = qutils.get_entry(model._node_id)
+
+    with qutils.node_state_pass():
+        with qutils.node_dict_cache_copy():
+            _, dt = _timed(qutils.invalidate_node_dict, model, True)
+            overhead["signalHandling"] += dt
+
+            _, dt = _timed(
+                qutils._get_node_dict, sample, qutils._handle_sample, sample
+            )
+            overhead["serialization"] += dt
+
+        if entry is not None and not qutils.is_interleaved(model):
+            msg, dt = _timed(signals.get_task_state, entry)
+            overhead["signalHandling"] += dt
+
+            data, dt = _timed(json.dumps, msg)
+            overhead["emitEncoding"] += dt
+            overhead["emits"] += 1
+            overhead["emitBytes"] += len(data)
+
+
+def dry_run(time_model=None, sample_ids=None):
+    """
+    Predicts the execution of the enabled samples of the queue
+
+    :param dict time_model: Values overriding the configured time model, see
+                            get_time_model
+    :param list sample_ids: Samples (location) to execute, all enabled
+                            samples if None
+    :returns: Dictionary on the form:
+              {
+                samples: [{sampleID: location, start: t, end: t,
+                           steps: [{name, queueID, start, duration}, ...]},
+                          ...],
+                totalTime: predicted time (s) for the queue,
+                timeModel: the time model used,
+                overhead: {signalHandling: s, serialization: s,
+                           emitEncoding: s, emits: n, emitBytes: n,
+                           total: s, perTask: s, tasks: n}
+              }
+    :rtype: dict
+    :raises ValueError: If the time model is invalid
+    """
+    time_model = get_time_model(time_model)
+    root = blcontrol.beamline.queue_model.get_model_root()
+    plate_mode = blcontrol.beamline.diffractometer.in_plate_mode()
+
+    overhead = {
+        "signalHandling": 0,
+        "serialization": 0,
+        "emitEncoding": 0,
+        "emits": 0,
+        "emitBytes": 0,
+        "tasks": 0,
+    }
+
+    samples, position, now = [], None, 0
+
+    for sample in root.get_children():
+        if not isinstance(sample, qmo.Sample) or not sample.is_enabled():
+            continue
+
+        if sample_ids is not None and sample.loc_str not in sample_ids:
+            continue
+
+        steps = []
+        start = now
+
+        if not plate_mode:
+            sample_position = scutils._sample_position(sample)
+
+            if time_model["mount"] is None:
+                mount_time = scutils._exchange_time(position, sample_position)
+            else:
+                mount_time = time_model["mount"]
+
+            now = _step(steps, now, "mount", mount_time, sample._node_id)
+            position = sample_position
+
+        centring_time = time_model["centring"]
+        now = _step(steps, now, "centring", centring_time, sample._node_id)
+
+        for task in _tasks(sample):
+            duration = task_time(task, time_model)
+            now = _step(steps, now, task.get_name(), duration, task._node_id)
+
+            # Started and finished
+            _entry_overhead(task, overhead)
+            _entry_overhead(task, overhead)
+            overhead["tasks"] += 1
+
+        samples.append(
+            {"sampleID": sample.loc_str, "start": start, "end": now, "steps": steps}
+        )
+
+    overhead["total"] = (
+        overhead["signalHandling"]
+        + overhead["serialization"]
+        + overhead["emitEncoding"]
+    )
+    overhead["perTask"] = (
+        overhead["total"] / overhead["tasks"] if overhead["tasks"] else 0
+    )
+
+    logging.getLogger("MX3.HWR").info(
+        "[QUEUE] Dry-run of %s samples, predicted time %.0f s, server overhead "
+        "%.3f s",
+        len(samples),
+        now,
+        overhead["total"],
+    )
+
+    return {
+        "samples": samples,
+        "totalTime": now,
+        "timeModel": time_model,
+        "overhead": overhead,
+    }
+
+
+def benchmark(queue_file, repeat=1, time_model=None):
+    """
+    Loads the queue in <queue_file> (NDJSON or CSV, see qutils.queue_import),
+    and prints the predicted timeline and the server overhead of a dry-run,
+    repeated <repeat> times.
+
+    :param str queue_file: Path to the queue file
+    :param int repeat: Number of dry-runs
+    :param dict time_model: Values overriding the configured time model
+    """
+    fmt = "csv" if queue_file.endswith(".csv") else "ndjson"
+
+    with open(queue_file) as f:
+        data = f.read()
+
+    qutils.clear_queue()
+
+    t0 = time.time()
+    qutils.queue_import(data, fmt)
+    import_time = time.time() - t0
+
+    runs = [dry_run(time_model) for _ in range(max(repeat, 1))]
+    report = runs[-1]
+
+    print("Queue %s imported in %.3f s" % (queue_file, import_time))
+
+    for sample in report["samples"]:
+        print(
+            "%-10s %8.1f - %8.1f s"
+            % (sample["sampleID"], sample["start"], sample["end"])
+        )
+
+        for step in sample["steps"]:
+            print("  %-30s %8.1f s" % (step["name"], step["duration"]))
+
+    print("Predicted time: %.1f s" % report["totalTime"])
+
+    for name in ("signalHandling", "serialization", "emitEncoding", "total"):
+        values = [run["overhead"][name] for run in runs]
+        print(
+            "Overhead %-15s min %.4f s, max %.4f s"
+            % (name, min(values), max(values))
+        )
+
+    print(
+        "%s tasks, %s emits (%s bytes), %.5f s overhead per task"
+        % (
+            report["overhead"]["tasks"],
+            report["overhead"]["emits"],
+            report["overhead"]["emitBytes"],
+            report["overhead"]["perTask"],
+        )
+    )
+
+    return report
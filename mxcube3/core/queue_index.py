@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Secondary indexes over the queue.
+
+The indexes map task type, execution state, data collection prefix and
+protein acronym to the queue nodes, and sample ids (location) to the sample
+nodes. They are updated from the journal entries (see queue_journal.flush),
+with the sample representations captured for the journal, so that looking
+up a subset of the queue does not require building the complete queue.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import defaultdict
+
+# Indexed fields of each node, {node_id: {queueID, sampleID, type, state,
+# checked, prefix, protein}}
+NODES = {}
+
+# Sample id (location) to the node id of the sample and to the node ids of
+# its tasks, in task index order
+SAMPLES = {}
+SAMPLE_TASKS = {}
+
+# Field value to node ids, for the fields in INDEXED_FIELDS
+INDEXES = {}
+
+INDEXED_FIELDS = ("type", "state", "checked", "prefix", "protein", "sampleID")
+
+
+def clear():
+    """
+    Clears the indexes
+    """
+    NODES.clear()
+    SAMPLES.clear()
+    SAMPLE_TASKS.clear()
+    INDEXES.clear()
+
+    for field in INDEXED_FIELDS:
+        INDEXES[field] = defaultdict(set)
+
+
+def _add_node(record):
+    NODES[record["queueID"]] = record
+
+    for field in INDEXED_FIELDS:
+        INDEXES[field][record[field]].add(record["queueID"])
+
+
+def _remove_node(node_id):
+    record = NODES.pop(node_id)
+
+    for field in INDEXED_FIELDS:
+        node_ids = INDEXES[field][record[field]]
+        node_ids.discard(node_id)
+
+        if not node_ids:
+            del INDEXES[field][record[field]]
+
+
+def remove_sample(sid):
+    """
+    Removes the sample with id <sid> and its tasks from the indexes
+
+    :param str sid: Sample id (location)
+    """
+    if sid in SAMPLES:
+        _remove_node(SAMPLES.pop(sid))
+
+        for node_id in SAMPLE_TASKS.pop(sid):
+            _remove_node(node_id)
+
+
+def update_sample(sid, sample):
+    """
+    Indexes the sample with id <sid> and its tasks
+
+    :param str sid: Sample id (location)
+    :param dict sample: The sample on the format returned by
+                        qutils.queue_to_dict
+    """
+    remove_sample(sid)
+
+    protein = sample.get("proteinAcronym")
+    SAMPLES[sid] = sample["queueID"]
+    SAMPLE_TASKS[sid] = [task["queueID"] for task in sample["tasks"]]
+
+    _add_node(
+        {
+            "queueID": sample["queueID"],
+            "sampleID": sid,
+            "type": "Sample",
+            "state": sample["state"],
+            "checked": sample["checked"],
+            "prefix": sample.get("defaultPrefix"),
+            "protein": protein,
+        }
+    )
+
+    for task in sample["tasks"]:
+        _add_node(
+            {
+                "queueID": task["queueID"],
+                "sampleID": sid,
+                "type": task["type"],
+                "state": task["state"],
+                "checked": task["checked"],
+                "prefix": task["parameters"].get("prefix"),
+                "protein": protein,
+            }
+        )
+
+
+def update(entry):
+    """
+    Updates the indexes with the journal entry <entry>, see
+    queue_journal.apply_entry
+    """
+    if entry["op"] == "clear":
+        clear()
+    elif entry["op"] == "order":
+        # Samples not in the new order are removed from the queue
+        for sid in set(SAMPLES) - set(entry["data"]["sampleOrder"]):
+            remove_sample(sid)
+
+    for sid in entry["removed"]:
+        remove_sample(sid)
+
+    for sid, sample in entry["samples"].items():
+        update_sample(sid, sample)
+
+
+def query(**criteria):
+    """
+    :param criteria: Field values the nodes should have, any of type,
+                     state, checked, prefix, protein and sampleID
+    :returns: The ids of the nodes matching all <criteria>, in ascending
+              order
+    :rtype: list
+    :raises ValueError: If a criterion is not an indexed field
+    """
+    from . import queue_journal
+
+    queue_journal.flush()
+
+    node_ids = None
+
+    for field, value in criteria.items():
+        if field not in INDEXED_FIELDS:
+            raise ValueError("Unknown query field %s" % field)
+
+        matching = INDEXES[field].get(value, set())
+        node_ids = matching if node_ids is None else node_ids & matching
+
+    if node_ids is None:
+        node_ids = NODES.keys()
+
+    return sorted(node_ids)
+
+
+def get_nodes(node_ids):
+    """
+    :returns: The indexed fields of the nodes with ids <node_ids>
+    :rtype: list
+    """
+    return [dict(NODES[node_id]) for node_id in node_ids]
+
+
+def get_sample_queue_id(sid):
+    """
+    :param str sid: Sample id (location)
+    :returns: The node id of the sample with id <sid>
+    :rtype: int
+    :raises KeyError: If the sample is not in the queue
+    """
+    from . import queue_journal
+
+    queue_journal.flush()
+
+    return SAMPLES[sid]
+
+
+def get_sample_tasks(sid):
+    """
+    :param str sid: Sample id (location)
+    :returns: The node ids of the tasks of the sample with id <sid>, in task
+              index order
+    :rtype: list
+    :raises KeyError: If the sample is not in the queue
+    """
+    from . import queue_journal
+
+    queue_journal.flush()
+
+    return SAMPLE_TASKS[sid]
+
+
+def get_puck_sample_queue_ids(puck):
+    """
+    :param puck: Puck (basket) number
+    :returns: The node ids of the samples in puck <puck>
+    :rtype: list
+    """
+    from . import queue_journal
+
+    queue_journal.flush()
+    prefix = "%s:" % puck
+
+    return [node_id for sid, node_id in SAMPLES.items() if sid.startswith(prefix)]
+
+
+clear()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only journal of the changes made to the queue.
+
+Each entry records the operation and the ids of the affected nodes. The
+dictionary representation of the affected samples (shared with the queue
+serialization cache, see qutils.NODE_DICT_CACHE) is kept with each entry so
+that the queue can be reconstructed at any position of the journal.
+
+The journal position is also the version of the queue, the changes are
+pushed to the clients as JSON-patch style deltas ("queue_delta") so that
+clients only need to fetch the complete queue when they are out of sync.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+from collections import OrderedDict, deque
+
+from HardwareRepository.HardwareObjects import queue_model_objects as qmo
+
+from mxcube3 import mxcube
+from mxcube3 import blcontrol
+
+from . import emit_bus
+from . import queue_index
+from . import queue_view
+
+# Journal entries, oldest first
+JOURNAL = deque()
+
+# Position of the last entry added to the journal
+POSITION = 0
+
+# Queue state at the position preceding the oldest entry in JOURNAL, entries
+# dropped from the journal are folded into this state.
+BASE = {"position": 0, "samples": {}, "order": []}
+
+# Entries for which the sample representations are not yet captured, they
+# are captured when the current batch of queue mutations ends.
+PENDING = []
+
+
+def record(op, nodes=(), samples=None, removed=(), **data):
+    """
+    Adds an entry to the journal
+
+    :param str op: The operation, for instance "add", "delete" or "enable"
+    :param list nodes: The affected queue model nodes
+    :param list samples: The sample nodes which representation changed,
+                         derived from <nodes> when not given
+    :param list removed: Sample ids (location) of the samples that were removed
+    :param data: Additional data describing the operation
+
+    :returns: The journal entry
+    :rtype: dict
+    """
+    from . import qutils
+
+    global POSITION
+    POSITION += 1
+
+    if samples is None:
+        samples = [qutils.get_sample_node(node) for node in nodes]
+
+    entry = {
+        "position": POSITION,
+        "timestamp": time.time(),
+        "op": op,
+        "nodes": [node._node_id for node in nodes],
+        "data": data,
+        "samples": {},
+        "removed": list(removed),
+    }
+
+    JOURNAL.append(entry)
+    PENDING.append((entry, [s for s in samples if s is not None]))
+
+    logging.getLogger("MX3.HWR").info(
+        "[QUEUE] %s %s (journal position %s)", op, entry["nodes"], POSITION
+    )
+
+    if not qutils.QUEUE_BATCH_DEPTH:
+        flush()
+
+    return entry
+
+
+def flush():
+    """
+    Captures the representation of the samples affected by the pending
+    entries, each sample is only serialized once per flush. The changes are
+    then applied to the queue indexes (see queue_index) and pushed to the
+    clients as one delta.
+    """
+    from . import qutils
+    from . import queue_store
+
+    if not PENDING:
+        return
+
+    sample_dicts = {}
+    sample_order = _sample_order()
+    since = PENDING[0][0]["position"] - 1
+
+    for entry, sample_nodes in PENDING:
+        entry["sampleOrder"] = sample_order
+
+        for sample_node in sample_nodes:
+            if sample_node._node_id not in sample_dicts:
+                sample_dict = qutils._get_node_dict(
+                    sample_node, qutils._handle_sample, sample_node
+                )
+                sample_dicts[sample_node._node_id] = sample_dict
+
+            entry["samples"].update(sample_dicts[sample_node._node_id])
+
+    entries = [entry for entry, _ in PENDING]
+    patches = [p for entry in entries for p in _entry_patches(entry)]
+    del PENDING[:]
+
+    for entry in entries:
+        queue_index.update(entry)
+
+    queue_store.append(entries)
+
+    # The samples are read-only views, plain dictionaries are emitted. The
+    # delta goes through the bus to stay ordered with the hardware events
+    emit_bus.emit(
+        "queue_delta",
+        {"version": POSITION, "since": since, "patches": queue_view.to_dict(patches)},
+    )
+
+    while len(JOURNAL) > mxcube.CONFIG.APP.QUEUE_JOURNAL_SIZE:
+        entry = JOURNAL.popleft()
+        apply_entry(BASE, entry)
+        BASE["position"] = entry["position"]
+
+
+def _sample_order():
+    """
+    :returns: The ids (location) of the enabled samples in queue order
+    :rtype: list
+    """
+    root = blcontrol.beamline.queue_model.get_model_root()
+
+    return [
+        sample.loc_str
+        for sample in root.get_children()
+        if isinstance(sample, qmo.Sample) and sample.is_enabled()
+    ]
+
+
+def _json_pointer(key):
+    return "/" + str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _entry_patches(entry):
+    """
+    :returns: The JSON-patch (RFC 6902) operations that applies the journal
+              entry <entry> to the queue on the format returned by
+              qutils.queue_to_dict
+    :rtype: list
+    """
+    patches = []
+
+    if entry["op"] == "clear":
+        patches.append({"op": "replace", "path": "", "value": {}})
+
+    for sid in entry["removed"]:
+        patches.append({"op": "remove", "path": _json_pointer(sid)})
+
+    for sid, sample in entry["samples"].items():
+        patches.append({"op": "add", "path": _json_pointer(sid), "value": sample})
+
+    if entry["op"] != "clear":
+        patches.append(
+            {"op": "add", "path": "/sample_order", "value": entry["sampleOrder"]}
+        )
+
+    return patches
+
+
+def apply_entry(state, entry):
+    """
+    Applies the journal entry <entry> to the queue state <state>, see
+    get_state
+    """
+    samples, order = state["samples"], state["order"]
+
+    if entry["op"] == "clear":
+        samples.clear()
+        del order[:]
+    elif entry["op"] == "order":
+        # Samples not in the new order are removed from the queue,
+        # see qutils.set_sample_order
+        new_order = [sid for sid in entry["data"]["sampleOrder"] if sid in samples]
+
+        for sid in set(order) - set(new_order):
+            samples.pop(sid, None)
+
+        order[:] = new_order
+
+    for sid in entry["removed"]:
+        samples.pop(sid, None)
+
+        if sid in order:
+            order.remove(sid)
+
+    for sid, sample in entry["samples"].items():
+        if sid not in samples:
+            order.append(sid)
+
+        samples[sid] = sample
+
+
+def get_position():
+    """
+    :returns: The position of the last entry in the journal
+    :rtype: int
+    """
+    return POSITION
+
+
+def get_entries(since=0):
+    """
+    :param int since: Only return entries after this position
+    :returns: The journal entries after position <since> without the sample
+              representations, on the form:
+              [{position: p, timestamp: t, op: op, nodes: [ids], data: {}}, ...]
+    :rtype: list
+    """
+    flush()
+
+    return [
+        {
+            "position": entry["position"],
+            "timestamp": entry["timestamp"],
+            "op": entry["op"],
+            "nodes": entry["nodes"],
+            "data": entry["data"],
+            "removed": entry["removed"],
+        }
+        for entry in JOURNAL
+        if entry["position"] > since
+    ]
+
+
+def get_delta(since=0):
+    """
+    :param int since: Version (journal position) the client has
+    :returns: The patches bringing the queue from version <since> to the
+              current version, on the form:
+              {version: current version, since: since, patches: [...]}
+
+              When <since> is 0 or no longer in the journal the patches
+              contain the complete queue, the patches of the entries are
+              otherwise collapsed to the last value of each path.
+    :rtype: dict
+    """
+    from . import qutils
+
+    flush()
+
+    if not since or since < BASE["position"] or since > POSITION:
+        patches = None
+    else:
+        # Only the last patch of each path is needed, a replace of the
+        # complete queue (clear) drops the patches before it
+        collapsed = OrderedDict()
+
+        for entry in JOURNAL:
+            if entry["position"] > since:
+                for patch in _entry_patches(entry):
+                    if patch["path"] == "":
+                        collapsed.clear()
+
+                    collapsed.pop(patch["path"], None)
+                    collapsed[patch["path"]] = patch
+
+        patches = list(collapsed.values())
+
+        # Larger than the queue itself
+        if len(patches) > len(queue_index.SAMPLES) + 1:
+            patches = None
+
+    if patches is None:
+        patches = [{"op": "replace", "path": "", "value": qutils.queue_to_dict()}]
+
+    return {
+        "version": POSITION,
+        "since": since,
+        "patches": queue_view.to_dict(patches),
+    }
+
+
+def reconstruct(position=None):
+    """
+    Reconstructs the queue as it was at journal position <position>
+
+    :param int position: Journal position, the last position if None
+    :returns: The queue on the format returned by qutils.queue_to_dict
+    :rtype: dict
+    :raises ValueError: If <position> is no longer (or not yet) in the journal
+    """
+    return state_to_dict(get_state(position))
+
+
+def get_state(position=None):
+    """
+    :param int position: Journal position, the last position if None
+    :returns: The queue state at journal position <position> on the form
+              {"samples": {sid: sample}, "order": [sid, ...]}, where order
+              contains all samples (enabled or not) in queue order.
+    :rtype: dict
+    :raises ValueError: If <position> is no longer (or not yet) in the journal
+    """
+    flush()
+
+    if position is None:
+        position = POSITION
+
+    if position < BASE["position"] or position > POSITION:
+        msg = "Journal position %s not available (%s - %s)"
+        raise ValueError(msg % (position, BASE["position"], POSITION))
+
+    state = {"samples": dict(BASE["samples"]), "order": list(BASE["order"])}
+
+    for entry in JOURNAL:
+        if entry["position"] > position:
+            break
+
+        apply_entry(state, entry)
+
+    return state
+
+
+def state_to_dict(state):
+    """
+    :param dict state: Queue state, see get_state
+    :returns: The queue on the format returned by qutils.queue_to_dict
+    :rtype: dict
+    """
+    samples, order = state["samples"], state["order"]
+
+    if not order:
+        return {}
+
+    res = {"sample_order": [sid for sid in order if samples[sid]["checked"]]}
+    res.update(samples)
+
+    return queue_view.to_dict(res)
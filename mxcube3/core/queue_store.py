@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Persistence of the queue in redis.
+
+The queue of a proposal is stored as a compact, versioned snapshot of the
+queue journal state (see queue_journal.get_state) and an append-only log of
+the journal entries recorded after the snapshot. The writes are done by a
+background greenlet, the encoding and compression in the gevent thread pool,
+so that saving the queue does not block the request that triggered it.
+
+Loading only replaces the decoding of the whole queue: the loaded queue is
+still rebuilt item by item in the queue model (see qutils.queue_add_item),
+as the queue is built when items are added by the client.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import time
+import zlib
+
+import gevent
+import gevent.queue
+import redis
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from mxcube3 import mxcube
+
+from . import queue_journal
+from . import queue_view
+
+# Version of the snapshot format
+SNAPSHOT_FORMAT = 1
+
+# Codec prefixes of the stored values
+CODEC_MSGPACK = b"M"
+CODEC_JSON = b"J"
+
+# Proposal for which the journal entries are appended to the operation log,
+# None when the log is closed, and the database the log is written to
+PROPOSAL_ID = None
+LOG_DB = None
+
+# Pending writes, processed in order by the writer greenlet
+WRITE_QUEUE = gevent.queue.Queue()
+WRITER_TASK = None
+
+# Number of entries in the operation log of the open proposal
+LOG_LENGTH = 0
+
+
+def _snapshot_key(proposal_id):
+    return "mxcube.queue:%d" % proposal_id
+
+
+def _log_key(proposal_id):
+    return "mxcube.queue:%d:log" % proposal_id
+
+
+def _checkpoints_key(proposal_id):
+    return "mxcube.queue:%d:checkpoints" % proposal_id
+
+
+def encode(obj):
+    """
+    :returns: <obj> encoded with msgpack (JSON if msgpack is not available)
+              and compressed
+    :rtype: bytes
+    """
+    if msgpack is not None:
+        data = msgpack.packb(obj, use_bin_type=True, default=dict)
+        return CODEC_MSGPACK + zlib.compress(data)
+
+    return CODEC_JSON + zlib.compress(queue_view.dumps(obj).encode("utf-8"))
+
+
+def decode(data):
+    """
+    :returns: The object encoded with encode
+    """
+    codec, data = data[:1], zlib.decompress(data[1:])
+
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+
+    return json.loads(data.decode("utf-8"))
+
+
+def _log_entry(entry):
+    return {
+        "position": entry["position"],
+        "op": entry["op"],
+        "data": entry["data"],
+        "samples": entry["samples"],
+        "removed": entry["removed"],
+    }
+
+
+def _write(func, *args):
+    global WRITER_TASK
+
+    WRITE_QUEUE.put((func, args))
+
+    if WRITER_TASK is None or WRITER_TASK.dead:
+        WRITER_TASK = gevent.spawn(_writer)
+
+
+def _writer():
+    threadpool = gevent.get_hub().threadpool
+
+    while not WRITE_QUEUE.empty():
+        func, args = WRITE_QUEUE.get()
+
+        try:
+            func(threadpool, *args)
+        except Exception:
+            logging.getLogger("MX3.HWR").exception("[QUEUE] Could not store queue")
+
+
+def _write_snapshot(threadpool, db, proposal_id, snapshot):
+    data = threadpool.apply(encode, (snapshot,))
+
+    pipe = db.pipeline()
+    pipe.set(_snapshot_key(proposal_id), data)
+    pipe.delete(_log_key(proposal_id))
+    pipe.execute()
+
+
+def _write_log(threadpool, db, proposal_id, entries):
+    data = threadpool.apply(lambda: [encode(entry) for entry in entries])
+    db.rpush(_log_key(proposal_id), *data)
+
+
+def _write_checkpoint(threadpool, db, proposal_id, name, checkpoint):
+    data = threadpool.apply(encode, (checkpoint,))
+    db.hset(_checkpoints_key(proposal_id), name, data)
+
+
+def wait():
+    """
+    Waits for the pending writes to be done
+    """
+    if WRITER_TASK is not None:
+        WRITER_TASK.join()
+
+
+def save(proposal_id, db=None):
+    """
+    Stores a snapshot of the current queue for proposal <proposal_id> and
+    starts a new operation log, the snapshot is written in the background.
+
+    :param int proposal_id: Proposal to store the queue for
+    :param redis.Redis db: Redis database
+    """
+    global LOG_LENGTH
+
+    db = db or redis.Redis()
+
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "version": queue_journal.get_position(),
+        "timestamp": time.time(),
+        "state": queue_journal.get_state(),
+    }
+
+    LOG_LENGTH = 0
+    _write(_write_snapshot, db, proposal_id, snapshot)
+
+
+def open_log(proposal_id, db=None):
+    """
+    Appends the queue changes to the operation log of proposal <proposal_id>,
+    from now on. A snapshot of the current queue is stored first.
+
+    :param int proposal_id: Proposal to store the queue for
+    :param redis.Redis db: Redis database
+    """
+    global PROPOSAL_ID, LOG_DB
+
+    LOG_DB = db or redis.Redis()
+    PROPOSAL_ID = proposal_id
+    save(proposal_id, LOG_DB)
+
+
+def close_log():
+    """
+    Stops appending queue changes to the operation log
+    """
+    global PROPOSAL_ID
+    PROPOSAL_ID = None
+
+
+def append(entries):
+    """
+    Appends the journal entries <entries> to the operation log, if open. A
+    new snapshot is stored when the log has grown beyond
+    APP.QUEUE_STORE_LOG_SIZE entries.
+
+    :param list entries: Journal entries
+    """
+    global LOG_LENGTH
+
+    if PROPOSAL_ID is None or not entries:
+        return
+
+    if LOG_LENGTH + len(entries) > mxcube.CONFIG.APP.QUEUE_STORE_LOG_SIZE:
+        save(PROPOSAL_ID, LOG_DB)
+    else:
+        LOG_LENGTH += len(entries)
+        entries = [_log_entry(entry) for entry in entries]
+        _write(_write_log, LOG_DB, PROPOSAL_ID, entries)
+
+
+def load(proposal_id, db=None):
+    """
+    Loads the queue stored for proposal <proposal_id>, the snapshot with the
+    entries of the operation log applied. The queue model is not built, see
+    qutils.load_queue_from_dict.
+
+    :param int proposal_id: Proposal to load the queue for
+    :param redis.Redis db: Redis database
+    :returns: The queue on the format returned by qutils.queue_to_dict, an
+              empty dictionary if no queue is stored
+    :rtype: dict
+    """
+    db = db or redis.Redis()
+    t0 = time.time()
+
+    # Make sure that pending writes are done
+    wait()
+
+    data = db.get(_snapshot_key(proposal_id))
+
+    if not data:
+        return {}
+
+    # Queues stored by previous versions (pickled) are ignored
+    if data[:1] not in (CODEC_MSGPACK, CODEC_JSON):
+        snapshot = {}
+    else:
+        snapshot = decode(data)
+
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        logging.getLogger("MX3.HWR").warning(
+            "[QUEUE] Ignoring stored queue with unknown format %s",
+            snapshot.get("format"),
+        )
+        return {}
+
+    state = snapshot["state"]
+    log = [decode(entry) for entry in db.lrange(_log_key(proposal_id), 0, -1)]
+
+    for entry in log:
+        if entry["position"] > snapshot["version"]:
+            queue_journal.apply_entry(state, entry)
+
+    logging.getLogger("MX3.HWR").info(
+        "[QUEUE] Loaded stored queue (%s samples, %s log entries) in %.3f s",
+        len(state["order"]),
+        len(log),
+        time.time() - t0,
+    )
+
+    return queue_journal.state_to_dict(state)
+
+
+def save_checkpoint(name, checkpoint):
+    """
+    Stores the queue checkpoint <name> (see queue_checkpoint) with the queue
+    of the open proposal, the checkpoint is written in the background.
+
+    :param str name: Name of the checkpoint
+    :param dict checkpoint: The checkpoint
+    :raises ValueError: If no proposal is open (see open_log)
+    """
+    if PROPOSAL_ID is None:
+        raise ValueError("No proposal to store the checkpoint %s for" % name)
+
+    _write(_write_checkpoint, LOG_DB, PROPOSAL_ID, name, checkpoint)
+
+
+def load_checkpoint(name):
+    """
+    :param str name: Name of the checkpoint
+    :returns: The queue checkpoint <name> stored with the queue of the open
+              proposal, None if there is no such checkpoint
+    :rtype: dict
+    """
+    if PROPOSAL_ID is None:
+        return None
+
+    wait()
+    data = LOG_DB.hget(_checkpoints_key(PROPOSAL_ID), name)
+
+    return decode(data) if data else None
+
+
+def delete_checkpoint(name):
+    """
+    Deletes the queue checkpoint <name> stored with the queue of the open
+    proposal
+
+    :param str name: Name of the checkpoint
+    :returns: True if the checkpoint was stored
+    :rtype: bool
+    """
+    if PROPOSAL_ID is None:
+        return False
+
+    wait()
+
+    return bool(LOG_DB.hdel(_checkpoints_key(PROPOSAL_ID), name))
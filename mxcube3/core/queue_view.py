@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, read-only view model of the queue.
+
+The dictionary representations of the queue nodes (see qutils._handle_*)
+are kept in the serialization cache (qutils.NODE_DICT_CACHE) and in the
+queue journal for as long as the nodes exist. The representations of the
+tasks all have the same keys, so instead of a dictionary per task, each
+representation is stored as a NodeView: the keys are kept once per distinct
+key set (Schema), and each view only holds a tuple with its values. Lists
+are stored as tuples and short strings are interned.
+
+NodeView implements the read-only mapping interface so it can be used like
+the dictionary it was made from, to_dict returns a mutable copy. JSON is
+produced directly from the views with JSONEncoder.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# Strings shorter than this are interned, values such as types, labels and
+# directories are then shared between the views
+INTERN_MAX_LENGTH = 128
+
+# Schema of each distinct key set, keys tuple -> Schema
+SCHEMAS = {}
+
+
+class Schema(object):
+    """
+    The keys of a set of views and the position of the value of each key
+    """
+
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+
+
+class NodeView(Mapping):
+    """
+    Read-only mapping with the values of a queue node representation
+    """
+
+    __slots__ = ("_schema", "_values")
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "NodeView(%r)" % to_dict(self)
+
+    def get(self, key, default=None):
+        i = self._schema.index.get(key)
+        return default if i is None else self._values[i]
+
+
+def _schema(keys):
+    schema = SCHEMAS.get(keys)
+
+    if schema is None:
+        schema = SCHEMAS[keys] = Schema(keys)
+
+    return schema
+
+
+def compact(value):
+    """
+    :returns: The compact, read-only representation of <value>, dictionaries
+              are converted to NodeViews and lists to tuples, recursively
+    """
+    if isinstance(value, NodeView):
+        return value
+    elif isinstance(value, dict):
+        keys = tuple(value)
+        values = tuple(compact(value[key]) for key in keys)
+        return NodeView(_schema(keys), values)
+    elif isinstance(value, (list, tuple)):
+        return tuple(compact(item) for item in value)
+    elif isinstance(value, str) and len(value) < INTERN_MAX_LENGTH:
+        return sys.intern(value)
+
+    return value
+
+
+def to_dict(value):
+    """
+    :returns: A mutable copy of <value> where NodeViews are converted to
+              dictionaries and tuples to lists, recursively
+    """
+    if isinstance(value, Mapping):
+        return {key: to_dict(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [to_dict(item) for item in value]
+
+    return value
+
+
+class JSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder handling NodeViews, the values are encoded directly from
+    the view.
+    """
+
+    def default(self, o):
+        if isinstance(o, Mapping):
+            return dict(zip(o, o.values()))
+
+        return super(JSONEncoder, self).default(o)
+
+
+def dumps(obj, **kwargs):
+    """
+    json.dumps handling NodeViews
+    """
+    kwargs.setdefault("cls", JSONEncoder)
+    return json.dumps(obj, **kwargs)
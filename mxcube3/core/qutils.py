@@ -4,13 +4,17 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import csv
+import io
 import json
-import pickle as pickle
+import hashlib
 import redis
 import itertools
 import logging
 import re
 
+import gevent
+
 from mock import Mock
 
 from HardwareRepository.HardwareObjects import queue_model_objects as qmo
@@ -20,12 +24,17 @@ from HardwareRepository.HardwareObjects.base_queue_entry import QUEUE_ENTRY_STAT
 
 from mxcube3 import mxcube
 from mxcube3 import blcontrol
-from mxcube3 import socketio
 
+from . import emit_bus
 from . import limsutils
+from . import queue_index
+from . import queue_journal
+from . import queue_store
+from . import queue_view
 from . import utils
 
 from .beamline_adapter import BeamlineAdapter
+from contextlib import contextmanager
 from functools import reduce
 
 # Important: same constants as in constants.js
@@ -45,6 +54,78 @@ READY = 0
 ORIGIN_MX3 = "MX3"
 QUEUE_CACHE = {}
 
+# Dictionary representation of queue nodes (as returned by the _handle_*
+# functions, without data retrieved from LIMS) keyed by node id. The cached
+# fragments are stored as compact, read-only views (see queue_view) shared
+# between calls to queue_to_dict, use queue_view.to_dict for a mutable copy.
+NODE_DICT_CACHE = {}
+
+# Position (task index) of the tasks of each sample, sample node id ->
+# {node id: task index}. Built on demand and dropped when tasks are added,
+# removed or moved within the sample.
+NODE_INDEX = {}
+
+# Model and queue entry of each node, node id -> (model, entry). Filled by
+# get_entry and emptied when nodes are removed from the queue.
+NODE_ENTRY_MAP = {}
+
+# The execution state of the queue manager, resolved once per serialization
+# pass (see node_state_pass), and the node states evaluated during the pass
+NODE_STATE_PASS = None
+
+# Number of nested queue batches (see queue_batch_context) currently applied
+QUEUE_BATCH_DEPTH = 0
+
+# Operations accepted by queue_batch and the keys they require
+QUEUE_BATCH_OPERATIONS = {
+    "add": ("items",),
+    "delete": ("items",),
+    "move": ("sampleID", "from", "to"),
+    "swap": ("sampleID", "from", "to"),
+    "enable": ("qidList", "enabled"),
+    "update": ("sampleQueueID", "queueID", "data"),
+    "order": ("sampleOrder",),
+}
+
+# Item types accepted by queue_import
+QUEUE_IMPORT_TYPES = (
+    "Sample",
+    "DataCollection",
+    "Interleaved",
+    "Characterisation",
+    "Workflow",
+    "XRFScan",
+    "EnergyScan",
+)
+
+# Columns accepted in CSV imports, each row describes a sample
+QUEUE_IMPORT_CSV_COLUMNS = (
+    "sampleID",
+    "sampleName",
+    "location",
+    "code",
+    "proteinAcronym",
+    "defaultPrefix",
+    "defaultSubDir",
+)
+
+# Number of items added to the queue between two progress updates of an import
+QUEUE_IMPORT_CHUNK_SIZE = 50
+
+# Default task parameters, name -> (params, etag), see get_default_params.
+# Emptied when one of the hardware objects in DEFAULT_PARAMS_SIGNALS (path
+# from the beamline object) emits one of the listed signals, or when omega
+# moves.
+DEFAULT_PARAMS_CACHE = {}
+
+DEFAULT_PARAMS_SIGNALS = (
+    ("energy", ("energyChanged", "valueChanged")),
+    ("resolution", ("valueChanged",)),
+    ("transmission", ("valueChanged",)),
+    ("detector", ("detectorModeChanged", "roiModeChanged", "binningModeChanged")),
+    ("detector.distance", ("valueChanged",)),
+)
+
 
 def is_collected(task):
     return (task["state"] & COLLECTED) == COLLECTED
@@ -54,6 +135,169 @@ def get_queue_from_cache():
     return QUEUE_CACHE
 
 
+def invalidate_node_dict(node, descendants=False):
+    """
+    Invalidates the cached dictionary representation of <node> and of all its
+    ancestors, the representation of a sample contains its tasks and the
+    state of a sample depends on the state of its tasks.
+
+    :param TaskNode node: Node that changed
+    :param bool descendants: True to also invalidate the children of <node>
+    """
+    if descendants:
+        _invalidate_node_dict_rec(node)
+
+    while node is not None:
+        NODE_DICT_CACHE.pop(node._node_id, None)
+        node = node.get_parent()
+
+
+def _invalidate_node_dict_rec(node):
+    NODE_DICT_CACHE.pop(node._node_id, None)
+
+    for child in node.get_children():
+        _invalidate_node_dict_rec(child)
+
+
+def get_sample_node(node):
+    """
+    :param TaskNode node: Sample node or any node below a sample
+    :returns: The sample node that <node> belongs to, None if <node> is not
+              part of a sample
+    """
+    while node is not None and not isinstance(node, qmo.Sample):
+        node = node.get_parent()
+
+    return node
+
+
+def invalidate_sample_dict(node):
+    """
+    Invalidates the cached dictionary representation of the sample that
+    <node> belongs to and of all its tasks, used when the position of tasks
+    within a sample changes.
+
+    :param TaskNode node: Sample node or any node below a sample
+    """
+    sample_node = get_sample_node(node)
+
+    if sample_node is not None:
+        invalidate_node_dict(sample_node, descendants=True)
+
+
+def invalidate_node_index(node):
+    """
+    Invalidates the task positions of the sample that <node> belongs to,
+    used when tasks are added, removed or moved.
+
+    :param TaskNode node: Sample node or any node below a sample
+    """
+    sample_node = get_sample_node(node)
+
+    if sample_node is not None:
+        NODE_INDEX.pop(sample_node._node_id, None)
+
+
+def _sample_task_index(sample_model):
+    """
+    :returns: Dictionary with the task index of each task of <sample_model>,
+              on the form {node_id: index}
+    """
+    index = NODE_INDEX.get(sample_model._node_id)
+
+    if index is None:
+        index = {}
+
+        for group in sample_model.get_children():
+            if group.interleave_num_images:
+                index[group._node_id] = len(index)
+            else:
+                for task in group.get_children():
+                    index[task._node_id] = len(index)
+
+        NODE_INDEX[sample_model._node_id] = index
+
+    return index
+
+
+def clear_node_dict_cache():
+    NODE_DICT_CACHE.clear()
+
+
+@contextmanager
+def node_dict_cache_copy():
+    """
+    Context manager replacing NODE_DICT_CACHE with a copy, so that cached
+    representations can be invalidated and rebuilt without affecting the
+    cache. The body must not yield to other greenlets, they would use the
+    copy.
+    """
+    global NODE_DICT_CACHE
+    cache = NODE_DICT_CACHE
+    NODE_DICT_CACHE = dict(cache)
+
+    try:
+        yield
+    finally:
+        NODE_DICT_CACHE = cache
+
+
+def _get_node_dict(node, handler, *args):
+    """
+    Returns the dictionary representation of <node>, the representation is
+    created by calling <handler> with <args> when its not already cached.
+    The representation is a read-only queue_view.NodeView.
+    """
+    res = NODE_DICT_CACHE.get(node._node_id)
+
+    if res is None:
+        res = queue_view.compact(handler(*args))
+        NODE_DICT_CACHE[node._node_id] = res
+
+    return res
+
+
+def _task_with_lims_data(task):
+    """
+    Returns a copy of <task> with the results retrieved from LIMS, or <task>
+    itself if there is nothing to retrieve (task not yet collected).
+    """
+    lims_id = mxcube.NODE_ID_TO_LIMS_ID.get(task["queueID"])
+
+    if (
+        not lims_id
+        or "limsResultData" not in task
+        or not blcontrol.beamline.lims.lims_rest
+    ):
+        return task
+
+    limsres = blcontrol.beamline.lims.lims_rest.get_dc(lims_id)
+    limsres["limsTaskLink"] = limsutils.get_dc_link(lims_id)
+
+    task = dict(task)
+    task["limsResultData"] = limsres
+
+    return task
+
+
+def _sample_with_lims_data(sample_dict):
+    """
+    Returns a copy of the sample representation <sample_dict> with the LIMS
+    results of its tasks, or <sample_dict> itself if none of the tasks have
+    results in LIMS.
+    """
+    (loc, sample), = sample_dict.items()
+    tasks = [_task_with_lims_data(task) for task in sample["tasks"]]
+
+    if all(t is o for t, o in zip(tasks, sample["tasks"])):
+        return sample_dict
+
+    sample = dict(sample)
+    sample["tasks"] = tasks
+
+    return {loc: sample}
+
+
 def build_prefix_path_dict(path_list):
     prefix_path_dict = {}
 
@@ -72,21 +316,98 @@ def build_prefix_path_dict(path_list):
     return prefix_path_dict
 
 
-def get_run_number(pt):
-    prefix_path_dict = build_prefix_path_dict(mxcube.INITIAL_FILE_LIST)
+def build_run_number_index(path_list):
+    """
+    Builds the index of the highest run number of each prefix path,
+    mxcube.RUN_NUMBER_INDEX, from the files in <path_list>, for a complete
+    scan of the data directory. The run numbers used while the scan was in
+    progress are kept.
+
+    :param list path_list: List of file paths
+    """
+    mxcube.RUN_NUMBER_INDEX = {}
+    update_run_number_index(path_list)
+
+    for prefix_path, run_number in limsutils.DATA_DIR_SCAN_RUN_NUMBERS.items():
+        _update_run_number_index(prefix_path, run_number)
+
+    limsutils.DATA_DIR_SCAN_RUN_NUMBERS.clear()
+
+
+def update_run_number_index(path_list):
+    """
+    Updates the index of the highest run number of each prefix path,
+    mxcube.RUN_NUMBER_INDEX, with the files in <path_list>, for files found
+    by an incremental scan
+
+    :param list path_list: List of file paths
+    """
+    for path in path_list:
+        try:
+            prefix_path, run_number, _ = qmo.PathTemplate.interpret_path(path)
+        except ValueError:
+            continue
+
+        _update_run_number_index(prefix_path, run_number)
+
+
+def _update_run_number_index(prefix_path, run_number):
+    if run_number > mxcube.RUN_NUMBER_INDEX.get(prefix_path, 0):
+        mxcube.RUN_NUMBER_INDEX[prefix_path] = run_number
+
+
+def _register_run_number(prefix_path, run_number):
+    _update_run_number_index(prefix_path, run_number)
 
+    # Merged in to the index built when the data directory scan completes
+    if not limsutils.DATA_DIR_SCANNED.is_set():
+        scan_run_numbers = limsutils.DATA_DIR_SCAN_RUN_NUMBERS
+
+        if run_number > scan_run_numbers.get(prefix_path, 0):
+            scan_run_numbers[prefix_path] = run_number
+
+
+def _prefix_path(pt):
     # Path templates of files not yet written to to disk, we are only
     # interested in the prefix path
-    fname = pt.get_image_path()
-    prefix_path, _, _ = qmo.PathTemplate.interpret_path(fname)
-    run_number = blcontrol.beamline.queue_model.get_next_run_number(pt)
+    prefix_path, _, _ = qmo.PathTemplate.interpret_path(pt.get_image_path())
+    return prefix_path
 
-    if prefix_path in prefix_path_dict:
-        rn = run_number + prefix_path_dict[prefix_path]
-    else:
-        rn = run_number
 
-    return rn
+def register_run_number(pt):
+    """
+    Registers the run number of the path template <pt> as used, for
+    tasks added to the queue and for collected data.
+
+    :param PathTemplate pt: Path template
+    """
+    _register_run_number(_prefix_path(pt), pt.run_number)
+
+
+def get_run_number(pt):
+    """
+    :param PathTemplate pt: Path template of a new task
+    :returns: The next free run number for the prefix path of <pt>
+    :rtype: int
+    """
+    prefix_path = _prefix_path(pt)
+
+    # While the data directory is scanned, only the directory of the task is
+    # listed to find the run numbers already on disk, they are kept when the
+    # index is rebuilt from the whole data directory once the scan completes
+    if not limsutils.DATA_DIR_SCANNED.is_set():
+        for path in limsutils.scan_task_directory(pt.directory):
+            try:
+                file_prefix_path, run_number, _ = qmo.PathTemplate.interpret_path(
+                    path
+                )
+            except ValueError:
+                continue
+
+            if file_prefix_path == prefix_path:
+                _register_run_number(prefix_path, run_number)
+
+    return mxcube.RUN_NUMBER_INDEX.get(prefix_path, 0) + 1
 
 
 def node_index(node):
@@ -112,19 +433,7 @@ def node_index(node):
             sample_model = node.get_parent().get_parent()
 
         sample = sample_model.loc_str
-        task_groups = sample_model.get_children()
-        tlist = []
-
-        for group in task_groups:
-            if group.interleave_num_images:
-                tlist.append(group)
-            else:
-                tlist.extend(group.get_children())
-
-        try:
-            index = tlist.index(node)
-        except Exception:
-            pass
+        index = _sample_task_index(sample_model).get(node._node_id)
 
     return {
         "sample": sample,
@@ -137,6 +446,8 @@ def node_index(node):
 def load_queue_from_dict(queue_dict):
     """
     Loads the queue in queue_dict in to the current blcontrol.beamline.queue_model (blcontrol.beamline.queue_model)
+    The samples and tasks are added item by item, as when added by the client,
+    in a single batch.
 
     :param dict queue_dict: Queue dictionary, on the same format as returned by
                             queue_to_dict
@@ -145,9 +456,41 @@ def load_queue_from_dict(queue_dict):
         item_list = []
 
         for sid in queue_dict["sample_order"]:
-            item_list.append(queue_dict[sid])
+            item_list.append(new_queue_item(queue_dict[sid]))
+
+        # Build the complete queue model before serializing it
+        if item_list:
+            with queue_batch_context():
+                _queue_add_items(item_list)
+
 
-        queue_add_item(item_list)
+def new_queue_item(item):
+    """
+    Copies a sample, or task, of another queue (for instance a stored queue)
+    to be added to the current queue. The queue ids of the sample and of its
+    tasks are not valid in the current queue and are removed, the copy is
+    mutable as the stored dictionaries may be shared (see NODE_DICT_CACHE).
+
+    :param dict item: Queue item, on the format returned by queue_to_dict
+    :returns: Copy of <item> without queueID and sampleQueueID
+    :rtype: dict
+    """
+    item = queue_view.to_dict(item)
+    _strip_queue_ids(item)
+
+    return item
+
+
+def _strip_queue_ids(value):
+    if isinstance(value, dict):
+        value.pop("queueID", None)
+        value.pop("sampleQueueID", None)
+
+        for item in value.values():
+            _strip_queue_ids(item)
+    elif isinstance(value, list):
+        for item in value:
+            _strip_queue_ids(item)
 
 
 def queue_to_dict(node=None, include_lims_data=False):
@@ -174,13 +517,21 @@ def queue_to_dict(node=None, include_lims_data=False):
              the TaskNode type (DataCollection, Chracterisation, Sample). The
              task dict can be directly used with the set_from_dict methods of
              the corresponding node.
+
+             The samples and tasks are the read-only views of the
+             serialization cache (see NODE_DICT_CACHE), use queue_view.to_dict
+             for a mutable copy and queue_view.dumps (or queue_to_json) to
+             encode them.
     """
     if not node:
         node = blcontrol.beamline.queue_model.get_model_root()
 
-    res = reduce(
-        lambda x, y: x.update(y) or x, queue_to_dict_rec(node, include_lims_data), {}
-    )
+    with node_state_pass():
+        res = reduce(
+            lambda x, y: x.update(y) or x,
+            queue_to_dict_rec(node, include_lims_data),
+            {},
+        )
 
     return res
 
@@ -210,14 +561,76 @@ def queue_to_json(node=None, include_lims_data=False):
              task dict can be directly used with the set_from_dict methods of
              the corresponding node.
     """
-    if not node:
-        node = blcontrol.beamline.queue_model.get_model_root()
+    return queue_view.dumps(queue_to_dict(node, include_lims_data))
 
-    res = reduce(
-        lambda x, y: x.update(y) or x, queue_to_dict_rec(node, include_lims_data), {}
-    )
 
-    return json.dumps(res, sort_keys=True, indent=4)
+@contextmanager
+def queue_batch_context():
+    """
+    Context manager for applying several queue mutations as one batch, the
+    samples affected by the batch are only serialized for the queue journal
+    once, when the outermost batch ends.
+    """
+    global QUEUE_BATCH_DEPTH
+    QUEUE_BATCH_DEPTH += 1
+
+    try:
+        yield
+    finally:
+        QUEUE_BATCH_DEPTH -= 1
+
+        if not QUEUE_BATCH_DEPTH:
+            queue_journal.flush()
+
+
+@contextmanager
+def node_state_pass():
+    """
+    Context manager for evaluating the state of several nodes, the current
+    entry and the execution state of the queue manager are only retrieved
+    once and the evaluated states are reused until the outermost pass ends.
+    """
+    global NODE_STATE_PASS
+
+    if NODE_STATE_PASS is not None:
+        yield
+        return
+
+    queue_manager = blcontrol.beamline.queue_manager
+
+    NODE_STATE_PASS = {
+        "current_entry": queue_manager.get_current_entry(),
+        "executing": queue_manager.is_executing(),
+        "states": {},
+    }
+
+    try:
+        yield
+    finally:
+        NODE_STATE_PASS = None
+
+
+def get_node_states(node):
+    """
+    Get the state of <node> and all its descendants in one pass
+
+    :param TaskNode node: Root of the nodes to get the states for
+
+    :returns: dictionary {node_id: (enabled, state)}, see get_node_state
+    """
+    states = {}
+
+    with node_state_pass():
+        _get_node_states_rec(node, states)
+
+    return states
+
+
+def _get_node_states_rec(node, states):
+    states[node._node_id] = get_node_state(node._node_id)
+
+    for child in node.get_children():
+        _get_node_states_rec(child, states)
 
 
 def get_node_state(node_id):
@@ -230,15 +643,34 @@ def get_node_state(node_id):
               where state: {0, 1, 2, 3} = {in_queue, running, success, failed}
               {'sample': sample, 'idx': index, 'queue_id': node_id}
     """
+    if NODE_STATE_PASS is not None:
+        node_state = NODE_STATE_PASS["states"].get(node_id)
+
+        if node_state is None:
+            node_state = _get_node_state(
+                node_id,
+                NODE_STATE_PASS["current_entry"],
+                NODE_STATE_PASS["executing"],
+            )
+            NODE_STATE_PASS["states"][node_id] = node_state
+    else:
+        queue_manager = blcontrol.beamline.queue_manager
+        node_state = _get_node_state(
+            node_id, queue_manager.get_current_entry(), queue_manager.is_executing()
+        )
+
+    return node_state
+
+
+def _get_node_state(node_id, curr_entry, executing):
     try:
         node, entry = get_entry(node_id)
     except BaseException:
         return (True, UNCOLLECTED)
 
     enabled = node.is_enabled()
-    curr_entry = blcontrol.beamline.queue_manager.get_current_entry()
 
-    running = blcontrol.beamline.queue_manager.is_executing and (
+    running = executing and (
         curr_entry == entry or curr_entry == entry._parent_container
     )
 
@@ -552,13 +984,19 @@ def _handle_interleaved(sample_node, node):
 
 
 def _handle_sample(node, include_lims_data=False):
+    with node_state_pass():
+        return _handle_sample_pass(node, include_lims_data)
+
+
+def _handle_sample_pass(node, include_lims_data):
     location = "Manual" if node.free_pin_mode else node.loc_str
-    enabled, state = get_node_state(node._node_id)
+    states = get_node_states(node)
+    enabled, state = states[node._node_id]
     children_states = []
 
     for child in node.get_children():
         for _c in child.get_children():
-            child_enabled, child_state = get_node_state(_c._node_id)
+            child_enabled, child_state = states[_c._node_id]
             children_states.append(child_state)
 
     if RUNNING in children_states:
@@ -614,36 +1052,51 @@ def queue_to_dict_rec(node, include_lims_data=False):
     else:
         node_list = node.get_children()
 
+    # The dictionary representations are built without LIMS data, so that
+    # they can be cached, the LIMS results are added on top of the cached
+    # representations when requested.
     for node in node_list:
         if isinstance(node, qmo.Sample):
             if len(result) == 0:
                 result = [{"sample_order": []}]
 
-            result.append(_handle_sample(node, include_lims_data))
+            sample = _get_node_dict(node, _handle_sample, node)
+
+            if include_lims_data:
+                sample = _sample_with_lims_data(sample)
+
+            result.append(sample)
 
             if node.is_enabled():
                 result[0]["sample_order"].append(node.loc_str)
 
+            continue
         elif isinstance(node, qmo.Characterisation):
             sample_node = node.get_parent().get_parent()
-            result.append(_handle_char(sample_node, node, include_lims_data))
+            task = _get_node_dict(node, _handle_char, sample_node, node)
         elif isinstance(node, qmo.DataCollection):
             sample_node = node_index(node)["sample_node"]
-            result.append(_handle_dc(sample_node, node, include_lims_data))
+            task = _get_node_dict(node, _handle_dc, sample_node, node)
         elif isinstance(node, qmo.Workflow):
             sample_node = node.get_parent().get_parent()
-            result.append(_handle_wf(sample_node, node, include_lims_data))
+            task = _get_node_dict(node, _handle_wf, sample_node, node, False)
         elif isinstance(node, qmo.XRFSpectrum):
             sample_node = node.get_parent().get_parent()
-            result.append(_handle_xrf(sample_node, node))
+            task = _get_node_dict(node, _handle_xrf, sample_node, node)
         elif isinstance(node, qmo.EnergyScan):
             sample_node = node.get_parent().get_parent()
-            result.append(_handle_energy_scan(sample_node, node))
+            task = _get_node_dict(node, _handle_energy_scan, sample_node, node)
         elif isinstance(node, qmo.TaskGroup) and node.interleave_num_images:
             sample_node = node.get_parent()
-            result.append(_handle_interleaved(sample_node, node))
+            task = _get_node_dict(node, _handle_interleaved, sample_node, node)
         else:
             result.extend(queue_to_dict_rec(node, include_lims_data))
+            continue
+
+        if include_lims_data:
+            task = _task_with_lims_data(task)
+
+        result.append(task)
 
     return result
 
@@ -672,15 +1125,35 @@ def get_entry(_id):
     :returns: The tuple model, entry
     :rtype: Tuple
     """
-    model = blcontrol.beamline.queue_model.get_node(int(_id))
-    entry = blcontrol.beamline.queue_manager.get_entry_with_model(model)
-    return model, entry
+    _id = int(_id)
+    model_entry = NODE_ENTRY_MAP.get(_id)
+
+    if model_entry is None:
+        model = blcontrol.beamline.queue_model.get_node(_id)
+        entry = blcontrol.beamline.queue_manager.get_entry_with_model(model)
+        model_entry = (model, entry)
+
+        # Entries are enqueued after their models are added, only keep
+        # complete lookups
+        if model is not None and entry is not None:
+            NODE_ENTRY_MAP[_id] = model_entry
+
+    return model_entry
+
+
+def _remove_node_entry_rec(node):
+    NODE_ENTRY_MAP.pop(node._node_id, None)
+
+    for child in node.get_children():
+        _remove_node_entry_rec(child)
 
 
 def set_enabled_entry(qid, enabled):
     model, entry = get_entry(qid)
     model.set_enabled(enabled)
     entry.set_enabled(enabled)
+    invalidate_node_dict(model)
+    queue_journal.record("enable", [model], enabled=enabled)
 
 
 def delete_entry(entry):
@@ -690,21 +1163,35 @@ def delete_entry(entry):
     parent_entry = entry.get_container()
     parent_entry.dequeue(entry)
     model = entry.get_data_model()
-    blcontrol.beamline.queue_model.del_child(model.get_parent(), model)
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+    sample_model = get_sample_node(model)
 
+    # The index of the remaining tasks of the sample changes
+    invalidate_sample_dict(model)
+    invalidate_node_index(model)
+    invalidate_node_dict(model, descendants=True)
+    _remove_node_entry_rec(model)
 
-def delete_entry_at(item_pos_list):
-    current_queue = queue_to_dict()
+    blcontrol.beamline.queue_model.del_child(model.get_parent(), model)
+
+    if sample_model is model:
+        queue_journal.record("delete", [model], [], [model.loc_str])
+    else:
+        queue_journal.record("delete", [model], [sample_model])
 
-    for (sid, tindex) in item_pos_list:
-        if tindex in ["undefined", None]:
-            node_id = current_queue[sid]["queueID"]
-            model, entry = get_entry(node_id)
-        else:
-            node_id = current_queue[sid]["tasks"][int(tindex)]["queueID"]
-            model, entry = get_entry(node_id)
 
+def delete_entry_at(item_pos_list):
+    # The positions refer to the queue before any of the items are deleted
+    node_ids = [
+        queue_index.get_sample_queue_id(sid)
+        if tindex in ["undefined", None]
+        else queue_index.get_sample_tasks(sid)[int(tindex)]
+        for (sid, tindex) in item_pos_list
+    ]
+
+    for node_id, (sid, tindex) in zip(node_ids, item_pos_list):
+        model, entry = get_entry(node_id)
+
+        if tindex not in ["undefined", None]:
             # Get the TaskGroup of the item, there is currently only one
             # task per TaskGroup so we have to remove the entire TaskGroup
             # with its task.
@@ -727,12 +1214,16 @@ def enable_entry(id_or_qentry, flag):
     """
     if isinstance(id_or_qentry, qe.BaseQueueEntry):
         id_or_qentry.set_enabled(flag)
-        id_or_qentry.get_data_model().set_enabled(flag)
+        model = id_or_qentry.get_data_model()
+        model.set_enabled(flag)
     else:
         model, entry = get_entry(id_or_qentry)
         entry.set_enabled(flag)
         model.set_enabled(flag)
 
+    invalidate_node_dict(model)
+    queue_journal.record("enable", [model], enabled=flag)
+
 
 def swap_task_entry(sid, ti1, ti2):
     """
@@ -743,9 +1234,7 @@ def swap_task_entry(sid, ti1, ti2):
     :param int ti1: Position of task1 (old position)
     :param int ti2: Position of task2 (new position)
     """
-    current_queue = queue_to_dict()
-
-    node_id = current_queue[sid]["queueID"]
+    node_id = queue_index.get_sample_queue_id(sid)
     smodel, sentry = get_entry(node_id)
 
     # Swap the order in the queue model
@@ -758,7 +1247,10 @@ def swap_task_entry(sid, ti1, ti2):
     sentry._queue_entry_list[ti2] = sentry._queue_entry_list[ti1]
     sentry._queue_entry_list[ti1] = ti2_temp_entry
 
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+    invalidate_sample_dict(smodel)
+    invalidate_node_index(smodel)
+
+    queue_journal.record("swap", [smodel], **{"from": ti1, "to": ti2})
 
 
 def move_task_entry(sid, ti1, ti2):
@@ -770,9 +1262,7 @@ def move_task_entry(sid, ti1, ti2):
     :param int ti1: Position of task1 (old position)
     :param int ti2: Position of task2 (new position)
     """
-    current_queue = queue_to_dict()
-
-    node_id = current_queue[sid]["queueID"]
+    node_id = queue_index.get_sample_queue_id(sid)
     smodel, sentry = get_entry(node_id)
 
     # Swap the order in the queue model
@@ -781,7 +1271,10 @@ def move_task_entry(sid, ti1, ti2):
     # Swap queue entry order
     sentry._queue_entry_list.insert(ti2, sentry._queue_entry_list.pop(ti1))
 
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+    invalidate_sample_dict(smodel)
+    invalidate_node_index(smodel)
+
+    queue_journal.record("move", [smodel], **{"from": ti1, "to": ti2})
 
 
 def set_sample_order(order):
@@ -803,9 +1296,9 @@ def set_sample_order(order):
         # Set queue entry order
         blcontrol.beamline.queue_manager._queue_entry_list = entry_list
 
-    limsutils.sample_list_set_order(order)
+        queue_journal.record("order", sampleOrder=sid_list)
 
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+    limsutils.sample_list_set_order(order)
 
 
 def queue_add_item(item_list):
@@ -825,41 +1318,247 @@ def queue_add_item(item_list):
 
     Each item (dictionary) describes either a sample or a task.
     """
+    with queue_batch_context():
+        _queue_add_items(item_list)
+
+    res = queue_to_dict()
+
+    return res
+
+
+def _queue_add_items(item_list):
+    """
+    Adds the queue items in item_list to the queue, see queue_add_item, without
+    returning the resulting queue.
+    """
     _queue_add_item_rec(item_list, None)
 
-    # Handling interleaved data collections, swap interleave task with
-    # the first of the data collections that are used as wedges, and then
-    # remove all collections that were used as wedges
-    for task in item_list[0]["tasks"]:
-        if task["type"] == "Interleaved" and task["parameters"].get(
-            "taskIndexList", False
-        ):
-            current_queue = queue_to_dict()
 
-            sid = task["sampleID"]
-            interleaved_tindex = len(current_queue[sid]["tasks"]) - 1
+def validate_queue_batch(operations):
+    """
+    Validates the list of operations <operations> passed to queue_batch
 
-            tindex_list = sorted(task["parameters"]["taskIndexList"])
+    :param list operations: List of operations
+    :raises ValueError: If one of the operations is invalid
+    """
+    if not isinstance(operations, list):
+        raise ValueError("Queue batch must be a list of operations")
 
-            # Swap first "wedge task" and the actual interleaved collection
-            # so that the interleaved task is the first task
-            swap_task_entry(sid, interleaved_tindex, tindex_list[0])
+    for idx, operation in enumerate(operations):
+        op = operation.get("op") if isinstance(operation, dict) else None
 
-            # We remove the swapped wedge index from the list, (now pointing
-            # at the interleaved collection) and add its new position
-            # (last task item) to the list.
-            tindex_list = tindex_list[1:]
-            tindex_list.append(interleaved_tindex)
+        if op not in QUEUE_BATCH_OPERATIONS:
+            raise ValueError("Unknown queue batch operation %s at %s" % (op, idx))
 
-            # The delete operation can be done all in one call if we make sure
-            # that we remove the items starting from the end (not altering
-            # previous indices)
-            for ti in reversed(tindex_list):
-                delete_entry_at([[sid, int(ti)]])
+        missing = [k for k in QUEUE_BATCH_OPERATIONS[op] if k not in operation]
 
-    res = queue_to_dict()
+        if missing:
+            msg = "Queue batch operation %s at %s is missing %s"
+            raise ValueError(msg % (op, idx, ", ".join(missing)))
 
-    return res
+
+def _queue_batch_operation(operation):
+    op = operation["op"]
+
+    if op == "add":
+        _queue_add_items(operation["items"])
+    elif op == "delete":
+        delete_entry_at(operation["items"])
+    elif op == "move":
+        move_task_entry(
+            operation["sampleID"], int(operation["from"]), int(operation["to"])
+        )
+    elif op == "swap":
+        swap_task_entry(
+            operation["sampleID"], int(operation["from"]), int(operation["to"])
+        )
+    elif op == "enable":
+        queue_enable_item(operation["qidList"], operation["enabled"])
+    elif op == "update":
+        queue_update_item(
+            operation["sampleQueueID"], operation["queueID"], operation["data"]
+        )
+    elif op == "order":
+        set_sample_order(operation["sampleOrder"])
+
+
+def queue_batch(operations):
+    """
+    Applies a list of queue mutations in one go. The operations are validated
+    before any of them is applied and the queue is only serialized (and
+    logged) once, after the last operation.
+
+    Each operation is a dictionary with the key "op" and the data needed for
+    that operation:
+
+    { "op": "add", "items": [item1, ... itemN] }, see queue_add_item
+    { "op": "delete", "items": [[sid, tindex], ...] }, see delete_entry_at
+    { "op": "move" | "swap", "sampleID": sid, "from": ti1, "to": ti2 }
+    { "op": "enable", "qidList": [qid1, ... qidN], "enabled": flag }
+    { "op": "update", "sampleQueueID": sqid, "queueID": tqid, "data": task }
+    { "op": "order", "sampleOrder": [sid1, ... sidN] }
+
+    :param list operations: List of operations
+    :returns: The resulting queue, on the format returned by queue_to_dict
+    :raises ValueError: If one of the operations is invalid or fails, the
+                        queue is then restored as it was before the batch,
+                        unexpected errors are re-raised after the restore
+    """
+    from . import queue_checkpoint
+
+    validate_queue_batch(operations)
+
+    # Restored if an operation fails, see queue_checkpoint.restore_state
+    state = queue_checkpoint.get_queue_state()
+    sample_list = queue_view.to_dict(mxcube.SAMPLE_LIST)
+    idx = 0
+
+    try:
+        with queue_batch_context():
+            for idx, operation in enumerate(operations):
+                _queue_batch_operation(operation)
+    except Exception as ex:
+        # The failing operation may have left nodes that are not invalidated
+        clear_node_dict_cache()
+        queue_checkpoint.restore_state(state, sample_list)
+
+        if not isinstance(ex, (LookupError, TypeError, ValueError)):
+            raise
+
+        msg = "Queue batch operation %s at %s failed (%s), nothing applied"
+        raise ValueError(msg % (operations[idx]["op"], idx, repr(ex)))
+
+    return queue_to_dict()
+
+
+def parse_queue_import(data, fmt):
+    """
+    Parses and validates the queue items of an import, see queue_import
+
+    :param str data: The items, one per line
+    :param str fmt: "ndjson" or "csv"
+    :returns: List of queue items
+    :raises ValueError: If an item is invalid, the line number is given
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(data))
+        unknown = set(reader.fieldnames or []) - set(QUEUE_IMPORT_CSV_COLUMNS)
+
+        if unknown:
+            raise ValueError("Unknown column(s): %s" % ", ".join(sorted(unknown)))
+
+        lines = []
+
+        # Empty cells are left out, so that the defaults apply
+        for row in reader:
+            item = dict((k, v) for k, v in row.items() if v not in ("", None))
+            item["type"] = "Sample"
+            lines.append((reader.line_num, item))
+    elif fmt == "ndjson":
+        lines = []
+
+        for line_num, line in enumerate(data.splitlines(), 1):
+            if line.strip():
+                try:
+                    lines.append((line_num, json.loads(line)))
+                except ValueError:
+                    raise ValueError("Line %s: invalid JSON" % line_num)
+    else:
+        raise ValueError("Unknown import format %s" % fmt)
+
+    root = blcontrol.beamline.queue_model.get_model_root()
+    sample_ids = set(sample.loc_str for sample in root.get_children())
+    items = []
+
+    for line_num, item in lines:
+        if not isinstance(item, dict):
+            raise ValueError("Line %s: item is not an object" % line_num)
+
+        if item.get("type") not in QUEUE_IMPORT_TYPES:
+            msg = "Line %s: unknown item type %s"
+            raise ValueError(msg % (line_num, item.get("type")))
+
+        if not item.get("sampleID"):
+            raise ValueError("Line %s: sampleID missing" % line_num)
+
+        if item["type"] == "Sample":
+            item.setdefault("location", item["sampleID"])
+            item.setdefault("sampleName", item["sampleID"])
+            item.setdefault("checked", True)
+            item.setdefault("tasks", [])
+            sample_ids.add(item["sampleID"])
+        elif item["sampleID"] not in sample_ids:
+            msg = "Line %s: sample %s is not in the queue"
+            raise ValueError(msg % (line_num, item["sampleID"]))
+        elif not isinstance(item.get("parameters"), dict):
+            raise ValueError("Line %s: parameters missing" % line_num)
+
+        items.append(item)
+
+    return items
+
+
+def queue_import(data, fmt="ndjson"):
+    """
+    Imports a large number of samples and tasks to the queue. The items are
+    validated before any of them is added, then added in chunks of
+    QUEUE_IMPORT_CHUNK_SIZE items, the progress is reported with the
+    "queue_import_progress" signal. The queue is only serialized once, when
+    all items are added.
+
+    With the format "ndjson", each line is a queue item as accepted by
+    queue_add_item. Tasks refer to their sample with sampleID, the sample
+    is either already in the queue or imported on a previous line.
+
+    With the format "csv", each row is a sample, see
+    QUEUE_IMPORT_CSV_COLUMNS for the accepted columns.
+
+    :param str data: The items, one per line
+    :param str fmt: "ndjson" or "csv"
+    :returns: The resulting queue, on the format returned by queue_to_dict
+    :raises ValueError: If an item is invalid, nothing is imported
+    """
+    items = parse_queue_import(data, fmt)
+
+    root = blcontrol.beamline.queue_model.get_model_root()
+    sample_ids = dict(
+        (sample.loc_str, sample._node_id) for sample in root.get_children()
+    )
+
+    with queue_batch_context():
+        for start in range(0, len(items), QUEUE_IMPORT_CHUNK_SIZE):
+            for item in items[start : start + QUEUE_IMPORT_CHUNK_SIZE]:
+                _queue_import_item(item, sample_ids)
+
+            progress = {
+                "done": min(start + QUEUE_IMPORT_CHUNK_SIZE, len(items)),
+                "total": len(items),
+            }
+
+            emit_bus.emit("queue_import_progress", progress, key="queue_import")
+
+            # Let the progress out and the other requests in
+            gevent.sleep(0)
+
+    return queue_to_dict()
+
+
+def _queue_import_item(item, sample_ids):
+    sid = item["sampleID"]
+
+    if item["type"] == "Sample":
+        if sid in sample_ids:
+            item["queueID"] = sample_ids[sid]
+        else:
+            item["queueID"] = sample_ids[sid] = add_sample(sid, item)
+
+            if sid not in mxcube.SAMPLE_LIST["sampleList"]:
+                limsutils.sample_list_update_sample(sid, item)
+
+        _queue_add_items([item])
+    else:
+        item.setdefault("sampleQueueID", sample_ids[sid])
+        _queue_add_item_rec([item])
 
 
 def _queue_add_item_rec(item_list, sample_node_id=None):
@@ -1057,8 +1756,11 @@ def set_dc_params(model, entry, task_data, sample_model):
     if not task_data.get("queueID", ""):
         acq.path_template.run_number = get_run_number(acq.path_template)
 
+    register_run_number(acq.path_template)
+
     model.set_enabled(task_data["checked"])
     entry.set_enabled(task_data["checked"])
+    invalidate_node_dict(model)
 
 
 def set_wf_params(model, entry, task_data, sample_model):
@@ -1120,6 +1822,7 @@ def set_wf_params(model, entry, task_data, sample_model):
 
     model.set_enabled(task_data["checked"])
     entry.set_enabled(task_data["checked"])
+    invalidate_node_dict(model)
 
 
 def set_char_params(model, entry, task_data, sample_model):
@@ -1149,6 +1852,7 @@ def set_char_params(model, entry, task_data, sample_model):
 
     model.set_enabled(task_data["checked"])
     entry.set_enabled(task_data["checked"])
+    invalidate_node_dict(model)
 
 
 def set_xrf_params(model, entry, task_data, sample_model):
@@ -1193,6 +1897,8 @@ def set_xrf_params(model, entry, task_data, sample_model):
     if not params.get("queueID", ""):
         model.path_template.run_number = get_run_number(model.path_template)
 
+    register_run_number(model.path_template)
+
     # Set count time, and if any, other paramters
     model.count_time = params.get("countTime", 0)
 
@@ -1201,6 +1907,7 @@ def set_xrf_params(model, entry, task_data, sample_model):
 
     model.set_enabled(task_data["checked"])
     entry.set_enabled(task_data["checked"])
+    invalidate_node_dict(model)
 
 
 def set_energy_scan_params(model, entry, task_data, sample_model):
@@ -1245,12 +1952,15 @@ def set_energy_scan_params(model, entry, task_data, sample_model):
     if not params.get("queueID", ""):
         model.path_template.run_number = get_run_number(model.path_template)
 
+    register_run_number(model.path_template)
+
     # Set element, and if any, other parameters
     model.element_symbol = params.get("element", "")
     model.edge = params.get("edge", "")
 
     model.set_enabled(task_data["checked"])
     entry.set_enabled(task_data["checked"])
+    invalidate_node_dict(model)
 
 
 def _create_dc(task):
@@ -1428,6 +2138,10 @@ def add_interleaved(node_id, task):
     """
     Adds a interleaved data collection task to the sample with id: <id>
 
+    The collections used as wedges, given by their task index in
+    task["parameters"]["taskIndexList"], are replaced by the interleaved
+    collection, which takes the position of the first of them.
+
     :param int id: id of the sample to which the task belongs
     :param dict task: task data
 
@@ -1436,6 +2150,19 @@ def add_interleaved(node_id, task):
     """
     sample_model, sample_entry = get_entry(node_id)
 
+    # Task groups of the collections used as wedges, resolved before the
+    # interleaved collection changes the task indices
+    task_ids = {idx: _id for _id, idx in _sample_task_index(sample_model).items()}
+    wedge_groups = []
+
+    for tindex in sorted(task["parameters"].get("taskIndexList", [])):
+        model = get_entry(task_ids[int(tindex)])[0]
+
+        if not isinstance(model, qmo.TaskGroup):
+            model = model.get_parent()
+
+        wedge_groups.append(model)
+
     group_model = qmo.TaskGroup()
     group_model.set_origin(ORIGIN_MX3)
     group_model.set_enabled(True)
@@ -1462,6 +2189,21 @@ def add_interleaved(node_id, task):
         blcontrol.beamline.queue_model.add_child(group_model, dc_model)
         group_entry.enqueue(dc_entry)
 
+    if wedge_groups:
+        # Move the interleaved collection (last) to the position of the
+        # first wedge and remove the wedges
+        position = sample_model.get_children().index(wedge_groups[0])
+        sample_model._children.insert(position, sample_model._children.pop())
+        sample_entry._queue_entry_list.insert(
+            position, sample_entry._queue_entry_list.pop()
+        )
+
+        invalidate_sample_dict(sample_model)
+        invalidate_node_index(sample_model)
+
+        for wedge_group in wedge_groups:
+            delete_entry(get_entry(wedge_group._node_id)[1])
+
     return group_model._node_id
 
 
@@ -1535,12 +2277,17 @@ def clear_queue():
     HWR.beamline.queue_model.clear_model("free-pin")
     HWR.beamline.queue_model.clear_model("plate")
     HWR.beamline.queue_model.select_model("ispyb")
+    clear_node_dict_cache()
+    NODE_INDEX.clear()
+    NODE_ENTRY_MAP.clear()
+    queue_journal.record("clear")
 
 
 def save_queue(session, redis=redis.Redis()):
     """
     Saves the current blcontrol.beamline.queue_model (blcontrol.beamline.queue_model) into a redis database.
-    The queue that is saved is the pickled result returned by queue_to_dict
+    A snapshot of the queue is written in the background, see queue_store, and
+    the changes are no longer logged.
 
     :param session: Session to save queue for
     :param redis: Redis database
@@ -1549,15 +2296,17 @@ def save_queue(session, redis=redis.Redis()):
     proposal_id = utils._proposal_id(session)
 
     if proposal_id is not None:
-        # List of samples dicts (containing tasks) sample and tasks have same
-        # order as the in queue HO
-        queue = queue_to_dict(blcontrol.beamline.queue_model.get_model_root())
-        redis.set("mxcube.queue:%d" % proposal_id, pickle.dumps(queue))
+        queue_store.close_log()
+        queue_store.save(proposal_id, redis)
 
 
 def load_queue(session, redis=redis.Redis()):
     """
-    Loads the queue belonging to session <session> into redis db <redis>
+    Loads the queue belonging to session <session> from redis db <redis>, the
+    changes made to the queue are then logged so that the queue can be
+    restored after a restart of the server. The stored queue is only loaded
+    if the queue is empty, it may already have been restored from the
+    application settings.
 
     :param session: Session for queue to load
     :param redis: Redis database
@@ -1565,9 +2314,10 @@ def load_queue(session, redis=redis.Redis()):
     proposal_id = utils._proposal_id(session)
 
     if proposal_id is not None:
-        serialized_queue = redis.get("mxcube.queue:%d" % proposal_id)
-        queue = pickle.loads(serialized_queue)
-        load_queue_from_dict(queue)
+        if not blcontrol.beamline.queue_model.get_model_root().get_children():
+            load_queue_from_dict(queue_store.load(proposal_id, redis))
+
+        queue_store.open_log(proposal_id, redis)
 
 
 def queue_model_child_added(parent, child):
@@ -1577,29 +2327,39 @@ def queue_model_child_added(parent, child):
     added. Handels for instance the addition of reference collections for
     characterisations and workflows.
     """
+    invalidate_node_dict(child)
+    invalidate_node_index(child)
+
     parent_model, parent_entry = get_entry(parent._node_id)
     child_model, child_entry = get_entry(child._node_id)
 
-    # Origin is ORIGIN_MX3 if task comes from MXCuBE-3
-    if child_model.get_origin() != ORIGIN_MX3:
-        if isinstance(child, qmo.DataCollection):
-            dc_entry = qe.DataCollectionQueueEntry(Mock(), child)
+    # The journal entries are captured once the entries of the new node
+    # are enqueued
+    with queue_batch_context():
+        # Origin is ORIGIN_MX3 if task comes from MXCuBE-3
+        if child_model.get_origin() != ORIGIN_MX3:
+            if isinstance(child, qmo.DataCollection):
+                dc_entry = qe.DataCollectionQueueEntry(Mock(), child)
+
+                enable_entry(dc_entry, True)
+                enable_entry(parent_entry, True)
+                parent_entry.enqueue(dc_entry)
+                sample = parent.get_parent()
 
-            enable_entry(dc_entry, True)
-            enable_entry(parent_entry, True)
-            parent_entry.enqueue(dc_entry)
-            sample = parent.get_parent()
+                task = _handle_dc(sample, child)
+                emit_bus.emit("add_task", {"tasks": [task]})
 
-            task = _handle_dc(sample, child)
-            socketio.emit("add_task", {"tasks": [task]}, namespace="/hwr")
+            elif isinstance(child, qmo.TaskGroup):
+                dcg_entry = qe.TaskGroupQueueEntry(Mock(), child)
+                enable_entry(dcg_entry, True)
+                parent_entry.enqueue(dcg_entry)
 
-        elif isinstance(child, qmo.TaskGroup):
-            dcg_entry = qe.TaskGroupQueueEntry(Mock(), child)
-            enable_entry(dcg_entry, True)
-            parent_entry.enqueue(dcg_entry)
+        queue_journal.record("add", [child])
 
 
 def queue_model_diff_plan_available(char, collection_list):
+    invalidate_node_dict(char)
+    queue_journal.record("update", [char])
     cols = []
     for collection in collection_list:
         if isinstance(collection, qmo.DataCollection):
@@ -1619,7 +2379,7 @@ def queue_model_diff_plan_available(char, collection_list):
             task.update({"isDiffractionPlan": True, "originID": origin_model._node_id})
             cols.append(task)
 
-    socketio.emit("add_diff_plan", {"tasks": cols}, namespace="/hwr")
+    emit_bus.emit("add_diff_plan", {"tasks": cols})
 
 
 def set_auto_add_diffplan(autoadd, current_sample=None):
@@ -1630,19 +2390,11 @@ def set_auto_add_diffplan(autoadd, current_sample=None):
     :param bool autoadd: True autoadd, False wait for user
     """
     mxcube.AUTO_ADD_DIFFPLAN = autoadd
-    current_queue = queue_to_dict()
+    mxcube.save_settings()
 
-    if "sample_order" in current_queue:
-        current_queue.pop("sample_order")
-
-    sampleIDs = list(current_queue.keys())
-    for sample in sampleIDs:
-        # this would be a sample
-        tasks = current_queue[sample]["tasks"]
-        for t in tasks:
-            if t["type"] == "Characterisation":
-                model, entry = get_entry(t["queueID"])
-                entry.auto_add_diff_plan = autoadd
+    for node_id in queue_index.query(type="Characterisation"):
+        model, entry = get_entry(node_id)
+        entry.auto_add_diff_plan = autoadd
 
 
 def execute_entry_with_id(sid, tindex=None):
@@ -1654,30 +2406,34 @@ def execute_entry_with_id(sid, tindex=None):
     """
     from . import scutils
 
-    current_queue = queue_to_dict()
     blcontrol.beamline.queue_manager.set_pause(False)
 
     if tindex in ["undefined", "None", "null", None]:
-        node_id = current_queue[sid]["queueID"]
+        node_id = queue_index.get_sample_queue_id(sid)
 
         # The queue does not run the mount defined by the sample entry if it has no
         # tasks, so in order function as expected; just mount the sample
         if (
-            not len(current_queue[sid]["tasks"])
+            not len(queue_index.get_sample_tasks(sid))
         ) and sid != scutils.get_current_sample().get("sampleID", ""):
+            model, entry = get_entry(node_id)
+            sample = _get_node_dict(model, _handle_sample, model)[sid]
 
             try:
-                scutils.mount_sample_clean_up(current_queue[sid])
+                scutils.mount_sample_clean_up(sample)
             except BaseException:
                 blcontrol.beamline.queue_manager.emit("queue_execution_failed", (None,))
             else:
                 blcontrol.beamline.queue_manager.emit("queue_stopped", (None,))
         else:
-            enabled_entries = []
-
-            for sampleID in current_queue["sample_order"]:
-                if current_queue[sampleID].get("checked", False):
-                    enabled_entries.append(sampleID)
+            # The model is walked, in queue order, since the enabled flag of
+            # the index is not updated by all the mutations
+            root = blcontrol.beamline.queue_model.get_model_root()
+            enabled_entries = [
+                sample.loc_str
+                for sample in root.get_children()
+                if isinstance(sample, qmo.Sample) and sample.is_enabled()
+            ]
 
             enabled_entries.pop(enabled_entries.index(sid))
             mxcube.TEMP_DISABLED = enabled_entries
@@ -1686,7 +2442,7 @@ def execute_entry_with_id(sid, tindex=None):
 
             blcontrol.beamline.queue_manager.execute()
     else:
-        node_id = current_queue[sid]["tasks"][int(tindex)]["queueID"]
+        node_id = queue_index.get_sample_tasks(sid)[int(tindex)]
 
         node, entry = get_entry(node_id)
         # in order to fill lims data, we execute first the parent (group_id missing)
@@ -1783,13 +2539,38 @@ def init_signals(queue):
         "energy_scan_finished", signals.energy_scan_finished
     )
 
+    init_default_params_signals()
 
-def enable_sample_entries(sample_id_list, flag):
-    current_queue = queue_to_dict()
 
+def init_default_params_signals():
+    """
+    Invalidates the cached default task parameters when the hardware objects
+    they depend on change, see DEFAULT_PARAMS_SIGNALS
+    """
+    for path, signal_names in DEFAULT_PARAMS_SIGNALS:
+        try:
+            ho = reduce(getattr, path.split("."), blcontrol.beamline)
+        except AttributeError:
+            ho = None
+
+        if ho is None:
+            msg = "[QUEUE] %s not available, default parameters not invalidated"
+            logging.getLogger("MX3.HWR").warning(msg, path)
+            continue
+
+        for signal_name in signal_names:
+            ho.connect(signal_name, invalidate_default_params)
+
+    # The default oscillation start is the current omega position
+    phi = blcontrol.beamline.diffractometer.getObjectByRole("phi")
+
+    if phi is not None:
+        phi.connect("valueChanged", invalidate_default_params)
+
+
+def enable_sample_entries(sample_id_list, flag):
     for sample_id in sample_id_list:
-        sample_data = current_queue[sample_id]
-        enable_entry(sample_data["queueID"], flag)
+        enable_entry(queue_index.get_sample_queue_id(sample_id), flag)
 
 
 def set_auto_mount_sample(automount, current_sample=None):
@@ -1800,6 +2581,7 @@ def set_auto_mount_sample(automount, current_sample=None):
     :param bool automount: True auto-mount, False wait for user
     """
     mxcube.AUTO_MOUNT_SAMPLE = automount
+    mxcube.save_settings()
 
 
 def get_auto_mount_sample():
@@ -1919,6 +2701,8 @@ def queue_stop():
             qe.get_data_model().set_executed(True)
             qe.get_data_model().set_enabled(False)
             qe._execution_failed = True
+            invalidate_node_dict(qe.get_data_model(), descendants=True)
+            queue_journal.record("state", [qe.get_data_model()])
 
             blcontrol.beamline.queue_manager._is_stopped = True
             signals.queue_execution_stopped()
@@ -1990,17 +2774,87 @@ def queue_update_item(sqid, tqid, data):
     elif data["type"] == "Characterisation":
         set_char_params(model, entry, data, sample_model)
 
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+    queue_journal.record("update", [model])
 
     return model
 
 
 def queue_enable_item(qid_list, enabled):
+    set_nodes_enabled(qid_list, enabled)
+
+
+def _set_model_enabled(model, enabled):
+    model.set_enabled(enabled)
+    entry = get_entry(model._node_id)[1]
+
+    if entry is not None:
+        entry.set_enabled(enabled)
+
+
+def _set_subtree_enabled(model, enabled):
+    _set_model_enabled(model, enabled)
+
+    for child in model.get_children():
+        # Enabling a sample does not re-arm its executed (collected, stopped
+        # or consumed) tasks, they can still be enabled explicitly
+        if enabled and child.is_executed():
+            continue
+
+        _set_subtree_enabled(child, enabled)
+
+
+def _propagate_enabled(model):
+    """
+    Updates the ancestors of <model>, a node is enabled if at least one of
+    its children is. Stops at the first ancestor that does not change.
+    """
+    parent = model.get_parent()
+
+    # The root node has no parent and is not part of the representation
+    while parent is not None and parent.get_parent() is not None:
+        enabled = any(child.is_enabled() for child in parent.get_children())
 
-    for qid in qid_list:
-        set_enabled_entry(qid, enabled)
+        if parent.is_enabled() == enabled:
+            break
 
-    logging.getLogger("MX3.HWR").info("[QUEUE] is:\n%s " % queue_to_json())
+        _set_model_enabled(parent, enabled)
+        parent = parent.get_parent()
+
+
+def set_nodes_enabled(node_ids, enabled):
+    """
+    Sets the enabled flag of the nodes with ids <node_ids> and of all their
+    descendants to <enabled>, executed descendants are not enabled. The
+    ancestors are enabled if one of their children is enabled and disabled
+    otherwise, so disabling the last task of a sample disables the sample
+    and enabling a task enables its sample.
+
+    :param list node_ids: Node ids, any combination of samples and tasks
+    :param bool enabled: True to enable, False to disable
+    """
+    models = [get_entry(node_id)[0] for node_id in node_ids]
+
+    with queue_batch_context():
+        for model in models:
+            _set_subtree_enabled(model, enabled)
+
+        for model in models:
+            _propagate_enabled(model)
+
+        samples = {}
+
+        for model in models:
+            sample = get_sample_node(model)
+
+            if sample is not None:
+                samples[sample._node_id] = sample
+
+        for sample in samples.values():
+            invalidate_node_dict(sample, descendants=True)
+
+        queue_journal.record(
+            "enable", models, list(samples.values()), enabled=enabled
+        )
 
 
 def update_sample(sid, params):
@@ -2022,76 +2876,16 @@ def update_sample(sid, params):
 
 
 def toggle_node(node_id):
-    node = blcontrol.beamline.queue_model.get_node(node_id)
-    entry = blcontrol.beamline.queue_manager.get_entry_with_model(node)
-    queue = queue_to_dict()
-
-    if isinstance(entry, qe.SampleQueueEntry):
-        # this is a sample entry, thus, go through its checked children and
-        # toggle those
-        if entry.is_enabled():
-            entry.set_enabled(False)
-            node.set_enabled(False)
-        else:
-            entry.set_enabled(True)
-            node.set_enabled(True)
-
-        new_state = entry.is_enabled()
-        for elem in queue[node_id]:
-            child_node = blcontrol.beamline.queue_model.get_node(elem["queueID"])
-            child_entry = blcontrol.beamline.queue_manager.get_entry_with_model(
-                child_node
-            )
-            if new_state:
-                child_entry.set_enabled(True)
-                child_node.set_enabled(True)
-            else:
-                child_entry.set_enabled(False)
-                child_node.set_enabled(False)
-
-    else:
-        # not a sample so find the parent and toggle directly
-        logging.getLogger("MX3.HWR").info(
-            "[QUEUE] toggling entry with id: %s" % node_id
-        )
-        # this is a TaskGroup, so it is not in the parsed queue
-        parent_node = node.get_parent()
-        # go a level up,
-        # this is a TaskGroup for a Char, a sampleQueueEntry if DataCol
-        parent_node = parent_node.get_parent()
-        if isinstance(parent_node, qmo.TaskGroup):
-            parent_node = parent_node.get_parent()
-        parent = parent_node._node_id
-        parent_entry = blcontrol.beamline.queue_manager.get_entry_with_model(
-            parent_node
-        )
-        # now that we know the sample parent no matter what is the entry
-        # (char, dc) check if the brother&sisters are enabled (and enable the
-        # parent)
-        checked = 0
-
-        for i in queue[parent]:
-            # at least one brother is enabled, no need to change parent
-            if i["queueID"] != node_id and i["checked"] == 1:
-                checked = 1
-                break
-        if entry.is_enabled():
-            entry.set_enabled(False)
-            node.set_enabled(False)
+    """
+    Toggles the enabled flag of the node with id <node_id>, see
+    set_nodes_enabled
 
-        else:
-            entry.set_enabled(True)
-            node.set_enabled(True)
+    :param int node_id: Node id of a sample or a task
+    """
+    model = get_entry(node_id)[0]
 
-        new_state = entry.is_enabled()
-        for met in queue[parent]:
-            if int(met.get("queueID")) == node_id:
-                if new_state == 0 and checked == 0:
-                    parent_entry.set_enabled(False)
-                    parent_node.set_enabled(False)
-                elif new_state == 1 and checked == 0:
-                    parent_entry.set_enabled(True)
-                    parent_node.set_enabled(True)
+    logging.getLogger("MX3.HWR").info("[QUEUE] toggling entry with id: %s" % node_id)
+    set_nodes_enabled([node_id], not model.is_enabled())
 
 
 def add_centring(_id, params):
@@ -2247,6 +3041,52 @@ def get_default_xrf_parameters():
     return {"countTime": int_time}
 
 
+def get_default_char_params():
+    """
+    returns the default values for a characterisation.
+    """
+    return (
+        blcontrol.beamline.characterisation.get_default_characterisation_parameters().as_dict()
+    )
+
+
+DEFAULT_PARAMS = {
+    "dc": get_default_dc_params,
+    "char_acq": get_default_char_acq_params,
+    "char": get_default_char_params,
+    "mesh": get_default_mesh_params,
+    "xrf": get_default_xrf_parameters,
+}
+
+
+def get_default_params(name):
+    """
+    Returns the default parameters of the task type <name>, the parameters
+    are only read from the hardware objects the first time or after a
+    change (see invalidate_default_params).
+
+    :param str name: One of dc, char_acq, char, mesh and xrf
+    :returns: The tuple (params, etag), where etag identifies the content
+              of params
+    :rtype: tuple
+    """
+    res = DEFAULT_PARAMS_CACHE.get(name)
+
+    if res is None:
+        params = DEFAULT_PARAMS[name]()
+        data = json.dumps(params, sort_keys=True).encode("utf-8")
+        res = DEFAULT_PARAMS_CACHE[name] = (params, hashlib.sha1(data).hexdigest())
+
+    return res
+
+
+def invalidate_default_params(*args, **kwargs):
+    """
+    Signal handler, drops the cached default parameters
+    """
+    DEFAULT_PARAMS_CACHE.clear()
+
+
 def get_sample(_id):
     sample = queue_to_dict().get(_id, None)
 
@@ -7,6 +7,8 @@ import logging
 import time
 import gevent
 
+from collections import deque
+
 # We are patching queue_entry.mount_sample at the end of this file.
 #import queue_entry
 
@@ -15,9 +17,24 @@ from mxcube3 import blcontrol
 
 from . import limsutils
 from . import qutils
+from . import signal_dispatch
 
 from queue_entry import QueueSkippEntryException, CENTRING_METHOD
 from HardwareRepository.HardwareObjects import queue_entry
+from HardwareRepository.HardwareObjects import queue_model_objects as qmo
+
+# Preparation of the sample changer for the next sample (see
+# prefetch_next_sample), the sample id and the greenlet doing it
+PREFETCH = {"sample": None, "task": None}
+
+# Dead time (s) between the end of the last task of a sample and the next
+# sample being loaded, for the last 100 samples, and the number of samples
+# for which the preparation was done before the mount started
+DEAD_TIMES = deque(maxlen=100)
+PREFETCH_HITS = 0
+
+# Time when the last task of the previous sample finished
+LAST_SAMPLE_FINISHED = None
 
 def init_signals():
     from mxcube3.routes import signals
@@ -29,7 +46,10 @@ def init_signals():
         "isCollisionSafe", signals.is_collision_safe
     )
     blcontrol.beamline.sample_changer.connect(
-        "loadedSampleChanged", signals.loaded_sample_changed
+        "loadedSampleChanged",
+        signal_dispatch.dispatcher(
+            signals.loaded_sample_changed, signal_dispatch.QUEUE
+        ),
     )
     blcontrol.beamline.sample_changer.connect(
         "contentsUpdated", signals.sc_contents_update
@@ -168,6 +188,7 @@ def sc_contents_from_location_get(loc):
 
 def set_current_sample(sample_id):
     mxcube.CURRENTLY_MOUNTED_SAMPLE = sample_id
+    mxcube.save_settings()
     msg = "[SC] Setting currenly mounted sample to %s" % sample_id
     logging.getLogger("MX3.HWR").info(msg)
 
@@ -192,15 +213,193 @@ def get_sample_info(location):
 
 def set_sample_to_be_mounted(loc):
     mxcube.SAMPLE_TO_BE_MOUNTED = loc
+    mxcube.save_settings()
 
 
 def get_sample_to_be_mounted():
     return mxcube.SAMPLE_TO_BE_MOUNTED
 
 
+def set_prefetch_next_sample(prefetch):
+    """
+    Sets the pipelined mount flag, prepare the sample changer for the next
+    sample while the last task of the current sample is executed (True)
+
+    :param bool prefetch: True to prepare the next sample
+    """
+    mxcube.PREFETCH_NEXT_SAMPLE = prefetch
+
+
+def get_prefetch_metrics():
+    """
+    :returns: dictionary on the form:
+              {
+                enabled: pipelined mount flag,
+                hits: number of samples prepared before their mount,
+                deadTimes: dead time (s) between the last samples,
+                meanDeadTime: mean dead time (s)
+              }
+    """
+    dead_times = list(DEAD_TIMES)
+
+    return {
+        "enabled": mxcube.PREFETCH_NEXT_SAMPLE,
+        "hits": PREFETCH_HITS,
+        "deadTimes": dead_times,
+        "meanDeadTime": sum(dead_times) / len(dead_times) if dead_times else None,
+    }
+
+
+def is_last_task(model):
+    """
+    :returns: True if <model> is the last enabled task of its sample
+    :rtype: bool
+    """
+    group = model.get_parent()
+
+    if not isinstance(group, qmo.TaskGroup):
+        return False
+
+    sample = group.get_parent()
+
+    if not isinstance(sample, qmo.Sample):
+        return False
+
+    # The disabled tasks and groups are not executed
+    tasks = [
+        task
+        for task_group in sample.get_children()
+        if task_group.is_enabled()
+        for task in task_group.get_children()
+        if task.is_enabled()
+    ]
+
+    return bool(tasks) and tasks[-1] is model
+
+
+def get_next_sample(sample_model):
+    """
+    :returns: The enabled sample following <sample_model> in the queue, None
+              if <sample_model> is the last one
+    """
+    samples = blcontrol.beamline.queue_model.get_model_root().get_children()
+
+    try:
+        index = samples.index(sample_model)
+    except ValueError:
+        return None
+
+    for sample in samples[index + 1 :]:
+        if sample.is_enabled():
+            return sample
+
+    return None
+
+
+def _simulates_prefetch(device):
+    """
+    :returns: True if the preparation of the sample changer is simulated for
+              <device>, a mockup sample changer without prefetch_sample
+    :rtype: bool
+    """
+    return (
+        device is blcontrol.beamline.sample_changer
+        and not hasattr(device, "prefetch_sample")
+        and "Mockup" in type(device).__name__
+    )
+
+
+def prefetch_next_sample(model):
+    """
+    Prepares the sample changer for the sample following the sample of the
+    task <model>, if <model> is the last task of its sample. Uses the
+    prefetch_sample method of the sample changer, or simulates the
+    preparation (SC_PREFETCH_SIMULATED_TIME) for the mockup sample changer.
+    The simulated preparation is otherwise part of each mockup mount when
+    prefetch is enabled, see queue_mount_sample.
+
+    :param TaskNode model: The task that was started
+    """
+    if not mxcube.PREFETCH_NEXT_SAMPLE or not is_last_task(model):
+        return
+
+    if blcontrol.beamline.diffractometer.in_plate_mode():
+        return
+
+    sample = get_next_sample(model.get_parent().get_parent())
+    sc = blcontrol.beamline.sample_changer
+
+    if sample is None or sample.free_pin_mode:
+        return
+
+    if hasattr(sc, "prefetch_sample"):
+        task = gevent.spawn(sc.prefetch_sample, sample.location)
+    elif _simulates_prefetch(sc):
+        simulated_time = mxcube.CONFIG.APP.SC_PREFETCH_SIMULATED_TIME
+        task = gevent.spawn(gevent.sleep, simulated_time)
+    else:
+        return
+
+    PREFETCH.update({"sample": sample.loc_str, "task": task})
+    logging.getLogger("MX3.HWR").info("[SC] Preparing next sample %s", sample.loc_str)
+
+
+def _wait_for_prefetch(data_model):
+    """
+    Waits for the preparation of the sample changer started by
+    prefetch_next_sample, if any
+
+    :returns: True if the sample changer was prepared for <data_model>
+    :rtype: bool
+    """
+    global PREFETCH_HITS
+
+    task, sample = PREFETCH["task"], PREFETCH["sample"]
+    PREFETCH.update({"sample": None, "task": None})
+
+    if task is None:
+        return False
+
+    prepared = sample == data_model.loc_str
+
+    if task.ready():
+        # Only a preparation done before the mount saved time
+        if prepared and task.successful():
+            PREFETCH_HITS += 1
+    elif prepared or not _simulates_prefetch(blcontrol.beamline.sample_changer):
+        # The sample changer is busy until the preparation is done
+        task.join()
+    else:
+        # The simulated preparation of another sample is simply dropped
+        task.kill(block=False)
+
+    return prepared and task.successful()
+
+
+def sample_finished(model):
+    """
+    Records the end of the task <model>, for measuring the dead time between
+    samples, see get_prefetch_metrics
+    """
+    global LAST_SAMPLE_FINISHED
+
+    if is_last_task(model):
+        LAST_SAMPLE_FINISHED = time.time()
+
+
+def _sample_loaded():
+    global LAST_SAMPLE_FINISHED
+
+    if LAST_SAMPLE_FINISHED is not None:
+        DEAD_TIMES.append(time.time() - LAST_SAMPLE_FINISHED)
+        LAST_SAMPLE_FINISHED = None
+
+
 def queue_mount_sample(view, data_model, centring_done_cb, async_result):
     from mxcube3.routes import signals
 
+    prepared = _wait_for_prefetch(data_model)
+
     blcontrol.beamline.sample_view.clear_all()
     logging.getLogger("user_level_log").info("Loading sample ...")
     log = logging.getLogger("user_level_log")
@@ -233,6 +432,15 @@ def queue_mount_sample(view, data_model, centring_done_cb, async_result):
     ):
         return
 
+    if (
+        mxcube.PREFETCH_NEXT_SAMPLE
+        and not prepared
+        and _simulates_prefetch(sample_mount_device)
+    ):
+        # With prefetch enabled, the simulated preparation is part of the
+        # mount unless it was done in advance, see prefetch_next_sample
+        gevent.sleep(mxcube.CONFIG.APP.SC_PREFETCH_SIMULATED_TIME)
+
     if hasattr(sample_mount_device, "__TYPE__"):
         if sample_mount_device.__TYPE__ in ["Marvin", "CATS"]:
             element = "%d:%02d" % loc
@@ -273,6 +481,7 @@ def queue_mount_sample(view, data_model, centring_done_cb, async_result):
         logging.getLogger("user_level_log").info("Sample not loaded")
         raise QueueSkippEntryException("Sample not loaded", "")
     else:
+        _sample_loaded()
         signals.loaded_sample_changed(sample_mount_device.get_loaded_sample())
         logging.getLogger("user_level_log").info("Sample loaded")
         dm = blcontrol.beamline.diffractometer
@@ -505,5 +714,181 @@ def get_initial_state():
     return initial_state
 
 
+def _sample_position(sample_model):
+    """
+    :returns: Tuple (cell, puck, position) of the sample <sample_model>, cell
+              is derived from the puck number with APP.SC_SCHEDULE_PUCKS_PER_CELL,
+              manually mounted samples get their own puck.
+    """
+    if sample_model.free_pin_mode:
+        return (None, sample_model.loc_str, 0)
+
+    puck, position = sample_model.location[0], sample_model.location[1]
+    pucks_per_cell = mxcube.CONFIG.APP.SC_SCHEDULE_PUCKS_PER_CELL
+
+    try:
+        cell = (int(puck) - 1) // pucks_per_cell if pucks_per_cell else None
+    except (TypeError, ValueError):
+        cell = None
+
+    return (cell, puck, position)
+
+
+def _exchange_time(from_pos, to_pos):
+    """
+    :returns: Predicted time (s) for exchanging the sample at <from_pos> with
+              the sample at <to_pos>, see _sample_position
+    """
+    cfg = mxcube.CONFIG.APP
+    t = cfg.SC_SCHEDULE_MOUNT_TIME
+
+    if from_pos is None or from_pos[1] != to_pos[1]:
+        t += cfg.SC_SCHEDULE_PUCK_SWITCH_TIME
+
+    if from_pos is not None and from_pos[0] != to_pos[0]:
+        t += cfg.SC_SCHEDULE_CELL_SWITCH_TIME
+
+    return t
+
+
+def sample_order_time(positions, start=None):
+    """
+    :param list positions: Sample positions in mount order, see _sample_position
+    :param tuple start: Position of the mounted sample, None if no sample is
+                        mounted
+    :returns: Predicted time (s) spent on mounting the samples
+    :rtype: float
+    """
+    total = 0
+
+    for pos in positions:
+        total += _exchange_time(start, pos)
+        start = pos
+
+    return total
+
+
+def _position_sort_key(value):
+    # Numbered cells/pucks first, in numerical order
+    return (0, value, "") if isinstance(value, int) else (1, 0, str(value))
+
+
+def _schedule_group(sids, positions, start):
+    """
+    Orders the samples <sids> so that the samples of a puck are mounted one
+    after the other and the pucks of a cell are used before moving to the
+    next cell, starting with the puck (or cell) of <start>.
+    """
+    pucks = {}
+
+    for sid in sids:
+        pos = positions[sid]
+        pucks.setdefault((pos[0], pos[1]), []).append(sid)
+
+    order = []
+
+    while pucks:
+        keys = sorted(
+            pucks.keys(),
+            key=lambda k: (_position_sort_key(k[0]), _position_sort_key(k[1])),
+        )
+
+        if start is not None and (start[0], start[1]) in pucks:
+            key = (start[0], start[1])
+        else:
+            same_cell = [k for k in keys if start is not None and k[0] == start[0]]
+            key = same_cell[0] if same_cell else keys[0]
+
+        puck = sorted(pucks.pop(key), key=lambda sid: positions[sid][2])
+        order.extend(puck)
+        start = positions[puck[-1]]
+
+    return order
+
+
+def schedule_samples(priorities=None, pinned=None):
+    """
+    Computes a mount order for the enabled samples in the queue that
+    minimises puck switches and cell (dewar) rotations of the sample changer.
+
+    Samples with a higher priority are mounted before samples with a lower
+    priority (default priority 0) and pinned samples are put at the given
+    position, the order of the other samples is optimised.
+
+    :param dict priorities: {sampleID: priority}
+    :param dict pinned: {sampleID: position in the enabled sample order}
+    :returns: dictionary on the form:
+              {
+                sampleOrder: [sampleID, ...] all samples of the queue, the
+                             disabled samples after the enabled ones,
+                currentTime: predicted mount time of the current order (s),
+                scheduledTime: predicted mount time of the new order (s),
+                saving: currentTime - scheduledTime
+              }
+    :raises ValueError: If a pinned position is invalid
+    """
+    priorities = priorities or {}
+    pinned = dict((sid, int(idx)) for sid, idx in (pinned or {}).items())
+
+    root = blcontrol.beamline.queue_model.get_model_root()
+    samples = [s for s in root.get_children() if s.is_enabled()]
+    disabled = [s.loc_str for s in root.get_children() if not s.is_enabled()]
+    positions = dict((s.loc_str, _sample_position(s)) for s in samples)
+    current_order = [s.loc_str for s in samples]
+
+    if set(pinned) - set(positions):
+        msg = "Pinned sample(s) not enabled in queue: %s"
+        raise ValueError(msg % ", ".join(sorted(set(pinned) - set(positions))))
+
+    if len(set(pinned.values())) != len(pinned) or not all(
+        0 <= idx < len(samples) for idx in pinned.values()
+    ):
+        raise ValueError("Invalid pinned position(s)")
+
+    mounted = [s for s in samples if s.loc_str == mxcube.CURRENTLY_MOUNTED_SAMPLE]
+    mounted_pos = _sample_position(mounted[0]) if mounted else None
+    start = mounted_pos
+    free = [sid for sid in current_order if sid not in pinned]
+    order = []
+
+    for priority in sorted(set(priorities.get(sid, 0) for sid in free), reverse=True):
+        group = [sid for sid in free if priorities.get(sid, 0) == priority]
+        group_order = _schedule_group(group, positions, start)
+        order.extend(group_order)
+        start = positions[group_order[-1]]
+
+    for sid, idx in sorted(pinned.items(), key=lambda item: item[1]):
+        order.insert(idx, sid)
+
+    current_time = sample_order_time(
+        [positions[sid] for sid in current_order], mounted_pos
+    )
+    scheduled_time = sample_order_time([positions[sid] for sid in order], mounted_pos)
+
+    return {
+        "sampleOrder": order + disabled,
+        "currentTime": current_time,
+        "scheduledTime": scheduled_time,
+        "saving": current_time - scheduled_time,
+    }
+
+
+def apply_sample_schedule(priorities=None, pinned=None):
+    """
+    Computes the mount order with schedule_samples and sets it as the sample
+    order of the queue, see qutils.set_sample_order
+
+    :returns: see schedule_samples
+    """
+    schedule = schedule_samples(priorities, pinned)
+    qutils.set_sample_order(schedule["sampleOrder"])
+
+    logging.getLogger("MX3.HWR").info(
+        "[SC] Sample order scheduled, predicted saving %.0f s", schedule["saving"]
+    )
+
+    return schedule
+
+
 # Important, patch queue_entry.mount_sample with the mount_sample defined above
 queue_entry.mount_sample = queue_mount_sample
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous dispatch of hardware object signals.
+
+Handlers that read hardware and emit messages to the clients (shapes, beam,
+loaded sample) are not called directly by the hardware object emitting the
+signal but through a dispatcher (see dispatcher), which puts the call in a
+bounded queue drained by worker greenlets, so that a slow handler or client
+never delays the hardware object.
+
+With the policy COALESCE, a call replaces the pending call of the same
+handler (and key), only the last call is made. With the policy QUEUE, all
+calls are made in order. When the queue is full (APP.SIGNAL_DISPATCH_SIZE
+calls) new calls are dropped.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+import gevent
+import gevent.event
+
+from mxcube3 import mxcube
+
+COALESCE = "coalesce"
+QUEUE = "queue"
+
+# Pending calls, {slot: (func, args, kwargs, time queued)}, where slot is
+# (func, key) for coalesced calls and a sequence number otherwise
+PENDING = OrderedDict()
+PENDING_READY = gevent.event.Event()
+SEQUENCE = itertools.count()
+
+WORKERS = []
+
+# Dispatcher of each handler and policy, (func, policy, key) -> dispatcher,
+# the dispatchers are referenced here since the hardware objects only keep
+# weak references to the signal handlers
+DISPATCHERS = {}
+
+MAX_DEPTH = 0
+
+# Counters per handler name, see get_metrics
+HANDLER_METRICS = {}
+
+
+def _handler_metrics(func):
+    name = "%s.%s" % (func.__module__, func.__name__)
+    metrics = HANDLER_METRICS.get(name)
+
+    if metrics is None:
+        metrics = HANDLER_METRICS[name] = {
+            "dispatched": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "executed": 0,
+            "errors": 0,
+            "totalLatency": 0,
+            "maxLatency": 0,
+            "totalRunTime": 0,
+        }
+
+    return metrics
+
+
+def _start_workers():
+    num_workers = mxcube.CONFIG.APP.SIGNAL_DISPATCH_WORKERS
+
+    for _ in range(num_workers - len([w for w in WORKERS if not w.dead])):
+        WORKERS.append(gevent.spawn(_worker))
+
+
+def _worker():
+    while True:
+        PENDING_READY.wait()
+
+        while PENDING:
+            _, (func, args, kwargs, t0) = PENDING.popitem(last=False)
+            _call(func, args, kwargs, t0)
+
+        PENDING_READY.clear()
+
+
+def _call(func, args, kwargs, t0):
+    metrics = _handler_metrics(func)
+    t1 = time.time()
+
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        metrics["errors"] += 1
+        logging.getLogger("MX3.HWR").exception(
+            "Error in signal handler %s", func.__name__
+        )
+
+    metrics["executed"] += 1
+    metrics["totalLatency"] += t1 - t0
+    metrics["maxLatency"] = max(metrics["maxLatency"], t1 - t0)
+    metrics["totalRunTime"] += time.time() - t1
+
+
+def dispatch(func, args=(), kwargs=None, policy=COALESCE, key=None):
+    """
+    Queues the call of <func> with <args> and <kwargs>
+
+    :param callable func: Handler
+    :param tuple args: Positional arguments
+    :param dict kwargs: Keyword arguments
+    :param str policy: COALESCE or QUEUE
+    :param callable key: Returns the key of a call, called with the
+                         arguments of the call, for the policy COALESCE.
+                         All calls have the same key if None
+    """
+    global MAX_DEPTH
+
+    kwargs = kwargs or {}
+    metrics = _handler_metrics(func)
+    metrics["dispatched"] += 1
+
+    if policy == COALESCE:
+        slot = (func, None if key is None else key(*args, **kwargs))
+
+        # The replacing call is made after the calls queued in between
+        if PENDING.pop(slot, None) is not None:
+            metrics["coalesced"] += 1
+    else:
+        slot = next(SEQUENCE)
+
+    if len(PENDING) >= mxcube.CONFIG.APP.SIGNAL_DISPATCH_SIZE:
+        metrics["dropped"] += 1
+        logging.getLogger("MX3.HWR").warning(
+            "Signal dispatch queue full, dropping call of %s", func.__name__
+        )
+        return
+
+    PENDING[slot] = (func, args, kwargs, time.time())
+    MAX_DEPTH = max(MAX_DEPTH, len(PENDING))
+
+    _start_workers()
+    PENDING_READY.set()
+
+
+def dispatcher(func, policy=COALESCE, key=None):
+    """
+    :param callable func: Handler
+    :param str policy: COALESCE or QUEUE, see dispatch
+    :param callable key: Key of a call for the policy COALESCE, see dispatch
+    :returns: A function queuing the call of <func> with its arguments, to
+              connect to a hardware object signal instead of <func>
+    :rtype: callable
+    """
+    res = DISPATCHERS.get((func, policy, key))
+
+    if res is None:
+
+        def res(*args, **kwargs):
+            # The signal and its sender are passed by the dispatcher of the
+            # hardware objects to handlers accepting keyword arguments
+            kwargs.pop("signal", None)
+            kwargs.pop("sender", None)
+            dispatch(func, args, kwargs, policy, key)
+
+        res.__name__ = func.__name__
+        DISPATCHERS[(func, policy, key)] = res
+
+    return res
+
+
+def get_metrics():
+    """
+    :returns: Dictionary on the form:
+              {
+                depth: number of pending calls,
+                maxDepth: largest number of pending calls,
+                capacity: APP.SIGNAL_DISPATCH_SIZE,
+                workers: number of worker greenlets,
+                handlers: {name: {dispatched, coalesced, dropped, executed,
+                                  errors, meanLatency (s), maxLatency (s),
+                                  meanRunTime (s)}}
+              }
+    :rtype: dict
+    """
+    handlers = {}
+
+    for name, metrics in HANDLER_METRICS.items():
+        executed = metrics["executed"]
+        handlers[name] = {
+            "dispatched": metrics["dispatched"],
+            "coalesced": metrics["coalesced"],
+            "dropped": metrics["dropped"],
+            "executed": executed,
+            "errors": metrics["errors"],
+            "meanLatency": metrics["totalLatency"] / executed if executed else 0,
+            "maxLatency": metrics["maxLatency"],
+            "meanRunTime": metrics["totalRunTime"] / executed if executed else 0,
+        }
+
+    return {
+        "depth": len(PENDING),
+        "maxDepth": MAX_DEPTH,
+        "capacity": mxcube.CONFIG.APP.SIGNAL_DISPATCH_SIZE,
+        "workers": len([w for w in WORKERS if not w.dead]),
+        "handlers": handlers,
+    }
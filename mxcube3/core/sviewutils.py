@@ -29,6 +29,16 @@ CLICK_COUNT = 0
 CLICK_LIMIT = 3
 CENTRING_POINT_ID = None
 
+# Shapes last sent to the clients, shape id -> camel cased dictionary, and
+# the version of the shapes, incremented when shapes are added, changed or
+# removed (see get_shapes_delta)
+SHAPES_SENT = {}
+SHAPES_VERSION = 0
+
+# Positions of the reference motors of each shape for which its screen
+# position was computed, shape id -> positions key (see _shape_positions_key)
+SHAPE_POSITIONS = {}
+
 
 def centring_clicks_left():
     global CLICK_COUNT, CLICK_LIMIT
@@ -133,6 +143,29 @@ def wait_for_centring_finishes(*args, **kwargs):
             blcontrol.beamline.diffractometer.accept_centring()
 
 
+def _send_motor_position(motor):
+    from mxcube3.routes import signals
+
+    movable = utils.get_movable_state_and_position(motor)
+
+    if movable:
+        signals.motor_position_callback(movable[motor])
+    else:
+        logging.getLogger("MX3.HWR").exception(
+            "Could not call position callback for %s" % motor
+        )
+
+
+# The position of each motor is sent at most 6 times per second (3 for the
+# lights), the last position is always sent
+send_motor_position = utils.Throttled(6, key=lambda motor: motor)(
+    _send_motor_position
+)
+send_light_position = utils.Throttled(3, key=lambda motor: motor)(
+    _send_motor_position
+)
+
+
 def init_signals():
     """
     Connect all the relevant hwobj signals with the corresponding
@@ -144,16 +177,8 @@ def init_signals():
 
     for motor in utils.get_centring_motors():
 
-        @utils.RateLimited(6)
         def pos_cb(pos, motor=motor, **kw):
-            movable = utils.get_movable_state_and_position(motor)
-
-            if movable:
-                signals.motor_position_callback(movable[motor])
-            else:
-                logging.getLogger("MX3.HWR").exception(
-                    "Could not call position callback for %s" % motor
-                )
+            send_motor_position(motor)
 
         def state_cb(state, motor=motor, **kw):
             movable = utils.get_movable_state_and_position(motor)
@@ -175,16 +200,8 @@ def init_signals():
 
     for actuator_name in ["FrontLight", "BackLight"]:
 
-        @utils.RateLimited(3)
         def light_pos_cb(pos, actuator_name=actuator_name, **kw):
-            movable = utils.get_movable_state_and_position(motor)
-
-            if movable:
-                signals.motor_position_callback(movable[motor])
-            else:
-                logging.getLogger("MX3.HWR").exception(
-                    "Could not call position callback for %s" % motor
-                )
+            send_light_position(actuator_name)
 
         def light_state_cb(state, actuator_name=actuator_name, **kw):
             movable = utils.get_movable_state_and_position(actuator_name)
@@ -298,6 +315,105 @@ def get_shapes():
     return {"shapes": to_camel(shape_dict)}
 
 
+def _shape_positions_key(shape, positions, ppm):
+    """
+    :returns: The current positions of the motors of the centred positions
+              of <shape> (its reference motors) and the pixels per mm, None
+              if they can not be compared
+    """
+    if positions is None:
+        return None
+
+    try:
+        motors = set()
+
+        for cpos in shape.get_centred_positions():
+            motors.update(cpos.as_dict())
+
+        return tuple((name, positions.get(name)) for name in sorted(motors)), ppm
+    except Exception:
+        # Positions that can not be compared, always recompute
+        return None
+
+
+def get_shapes_delta(update_positions=False):
+    """
+    Returns the shapes that changed since the last call
+
+    :param bool update_positions: Recompute the screen position of the
+                                  shapes, only done for the shapes whose
+                                  position was computed for other positions
+                                  of their reference motors. Only these
+                                  shapes (and new shapes) are then
+                                  compared.
+    :returns: Dictionary on the form:
+              {
+                version: version of the shapes,
+                shapes: {id: shape} added or changed shapes,
+                removed: [id, ...] removed shapes
+              }
+    :rtype: dict
+    """
+    global SHAPES_VERSION
+
+    dm = blcontrol.beamline.diffractometer
+    shapes, shape_ids = {}, set()
+
+    if update_positions:
+        try:
+            positions = dm.get_positions()
+            ppm = tuple(dm.get_pixels_per_mm())
+        except Exception:
+            positions, ppm = None, None
+
+    for shape in blcontrol.beamline.sample_view.get_shapes():
+        shape_ids.add(shape.id)
+
+        if update_positions:
+            key = _shape_positions_key(shape, positions, ppm)
+
+            if key is not None and SHAPE_POSITIONS.get(shape.id) == key:
+                if shape.id in SHAPES_SENT:
+                    continue
+            else:
+                shape.update_position(dm.motor_positions_to_screen)
+                SHAPE_POSITIONS[shape.id] = key
+
+        s = to_camel(shape.as_dict())
+
+        if SHAPES_SENT.get(shape.id) != s:
+            SHAPES_SENT[shape.id] = shapes[shape.id] = s
+
+    removed = [sid for sid in SHAPES_SENT if sid not in shape_ids]
+
+    for sid in removed:
+        del SHAPES_SENT[sid]
+        SHAPE_POSITIONS.pop(sid, None)
+
+    if shapes or removed:
+        SHAPES_VERSION += 1
+
+    return {"version": SHAPES_VERSION, "shapes": shapes, "removed": removed}
+
+
+def get_shapes_sent():
+    """
+    :returns: The shapes last sent to the clients, on the format of
+              get_shapes, for a client that just connected
+    :rtype: dict
+    """
+    return {"shapes": dict(SHAPES_SENT)}
+
+
+def reset_shapes_sent():
+    """
+    Forgets the shapes sent to the clients, all shapes are sent with the next
+    delta, for instance when the clients cleared their shapes
+    """
+    SHAPES_SENT.clear()
+    SHAPE_POSITIONS.clear()
+
+
 def get_shape_width_sid(sid):
     shape = blcontrol.beamline.sample_view.get_shape(sid)
 
@@ -567,4 +683,5 @@ def set_centring_method(method):
         msg = "Using click centring when mounting samples"
         mxcube.CENTRING_METHOD = CENTRING_METHOD.MANUAL
 
+    mxcube.save_settings()
     logging.getLogger("user_level_log").info(msg)
@@ -4,6 +4,7 @@ from __future__ import division
 from __future__ import print_function
 
 import re
+import functools
 import logging
 import time
 import gevent
@@ -49,6 +50,89 @@ def RateLimited(maxPerSecond):
     return decorate
 
 
+def Throttled(maxPerSecond, key=None):
+    """
+    Decorator limiting the calls of the decorated function to <maxPerSecond>
+    per key. The first call of a key is made directly, the calls made during
+    the following interval are not, but the last of them is made (with its
+    arguments) when the interval has elapsed, so that the last value is
+    always delivered. The state of a key is dropped when an interval elapses
+    without calls.
+
+    The decorated function has the methods flush(key), making the pending
+    call of <key> directly, and cancel(key), dropping it.
+
+    :param float maxPerSecond: Maximum number of calls per second and key
+    :param callable key: Returns the key of a call, called with the arguments
+                         of the call. All calls have the same key if None
+    """
+    minInterval = 1.0 / float(maxPerSecond)
+
+    def decorate(func):
+        # Keys with an interval running, key -> {"pending": (args, kwargs) of
+        # the pending call or None, "timer": greenlet ending the interval}
+        calls = {}
+
+        def _call(args, kwargs):
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logging.getLogger("MX3.HWR").exception(
+                    "Error in throttled call of %s", func.__name__
+                )
+
+        def _interval_elapsed(k):
+            call = calls[k]
+
+            if call["pending"] is None:
+                del calls[k]
+                return
+
+            # The pending call starts a new interval
+            args, kwargs = call["pending"]
+            call["pending"] = None
+            call["timer"] = gevent.spawn_later(minInterval, _interval_elapsed, k)
+            _call(args, kwargs)
+
+        def flush(k=None):
+            call = calls.pop(k, None)
+
+            if call is not None:
+                call["timer"].kill(block=False)
+
+                if call["pending"] is not None:
+                    _call(*call["pending"])
+
+        def cancel(k=None):
+            call = calls.get(k)
+
+            if call is not None:
+                call["pending"] = None
+
+        @functools.wraps(func)
+        def throttledFunction(*args, **kwargs):
+            k = None if key is None else key(*args, **kwargs)
+            call = calls.get(k)
+
+            if call is not None:
+                call["pending"] = (args, kwargs)
+                return
+
+            calls[k] = {
+                "pending": None,
+                "timer": gevent.spawn_later(minInterval, _interval_elapsed, k),
+            }
+
+            return func(*args, **kwargs)
+
+        throttledFunction.flush = flush
+        throttledFunction.cancel = cancel
+
+        return throttledFunction
+
+    return decorate
+
+
 def _proposal_id(session):
     try:
         return int(session["loginInfo"]["loginRes"]["Proposal"]["number"])
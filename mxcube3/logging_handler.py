@@ -6,6 +6,7 @@ import logging
 import traceback
 from mxcube3 import socketio
 from mxcube3 import server
+from mxcube3.core import emit_bus
 
 
 @socketio.on("connect", namespace="/logging")
@@ -42,6 +43,6 @@ class MX3LoggingHandler(logging.handlers.BufferingHandler):
         if record.name != "geventwebsocket.handler":
             record_dict = self._record_to_json(record)
             super().emit(record_dict)
-            socketio.emit("log_record", record_dict, namespace="/logging")
+            emit_bus.emit("log_record", record_dict, namespace="/logging")
         else:
             super().emit(record)
@@ -2,7 +2,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from flask import jsonify
+
+from mxcube3 import mxcube
 from mxcube3 import server
+from mxcube3.core import emit_bus
+from mxcube3.core import signal_dispatch
 
 import logging
 
@@ -23,3 +28,35 @@ def serve_static_file():
 def unrestricted_serve_static_file():
     logging.getLogger("HWR").info("[Main] Serving main page")
     return server.send_static_file("index.html")
+
+
+@server.route("/mxcube/api/v0.1/emit_metrics", methods=["GET"])
+@server.restrict
+def get_emit_metrics():
+    """
+    Number of Socket.IO messages emitted, coalesced and sent, and the number
+    of frames sent, see emit_bus.get_metrics
+    """
+    return jsonify(emit_bus.get_metrics())
+
+
+@server.route("/mxcube/api/v0.1/signal_dispatch_metrics", methods=["GET"])
+@server.restrict
+def get_signal_dispatch_metrics():
+    """
+    Depth of the signal dispatch queue and the number of dispatched,
+    coalesced and dropped calls and the latency of each handler, see
+    signal_dispatch.get_metrics
+    """
+    return jsonify(signal_dispatch.get_metrics())
+
+
+@server.route("/mxcube/api/v0.1/settings_metrics", methods=["GET"])
+@server.restrict
+def get_settings_metrics():
+    """
+    Size (bytes) of the application settings and the time (s) spent reading,
+    decoding and restoring the queue when they were last restored, see
+    mxcube.load_settings
+    """
+    return jsonify(mxcube.SETTINGS_RESTORE_METRICS)
@@ -12,6 +12,10 @@ from mxcube3 import socketio
 
 from mxcube3.core import qutils
 from mxcube3.core import limsutils
+from mxcube3.core import scutils
+from mxcube3.core import queue_dryrun
+from mxcube3.core import queue_checkpoint
+from mxcube3.core import emit_bus
 
 
 @server.route("/mxcube/api/v0.1/queue/start", methods=["PUT"])
@@ -120,7 +124,10 @@ def queue_get():
               200: On success
               409: On error, could not retrieve queue
     """
-    resp = jsonify(qutils.queue_to_dict(include_lims_data=True))
+    # Encoded straight from the views of the serialization cache
+    resp = Response(
+        qutils.queue_to_json(include_lims_data=True), mimetype="application/json"
+    )
     resp.status_code = 200
     return resp
 
@@ -142,6 +149,74 @@ def queue_get_state():
     return resp
 
 
+@server.route("/mxcube/api/v0.1/queue/journal", methods=["GET"])
+@server.restrict
+def queue_get_journal():
+    """
+    Get the queue journal entries after the position given by the query
+    parameter since (0 by default)
+
+    :returns: Response object response Content-Type: application/json, json
+              object {"position": last position, "entries": [...]}, see
+              queue_journal.get_entries. The status code is set to:
+
+              200: On success
+    """
+    since = request.args.get("since", 0, type=int)
+
+    resp = jsonify(
+        {
+            "position": qutils.queue_journal.get_position(),
+            "entries": qutils.queue_journal.get_entries(since),
+        }
+    )
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/delta", methods=["GET"])
+@server.restrict
+def queue_get_delta():
+    """
+    Get the changes to the queue since the version given by the query
+    parameter since (0 by default), same format as the queue_delta signal.
+
+    :returns: Response object response Content-Type: application/json, json
+              object {"version": v, "since": since, "patches": [...]}, see
+              queue_journal.get_delta. The status code is set to:
+
+              200: On success
+    """
+    since = request.args.get("since", 0, type=int)
+
+    resp = jsonify(qutils.queue_journal.get_delta(since))
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/journal/<int:position>", methods=["GET"])
+@server.restrict
+def queue_get_journal_position(position):
+    """
+    Get the queue as it was at the given journal position
+
+    :returns: Response object response Content-Type: application/json, json
+              object containing the queue on the format returned by
+              queue_to_dict. The status code is set to:
+
+              200: On success
+              409: On error, position not available in the journal
+    """
+    try:
+        queue = qutils.queue_journal.reconstruct(position)
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = jsonify(queue)
+    resp.status_code = 200
+    return resp
+
+
 @server.route("/mxcube/api/v0.1/queue/<sid>/<tindex>/execute", methods=["PUT"])
 @server.require_control
 @server.restrict
@@ -190,6 +265,76 @@ def queue_add_item():
     return resp
 
 
+@server.route("/mxcube/api/v0.1/queue/import", methods=["POST"])
+@server.require_control
+@server.restrict
+def queue_import():
+    """
+    Import samples and tasks, one item per line. The format is given by the
+    Content-Type, text/csv for CSV and NDJSON (application/x-ndjson)
+    otherwise, see qutils.queue_import.
+
+    :returns: Response object, Content-Type: application/json, with the
+              resulting sample order and sample list. The status code is set to:
+
+              200: On success
+              409: On error, invalid item(s), nothing imported
+    """
+    fmt = "csv" if request.mimetype == "text/csv" else "ndjson"
+
+    try:
+        queue = qutils.queue_import(request.get_data(as_text=True), fmt)
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    sample_list = limsutils.sample_list_get(current_queue=queue)
+
+    resp = jsonify(
+        {
+            "sampleOrder": queue.get("sample_order", []),
+            "sampleList": sample_list.get("sampleList", {}),
+        }
+    )
+    resp.status_code = 200
+
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/batch", methods=["POST"])
+@server.require_control
+@server.restrict
+def queue_batch():
+    """
+    Apply a list of queue operations (add, delete, move, swap, enable, update
+    and order) in one go, see qutils.queue_batch for the format of the
+    operations.
+
+    :returns: Response object, Content-Type: application/json, with the
+              resulting sample order and sample list. The status code is set to:
+
+              200: On success
+              409: On error, invalid operation(s), nothing applied
+    """
+    try:
+        queue = qutils.queue_batch(request.get_json())
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    sample_list = limsutils.sample_list_get(current_queue=queue)
+
+    res = {
+        "sampleOrder": queue.get("sample_order", []),
+        "sampleList": sample_list.get("sampleList", {}),
+    }
+
+    emit_bus.emit("queue_batch_applied", res)
+
+    resp = jsonify(res)
+    resp.status_code = 200
+
+    return resp
+
+
 @server.route("/mxcube/api/v0.1/queue/<sqid>/<tqid>", methods=["POST"])
 @server.require_control
 @server.restrict
@@ -198,7 +343,7 @@ def queue_update_item(sqid, tqid):
 
     model = qutils.queue_update_item(sqid, tqid, data)
 
-    resp = jsonify(qutils.queue_to_dict([model]))
+    resp = Response(qutils.queue_to_json([model]), mimetype="application/json")
     resp.status_code = 200
 
     return resp
@@ -219,9 +364,28 @@ def queue_delete_item():
 @server.require_control
 @server.restrict
 def queue_enable_item():
+    """
+    Enables or disables a set of nodes with their descendants, the nodes are
+    given by any combination of "qidList" (node ids), "sampleIDs" and "puck"
+    (all samples of a puck).
+
+    :returns: Response object, status code set to:
+              200: On success
+              409: On error, unknown sample
+    """
     params = request.get_json()
-    qid_list = params.get("qidList", None)
+    qid_list = list(params.get("qidList", None) or [])
     enabled = params.get("enabled", False)
+
+    try:
+        for sid in params.get("sampleIDs", []):
+            qid_list.append(qutils.queue_index.get_sample_queue_id(sid))
+    except KeyError as ex:
+        return Response("Unknown sample %s" % ex, status=409)
+
+    if params.get("puck") is not None:
+        qid_list.extend(qutils.queue_index.get_puck_sample_queue_ids(params["puck"]))
+
     qutils.queue_enable_item(qid_list, enabled)
 
     return Response(status=200)
@@ -251,6 +415,191 @@ def queue_set_sample_order():
     return Response(status=200)
 
 
+@server.route("/mxcube/api/v0.1/queue/schedule", methods=["POST"])
+@server.require_control
+@server.restrict
+def queue_schedule_samples():
+    """
+    Computes a sample order that minimises the sample changer travel, and
+    applies it if "apply" is true. Accepts the optional "priorities"
+    {sampleID: priority} and "pinned" {sampleID: position}, see
+    scutils.schedule_samples
+
+    :returns: Response object, Content-Type: application/json, with the
+              scheduled sample order and the predicted time saving. The
+              status code is set to:
+
+              200: On success
+              409: On error, invalid pinned positions
+    """
+    params = request.get_json() or {}
+
+    if params.get("apply", False):
+        schedule_func = scutils.apply_sample_schedule
+    else:
+        schedule_func = scutils.schedule_samples
+
+    try:
+        schedule = schedule_func(params.get("priorities"), params.get("pinned"))
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = jsonify(schedule)
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/query", methods=["GET"])
+@server.restrict
+def queue_query():
+    """
+    Looks up the queue nodes matching the query parameters, any of "type"
+    (Sample, DataCollection, Characterisation, ...), "state", "checked",
+    "prefix", "protein" and "sampleID", see queue_index.query
+
+    :returns: Response object, Content-Type: application/json, on the form
+              {"nodes": [{queueID, sampleID, type, state, checked, prefix,
+              protein}, ...]}. The status code is set to:
+
+              200: On success
+              409: On error, unknown query parameter
+    """
+    criteria = request.args.to_dict()
+
+    if "state" in criteria:
+        criteria["state"] = request.args.get("state", type=int)
+
+    if "checked" in criteria:
+        criteria["checked"] = criteria["checked"].lower() in ("1", "true")
+
+    try:
+        node_ids = qutils.queue_index.query(**criteria)
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = jsonify({"nodes": qutils.queue_index.get_nodes(node_ids)})
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/dry_run", methods=["POST"])
+@server.restrict
+def queue_dry_run():
+    """
+    Predicts the execution time of the queue without executing it, and
+    measures the server side overhead of the execution. Accepts the optional
+    "timeModel" overriding the configured time model and "sampleIDs", the
+    samples to run, see queue_dryrun.dry_run
+
+    :returns: Response object, Content-Type: application/json, with the
+              per-sample timeline and the server overhead. The status code
+              is set to:
+
+              200: On success
+              409: On error, invalid time model
+    """
+    params = request.get_json() or {}
+
+    try:
+        report = queue_dryrun.dry_run(params.get("timeModel"), params.get("sampleIDs"))
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = jsonify(report)
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/checkpoint", methods=["GET"])
+@server.restrict
+def queue_get_checkpoints():
+    """
+    Get the queue checkpoints of this session
+
+    :returns: Response object, Content-Type: application/json, on the form
+              {"checkpoints": [{name, timestamp, version, samples}, ...]}.
+              The status code is set to:
+
+              200: On success
+    """
+    resp = jsonify({"checkpoints": queue_checkpoint.get_checkpoints()})
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/checkpoint", methods=["POST"])
+@server.require_control
+@server.restrict
+def queue_create_checkpoint():
+    """
+    Creates a named checkpoint of the queue and the sample list. Accepts
+    "name" and the optional "persist", to also store the checkpoint with the
+    queue of the proposal, see queue_checkpoint.create
+
+    :returns: Response object, Content-Type: application/json, the created
+              checkpoint {name, timestamp, version, samples}. The status code
+              is set to:
+
+              200: On success
+              409: On error, name missing or checkpoint could not be stored
+    """
+    params = request.get_json() or {}
+
+    try:
+        info = queue_checkpoint.create(params.get("name"), params.get("persist"))
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = jsonify(info)
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/checkpoint/<name>/restore", methods=["POST"])
+@server.require_control
+@server.restrict
+def queue_restore_checkpoint(name):
+    """
+    Restores the queue and the sample list of the checkpoint <name>, see
+    queue_checkpoint.restore
+
+    :returns: Response object, Content-Type: application/json, the restored
+              queue on the format returned by queue_to_dict. The status code
+              is set to:
+
+              200: On success
+              409: On error, unknown checkpoint or queue running
+    """
+    try:
+        queue_checkpoint.restore(name)
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    resp = Response(qutils.queue_to_json(), mimetype="application/json")
+    resp.status_code = 200
+    return resp
+
+
+@server.route("/mxcube/api/v0.1/queue/checkpoint/<name>", methods=["DELETE"])
+@server.require_control
+@server.restrict
+def queue_delete_checkpoint(name):
+    """
+    Deletes the checkpoint <name>
+
+    :returns: Response object, the status code is set to:
+
+              200: On success
+              409: On error, unknown checkpoint
+    """
+    try:
+        queue_checkpoint.delete(name)
+    except ValueError as ex:
+        return Response(str(ex), status=409)
+
+    return Response(status=200)
+
+
 @server.route("/mxcube/api/v0.1/queue/<sample_id>", methods=["PUT"])
 @server.require_control
 @server.restrict
@@ -292,16 +641,36 @@ def toggle_node(node_id):
     return Response(status=200)
 
 
+def _default_params_response(name):
+    """
+    :returns: Response object with the default parameters <name> (see
+              qutils.get_default_params) and their ETag, or an empty response
+              with status code 304 if the client already has them
+              (If-None-Match)
+    """
+    params, etag = qutils.get_default_params(name)
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(params)
+        resp.status_code = 200
+
+    # Let the client revalidate each time, the parameters change with the
+    # beamline
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+
+    return resp
+
+
 @server.route("/mxcube/api/v0.1/queue/dc", methods=["GET"])
 @server.restrict
 def get_default_dc_params():
     """
     returns the default values for an acquisition (data collection).
     """
-    resp = jsonify(qutils.get_default_dc_params())
-
-    resp.status_code = 200
-    return resp
+    return _default_params_response("dc")
 
 
 @server.route("/mxcube/api/v0.1/queue/char_acq", methods=["GET"])
@@ -311,10 +680,7 @@ def get_default_char_acq_params():
     returns the default values for a characterisation acquisition.
     TODO: implement as_dict in the qmo.AcquisitionParameters
     """
-    resp = jsonify(qutils.get_default_char_acq_params())
-
-    resp.status_code = 200
-    return resp
+    return _default_params_response("char_acq")
 
 
 @server.route("/mxcube/api/v0.1/queue/char", methods=["GET"])
@@ -323,12 +689,7 @@ def get_default_char_params():
     """
     returns the default values for a characterisation.
     """
-    p = (
-        blcontrol.beamline.characterisation.get_default_characterisation_parameters().as_dict()
-    )
-    resp = jsonify(p)
-    resp.status_code = 200
-    return resp
+    return _default_params_response("char")
 
 
 @server.route("/mxcube/api/v0.1/queue/mesh", methods=["GET"])
@@ -337,9 +698,7 @@ def get_default_mesh_params():
     """
     returns the default values for a mesh.
     """
-    resp = jsonify(qutils.get_default_mesh_params())
-    resp.status_code = 200
-    return resp
+    return _default_params_response("mesh")
 
 
 @server.route("/mxcube/api/v0.1/queue/xrf", methods=["GET"])
@@ -348,9 +707,7 @@ def get_default_xrf_parameters():
     """
     returns the default values for a xrf scan
     """
-    resp = jsonify(qutils.get_default_xrf_parameters())
-    resp.status_code = 200
-    return resp
+    return _default_params_response("xrf")
 
 
 @server.route("/mxcube/api/v0.1/queue/automount", methods=["POST"])
@@ -371,6 +728,7 @@ def set_autmount():
 def set_num_snapshots():
     data = request.get_json()
     mxcube.NUM_SNAPSHOTS = data.get("numSnapshots", 4)
+    mxcube.save_settings()
     resp = jsonify({"numSnapshots": data.get("numSnapshots", 4)})
     resp.status_code = 200
 
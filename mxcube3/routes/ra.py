@@ -18,6 +18,7 @@ from mxcube3 import server
 
 from mxcube3 import blcontrol
 from mxcube3.core import loginutils
+from mxcube3.core import sviewutils
 
 
 @server.route("/mxcube/api/v0.1/ra/request_control", methods=["POST"])
@@ -162,6 +163,7 @@ def timeout_gives_control():
     """
     control = request.get_json().get("timeoutGivesControl")
     mxcube.TIMEOUT_GIVES_CONTROL = control
+    mxcube.save_settings()
 
     return Response(status=200)
 
@@ -222,6 +224,14 @@ def connect():
     if user:
         user["socketio_sid"] = request.sid
 
+    # The shapes are otherwise only sent as deltas, see signals.send_shapes
+    socketio.emit(
+        "update_shapes",
+        sviewutils.get_shapes_sent(),
+        room=request.sid,
+        namespace="/hwr",
+    )
+
     # (Note: User is logged in if operator)
     if loginutils.is_operator(session.sid):
         if (
@@ -170,3 +170,19 @@ def send_command(cmdparts, args=None):
         )
     else:
         return jsonify(response=ret)
+
+
+@server.route("/mxcube/api/v0.1/sample_changer/prefetch", methods=["GET"])
+@server.restrict
+def get_prefetch_metrics():
+    return jsonify(scutils.get_prefetch_metrics())
+
+
+@server.route("/mxcube/api/v0.1/sample_changer/prefetch", methods=["PUT"])
+@server.require_control
+@server.restrict
+def set_prefetch_next_sample():
+    enabled = request.get_json().get("enabled", False)
+    scutils.set_prefetch_next_sample(enabled)
+
+    return jsonify(scutils.get_prefetch_metrics())
@@ -5,13 +5,15 @@ from __future__ import print_function
 import logging
 import json
 
-from mxcube3 import socketio
 from mxcube3 import mxcube
 from mxcube3 import blcontrol
 from mxcube3.core import utils
 from mxcube3.core import qutils
 from mxcube3.core import scutils
 from mxcube3.core import limsutils
+from mxcube3.core import sviewutils
+from mxcube3.core import emit_bus
+from mxcube3.core import signal_dispatch
 
 from abstract.AbstractSampleChanger import SampleChangerState
 from HardwareRepository.BaseHardwareObjects import HardwareObjectState
@@ -30,22 +32,88 @@ from HardwareRepository.HardwareObjects import queue_model_objects as qmo
 from HardwareRepository.HardwareObjects import queue_entry as qe
 
 from queue_entry import CENTRING_METHOD
-from mxcube3.core.utils import to_camel
 
 
-def last_queue_node():
-    node = blcontrol.beamline.queue_manager._current_queue_entries[-1].get_data_model()
+class ExecutionContext(object):
+    """
+    The node executed by a queue entry, its position in the queue and its
+    number of images, for the collection signal handlers. Computed once when
+    the entry is started, see queue_execution_entry_started.
+    """
+
+    __slots__ = (
+        "entry",
+        "node",
+        "sample",
+        "idx",
+        "queue_id",
+        "interleaved",
+        "num_images",
+    )
+
+    def __init__(self, entry):
+        node = entry.get_data_model()
+
+        # Reference collections are orphans, the node we want is the
+        # characterisation not the reference collection itself
+        if "refdc" in node.get_name():
+            parent = node.get_parent()
+            node = parent._children[0]
+
+        index = qutils.node_index(node)
+
+        self.entry = entry
+        self.node = node
+        self.sample = index["sample"]
+        self.idx = index["idx"]
+        self.queue_id = index["queue_id"]
+        self.interleaved = qutils.is_interleaved(node)
+        self.num_images = None
+
+        if isinstance(node, qmo.Characterisation):
+            dc = node.reference_image_collection
+            num_images = dc.acquisitions[0].acquisition_parameters.num_images
+            self.num_images = float(num_images) * 2
+        elif isinstance(node, qmo.DataCollection):
+            num_images = node.acquisitions[0].acquisition_parameters.num_images
+            self.num_images = float(num_images)
+
+    def progress(self, pdata):
+        """
+        :returns: The progress of the node, see qutils.get_task_progress
+        :rtype: float
+        """
+        if self.interleaved or self.num_images is None:
+            return qutils.get_task_progress(self.node, pdata)
+        elif self.node.is_executed():
+            return 1
+
+        return pdata / self.num_images
+
 
-    # Reference collections are orphans, the node we want is the
-    # characterisation not the reference collection itself
-    if "refdc" in node.get_name():
-        parent = node.get_parent()
-        node = parent._children[0]
+# Execution contexts of the entries being executed, outermost first
+EXECUTION_CONTEXTS = []
 
-    res = qutils.node_index(node)
-    res["node"] = node
 
-    return res
+def get_execution_context():
+    """
+    :returns: The execution context of the innermost entry being executed
+    :rtype: ExecutionContext
+    """
+    entry = blcontrol.beamline.queue_manager._current_queue_entries[-1]
+
+    if not EXECUTION_CONTEXTS or EXECUTION_CONTEXTS[-1].entry is not entry:
+        # Entry started without queue_execution_entry_started
+        EXECUTION_CONTEXTS.append(ExecutionContext(entry))
+
+    return EXECUTION_CONTEXTS[-1]
+
+
+def _execution_entry_finished(entry):
+    for i, context in enumerate(EXECUTION_CONTEXTS):
+        if context.entry is entry:
+            del EXECUTION_CONTEXTS[i:]
+            break
 
 
 beam_signals = ["beamPosChanged", "beamInfoChanged", "valueChanged", "stateChanged"]
@@ -105,13 +173,13 @@ def diffractometer_phase_changed(*args):
     logging.getLogger("user_level_log").info(
         "Diffractometer phase changed to %s" % args
     )
-    socketio.emit("diff_phase_changed", data, namespace="/hwr")
+    emit_bus.emit("diff_phase_changed", data, key="diffractometer")
 
 
 def sc_state_changed(*args):
     new_state = args[0]
     state_str = SampleChangerState.STATE_DESC.get(new_state, "Unknown").upper()
-    socketio.emit("sc_state", state_str, namespace="/hwr")
+    emit_bus.emit("sc_state", state_str, key="sample_changer")
 
 
 def sc_load(location):
@@ -121,7 +189,7 @@ def sc_load(location):
         "message": "Please wait, loading sample",
     }
 
-    socketio.emit("sc", msg, namespace="/hwr")
+    emit_bus.emit("sc", msg)
 
 
 def sc_load_ready(location):
@@ -131,7 +199,7 @@ def sc_load_ready(location):
         "message": "Sample changer, loaded sample",
     }
 
-    socketio.emit("sc", msg, namespace="/hwr")
+    emit_bus.emit("sc", msg)
 
 
 def sc_unload(location):
@@ -141,7 +209,7 @@ def sc_unload(location):
         "message": "Please wait, unloading sample",
     }
 
-    socketio.emit("sc", msg, namespace="/hwr")
+    emit_bus.emit("sc", msg)
 
 
 def is_collision_safe(*args):
@@ -150,7 +218,7 @@ def is_collision_safe(*args):
     # we are only interested when it becames true
     if new_state:
         msg = {"signal": "isCollisionSafe", "message": "Sample moved to safe area"}
-        socketio.emit("sc", msg, namespace="/hwr")
+        emit_bus.emit("sc", msg)
 
 
 def loaded_sample_changed(sample):
@@ -178,10 +246,8 @@ def loaded_sample_changed(sample):
 
             scutils.set_current_sample(address)
 
-        socketio.emit(
-            "loaded_sample_changed",
-            {"address": address, "barcode": barcode},
-            namespace="/hwr",
+        emit_bus.emit(
+            "loaded_sample_changed", {"address": address, "barcode": barcode}
         )
 
         sc_load_ready(address)
@@ -193,23 +259,25 @@ def set_current_sample(sample_id):
         sample_id = ""
 
     sample = {"sampleID": sample_id}
-    socketio.emit("set_current_sample", sample, namespace="/hwr")
+    emit_bus.emit("set_current_sample", sample)
+
+    # The clients clear their shapes when the current sample changes
+    sviewutils.reset_shapes_sent()
 
 
 def sc_contents_update():
-    socketio.emit("sc_contents_update")
+    emit_bus.emit("sc_contents_update")
 
 
 def sc_maintenance_update(state_list, cmd_state, message):
     try:
-        socketio.emit(
+        emit_bus.emit(
             "sc_maintenance_update",
             {
                 "state": json.dumps(state_list),
                 "commands_state": json.dumps(cmd_state),
                 "message": message,
             },
-            namespace="/hwr",
         )
     except Exception as msg:
         logging.getLogger("HWR").error("error sending message: %s" + str(msg))
@@ -223,7 +291,7 @@ def centring_started(method, *args):
     elif method in ["Manual 3-click"]:
         msg = {"method": CENTRING_METHOD.MANUAL}
 
-    socketio.emit("sample_centring", msg, namespace="/hwr")
+    emit_bus.emit("sample_centring", msg)
 
 
 def get_task_state(entry):
@@ -281,28 +349,31 @@ def update_task_result(entry):
         "limsResultData": limsres,
     }
 
-    socketio.emit("update_task_lims_data", msg, namespace="/hwr")
+    emit_bus.emit("update_task_lims_data", msg)
 
     
 def queue_execution_entry_started(entry, message):
+    qutils.invalidate_node_dict(entry.get_data_model(), descendants=True)
+    qutils.queue_journal.record("state", [entry.get_data_model()])
+    scutils.prefetch_next_sample(entry.get_data_model())
     handle_auto_mount_next(entry)
 
-    if not qutils.is_interleaved(entry.get_data_model()):
-        socketio.emit("task", get_task_state(entry), namespace="/hwr")
+    context = ExecutionContext(entry)
+    EXECUTION_CONTEXTS.append(context)
 
-
-def queue_execution_entry_started(entry, message):
-    handle_auto_mount_next(entry)
-
-    if not qutils.is_interleaved(entry.get_data_model()):
-        socketio.emit("task", get_task_state(entry), namespace="/hwr")
+    if not context.interleaved:
+        emit_bus.emit("task", get_task_state(entry))
 
 
 def queue_execution_entry_finished(entry, message):
+    qutils.invalidate_node_dict(entry.get_data_model(), descendants=True)
+    qutils.queue_journal.record("state", [entry.get_data_model()])
+    scutils.sample_finished(entry.get_data_model())
     handle_auto_mount_next(entry)
+    _execution_entry_finished(entry)
 
     if not qutils.is_interleaved(entry.get_data_model()):
-        socketio.emit("task", get_task_state(entry), namespace="/hwr")
+        emit_bus.emit("task", get_task_state(entry))
 
     queue_toggle_sample(entry)
 
@@ -310,30 +381,43 @@ def queue_execution_entry_finished(entry, message):
 def queue_toggle_sample(entry):
     if isinstance(entry, qe.SampleQueueEntry):
         msg = {"Signal": "DisableSample", "sampleID": entry.get_data_model().loc_str}
-        socketio.emit("queue", msg, namespace="/hwr")
+        emit_bus.emit("queue", msg)
 
 
 def queue_execution_started(entry, queue_state=None):
     state = queue_state if queue_state else qutils.queue_exec_state()
     msg = {"Signal": state, "Message": "Queue execution started"}
 
-    socketio.emit("queue", msg, namespace="/hwr")
+    emit_bus.emit("queue", msg)
+
+
+def _record_queue_state():
+    # The running state of the last executed entries is not valid anymore,
+    # the journal (and the index updated from it) get the current state
+    qutils.clear_node_dict_cache()
+    root = blcontrol.beamline.queue_model.get_model_root()
+    samples = [n for n in root.get_children() if isinstance(n, qmo.Sample)]
+    qutils.queue_journal.record("state", samples=samples)
 
 
 def queue_execution_finished(entry, queue_state=None):
+    del EXECUTION_CONTEXTS[:]
     state = queue_state if queue_state else qutils.queue_exec_state()
     msg = {"Signal": state, "Message": "Queue execution stopped"}
 
+    _record_queue_state()
     qutils.enable_sample_entries(mxcube.TEMP_DISABLED, True)
     mxcube.TEMP_DISABLED = []
 
-    socketio.emit("queue", msg, namespace="/hwr")
+    emit_bus.emit("queue", msg)
 
 
 def queue_execution_stopped(*args):
+    del EXECUTION_CONTEXTS[:]
+    _record_queue_state()
     msg = {"Signal": "QueueStopped", "Message": "Queue execution stopped"}
 
-    socketio.emit("queue", msg, namespace="/hwr")
+    emit_bus.emit("queue", msg)
 
 
 def queue_execution_paused(state):
@@ -342,25 +426,27 @@ def queue_execution_paused(state):
     else:
         msg = {"Signal": "QueueRunning", "Message": "Queue execution paused"}
 
-    socketio.emit("queue", msg, namespace="/hwr")
+    emit_bus.emit("queue", msg)
 
 
 def queue_execution_failed(entry):
+    del EXECUTION_CONTEXTS[:]
+    _record_queue_state()
     msg = {"Signal": qutils.queue_exec_state(), "Message": "Queue execution stopped"}
 
-    socketio.emit("queue", msg, namespace="/hwr")
+    emit_bus.emit("queue", msg)
 
 
 def collect_oscillation_started(*args):
-    node = last_queue_node()
+    context = get_execution_context()
 
-    if not qutils.is_interleaved(node["node"]):
+    if not context.interleaved:
         msg = {
             "Signal": "collectOscillationStarted",
             "Message": task_signals["collectOscillationStarted"],
-            "taskIndex": node["idx"],
-            "queueID": node["queue_id"],
-            "sample": node["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": RUNNING,
             "progress": 0,
         }
@@ -368,23 +454,23 @@ def collect_oscillation_started(*args):
         logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
         try:
-            socketio.emit("task", msg, namespace="/hwr")
+            emit_bus.emit("task", msg)
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def collect_image_taken(frame):
-    node = last_queue_node()
+    context = get_execution_context()
 
-    if not qutils.is_interleaved(node["node"]):
-        progress = qutils.get_task_progress(last_queue_node()["node"], frame)
+    if not context.interleaved:
+        progress = context.progress(frame)
 
         msg = {
             "Signal": "collectImageTaken",
             "Message": task_signals["collectImageTaken"],
-            "taskIndex": node["idx"],
-            "queueID": node["queue_id"],
-            "sample": node["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": RUNNING if progress < 1 else COLLECTED,
             "progress": progress,
         }
@@ -393,31 +479,34 @@ def collect_image_taken(frame):
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
-@utils.RateLimited(1)
+@utils.Throttled(1, key=lambda msg: msg["queueID"])
 def _emit_progress(msg):
     logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
-    socketio.emit("task", msg, namespace="/hwr")
+    emit_bus.emit("task", msg)
 
 
 def collect_oscillation_failed(
     owner=None, status=FAILED, state=None, lims_id="", osc_id=None, params=None
 ):
-    node = last_queue_node()
+    context = get_execution_context()
 
-    mxcube.NODE_ID_TO_LIMS_ID[node["queue_id"]] = lims_id
+    mxcube.NODE_ID_TO_LIMS_ID[context.queue_id] = lims_id
 
-    if not qutils.is_interleaved(node["node"]):
+    if not context.interleaved:
         try:
             blcontrol.beamline.lims_rest.get_dc(lims_id)
         except BaseException:
             pass
 
+        # The pending progress is older than this message
+        _emit_progress.cancel(context.queue_id)
+
         msg = {
             "Signal": "collectOscillationFailed",
             "Message": task_signals["collectOscillationFailed"],
-            "taskIndex": node["idx"],
-            "queueID": node["queue_id"],
-            "sample": node["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": FAILED,
             "progress": 0,
         }
@@ -425,24 +514,30 @@ def collect_oscillation_failed(
         logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
         try:
-            socketio.emit("task", msg, namespace="/hwr")
+            emit_bus.emit("task", msg)
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def collect_oscillation_finished(owner, status, state, lims_id, osc_id, params):
-    node = last_queue_node()
-    mxcube.NODE_ID_TO_LIMS_ID[node["queue_id"]] = lims_id
+    context = get_execution_context()
+    mxcube.NODE_ID_TO_LIMS_ID[context.queue_id] = lims_id
+
+    if isinstance(context.node, qmo.DataCollection):
+        qutils.register_run_number(context.node.acquisitions[0].path_template)
+
+    if not context.interleaved:
+        qutils.enable_entry(context.queue_id, False)
 
-    if not qutils.is_interleaved(node["node"]):
-        qutils.enable_entry(node["queue_id"], False)
+        # The pending progress is older than this message
+        _emit_progress.cancel(context.queue_id)
 
         msg = {
             "Signal": "collectOscillationFinished",
             "Message": task_signals["collectOscillationFinished"],
-            "taskIndex": node["idx"],
-            "queueID": node["queue_id"],
-            "sample": node["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": COLLECTED,
             "progress": 1,
         }
@@ -450,23 +545,24 @@ def collect_oscillation_finished(owner, status, state, lims_id, osc_id, params):
         logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
         try:
-            socketio.emit("task", msg, namespace="/hwr")
+            emit_bus.emit("task", msg)
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def collect_ended(owner, success, message):
-    node = last_queue_node()
+    context = get_execution_context()
 
-    if not qutils.is_interleaved(node["node"]):
+    if not context.interleaved:
+        _emit_progress.cancel(context.queue_id)
         state = COLLECTED if success else WARNING
 
         msg = {
             "Signal": "collectOscillationFinished",
             "Message": message,
-            "taskIndex": node["idx"],
-            "queueID": node["queue_id"],
-            "sample": node["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": state,
             "progress": 1,
         }
@@ -474,22 +570,22 @@ def collect_ended(owner, success, message):
         logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
         try:
-            socketio.emit("task", msg, namespace="/hwr")
+            emit_bus.emit("task", msg)
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def collect_started(*args, **kwargs):
-    node = last_queue_node()
+    context = get_execution_context()
 
-    if not qutils.is_interleaved(node["node"]):
+    if not context.interleaved:
 
         msg = {
             "Signal": kwargs["signal"],
             "Message": task_signals[kwargs["signal"]],
-            "taskIndex": last_queue_node()["idx"],
-            "queueID": last_queue_node()["queue_id"],
-            "sample": last_queue_node()["sample"],
+            "taskIndex": context.idx,
+            "queueID": context.queue_id,
+            "sample": context.sample,
             "state": RUNNING,
             "progress": 0,
         }
@@ -497,30 +593,28 @@ def collect_started(*args, **kwargs):
         logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
         try:
-            socketio.emit("task", msg, namespace="/hwr")
+            emit_bus.emit("task", msg)
         except Exception:
             logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def grid_result_available(shape):
-    socketio.emit("grid_result_available", {"shape": shape}, namespace="/hwr")
+    emit_bus.emit("grid_result_available", {"shape": shape})
 
 
 def energy_scan_finished(pk, ip, rm, sample):
-    socketio.emit(
-        "energy_scan_result", {"pk": pk, "ip": ip, "rm": rm}, namespace="/hwr"
-    )
+    emit_bus.emit("energy_scan_result", {"pk": pk, "ip": ip, "rm": rm})
 
 
 def queue_interleaved_started():
-    node = last_queue_node()
+    context = get_execution_context()
 
     msg = {
         "Signal": "queue_interleaved_started",
         "Message": "Interleaved collection started",
-        "taskIndex": node["idx"],
-        "queueID": node["queue_id"],
-        "sample": node["sample"],
+        "taskIndex": context.idx,
+        "queueID": context.queue_id,
+        "sample": context.sample,
         "state": RUNNING,
         "progress": 0,
     }
@@ -528,20 +622,20 @@ def queue_interleaved_started():
     logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
     try:
-        socketio.emit("task", msg, namespace="/hwr")
+        emit_bus.emit("task", msg)
     except Exception:
         logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def queue_interleaved_finished():
-    node = last_queue_node()
+    context = get_execution_context()
 
     msg = {
         "Signal": "queue_interleaved_finished",
         "Message": "Interleaved collection ended",
-        "taskIndex": node["idx"],
-        "queueID": node["queue_id"],
-        "sample": node["sample"],
+        "taskIndex": context.idx,
+        "queueID": context.queue_id,
+        "sample": context.sample,
         "state": COLLECTED,
         "progress": 1,
     }
@@ -549,21 +643,21 @@ def queue_interleaved_finished():
     logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
     try:
-        socketio.emit("task", msg, namespace="/hwr")
+        emit_bus.emit("task", msg)
     except Exception:
         logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def queue_interleaved_sw_done(data):
-    node = last_queue_node()
-    progress = qutils.get_task_progress(node["node"], data)
+    context = get_execution_context()
+    progress = context.progress(data)
 
     msg = {
         "Signal": "collectImageTaken",
         "Message": task_signals["collectImageTaken"],
-        "taskIndex": node["idx"],
-        "queueID": node["queue_id"],
-        "sample": node["sample"],
+        "taskIndex": context.idx,
+        "queueID": context.queue_id,
+        "sample": context.sample,
         "state": RUNNING if progress < 1 else COLLECTED,
         "progress": progress,
     }
@@ -571,47 +665,39 @@ def queue_interleaved_sw_done(data):
     logging.getLogger("HWR").debug("[TASK CALLBACK] " + str(msg))
 
     try:
-        socketio.emit("task", msg, namespace="/hwr")
+        emit_bus.emit("task", msg)
     except Exception:
         logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def xrf_task_progress(taskId, progress):
-    node = last_queue_node()
+    context = get_execution_context()
 
     msg = {
         "Signal": "XRFTaskUpdate",
         "Message": "XRFTaskUpdate",
-        "taskIndex": node["idx"],
-        "queueID": node["queue_id"],
-        "sample": node["sample"],
+        "taskIndex": context.idx,
+        "queueID": context.queue_id,
+        "sample": context.sample,
         "state": RUNNING if progress < 1 else COLLECTED,
         "progress": progress,
     }
 
     try:
-        socketio.emit("task", msg, namespace="/hwr")
+        emit_bus.emit("task", msg)
     except Exception:
         logging.getLogger("HWR").error("error sending message: " + str(msg))
 
 
 def send_shapes(update_positions=False, movable={}):
+    delta = sviewutils.get_shapes_delta(update_positions)
 
-    shape_dict = {}
-    for shape in blcontrol.beamline.sample_view.get_shapes():
-        if update_positions:
-            shape.update_position(
-                blcontrol.beamline.diffractometer.motor_positions_to_screen
-            )
-
-        s = to_camel(shape.as_dict())
-        shape_dict.update({shape.id: s})
-
-    socketio.emit("update_shapes", {"shapes": shape_dict}, namespace="/hwr")
+    if delta["shapes"] or delta["removed"]:
+        emit_bus.emit("shapes_delta", delta)
 
 
 def motor_position_callback(movable):
-    socketio.emit("motor_position", movable, namespace="/hwr")
+    emit_bus.emit("motor_position", movable, key=movable["name"])
 
 
 def motor_state_callback(movable, sender=None, **kw):
@@ -621,16 +707,16 @@ def motor_state_callback(movable, sender=None, **kw):
         motor_position_callback(movable)
 
         # Re calculate positions for shapes after motor finished to move
-        send_shapes(update_positions=True, movable=movable)
+        signal_dispatch.dispatch(
+            send_shapes, kwargs={"update_positions": True, "movable": movable}
+        )
 
         # Update the pixels per mm if it was the zoom motor that moved
         if movable["name"] == "zoom":
             ppm = blcontrol.beamline.diffractometer.get_pixels_per_mm()
-            socketio.emit(
-                "update_pixels_per_mm", {"pixelsPerMm": ppm}, namespace="/hwr"
-            )
+            emit_bus.emit("update_pixels_per_mm", {"pixelsPerMm": ppm}, key="zoom")
 
-    socketio.emit("motor_state", movable, namespace="/hwr")
+    emit_bus.emit("motor_state", movable, key=movable["name"])
 
 
 def beam_changed(*args, **kwargs):
@@ -652,7 +738,7 @@ def beam_changed(*args, **kwargs):
         }
     )
     try:
-        socketio.emit("beam_changed", {"data": beam_info_dict}, namespace="/hwr")
+        emit_bus.emit("beam_changed", {"data": beam_info_dict}, key="beam")
     except Exception:
         logging.getLogger("HWR").exception("error sending message: %s" + str(msg))
 
@@ -660,7 +746,7 @@ def beam_changed(*args, **kwargs):
 def beamline_action_start(name):
     msg = {"name": name, "state": RUNNING}
     try:
-        socketio.emit("beamline_action", msg, namespace="/hwr")
+        emit_bus.emit("beamline_action", msg)
     except Exception:
         logging.getLogger("HWR").exception(
             "error sending beamline action message: %s", msg
@@ -670,7 +756,7 @@ def beamline_action_start(name):
 def beamline_action_done(name, result):
     try:
         msg = {"name": name, "state": READY, "data": result}
-        socketio.emit("beamline_action", msg, namespace="/hwr")
+        emit_bus.emit("beamline_action", msg)
     except Exception:
         logging.getLogger("HWR").exception(
             "error sending beamline action message: %s", msg
@@ -682,7 +768,7 @@ def beamline_action_done(name, result):
 def beamline_action_failed(name):
     msg = {"name": name, "state": FAILED}
     try:
-        socketio.emit("beamline_action", msg, namespace="/hwr")
+        emit_bus.emit("beamline_action", msg)
     except Exception:
         logging.getLogger("HWR").exception(
             "error sending beamline action message: %s", msg
@@ -695,46 +781,56 @@ def safety_shutter_state_changed(values):
     ho = BeamlineAdapter(blcontrol.beamline).getObjectByRole("safety_shutter")
     data = ho.dict_repr()
     try:
-        socketio.emit("beamline_value_change", data, namespace="/hwr")
+        emit_bus.emit("beamline_value_change", data, key=data["name"])
     except Exception:
         logging.getLogger("HWR").error("error sending message: %s" + str(data))
 
 
 def mach_info_changed(values):
     try:
-        socketio.emit("mach_info_changed", values, namespace="/hwr")
+        emit_bus.emit("mach_info_changed", values, key="machine")
     except Exception:
         logging.getLogger("HWR").error("error sending message: %s" + str(msg))
 
 
 def new_plot(plot_info):
     try:
-        socketio.emit("new_plot", plot_info, namespace="/hwr")
+        emit_bus.emit("new_plot", plot_info)
     except Exception:
         logging.getLogger("HWR").error("error sending new_plot message: %s", plot_info)
 
 
-@utils.RateLimited(1)
-def plot_data(data, last_index=[0], **kwargs):
+# Number of points of each plot already sent, plot id -> number of points
+PLOT_DATA_INDEX = {}
+
+
+@utils.Throttled(1, key=lambda data, **kwargs: data["id"])
+def plot_data(data, **kwargs):
     data_data = data["data"]
-    if last_index[0] > len(data_data):
-        last_index = [0]
+    last_index = PLOT_DATA_INDEX.get(data["id"], 0)
 
-    data["data"] = data_data[last_index[0] :]
+    if last_index > len(data_data):
+        last_index = 0
+
+    data["data"] = data_data[last_index:]
 
     try:
-        socketio.emit("plot_data", data, namespace="/hwr")
+        emit_bus.emit("plot_data", data)
     except Exception:
         logging.getLogger("HWR").exception(
             "error sending plot_data message for plot %s", data["id"]
         )
     else:
-        last_index[0] += len(data_data)
+        PLOT_DATA_INDEX[data["id"]] = len(data_data)
 
 
 def plot_end(data):
+    # Send the last points before the end of the plot
+    plot_data.flush(data["id"])
+    PLOT_DATA_INDEX.pop(data["id"], None)
+
     try:
-        socketio.emit("plot_end", data, namespace="/hwr")
+        emit_bus.emit("plot_end", data)
     except Exception:
         logging.getLogger("HWR").error(
             "error sending plot_end message for plot %s", data["id"]
@@ -43,6 +43,105 @@ export function setQueue(queue) {
 }
 
 
+// Queue on the server format (queue_to_dict) kept up to date with the
+// queue_delta messages, its version and the latest version announced
+let serverQueue = {};
+let serverQueueVersion = null;
+let latestQueueVersion = null;
+let fetchingQueueDelta = false;
+
+
+function applyQueuePatches(patches) {
+  // The patches only replace the whole queue or add/remove top level keys
+  const changed = new Set();
+
+  patches.forEach((patch) => {
+    const key = patch.path.slice(1).replace(/~1/g, '/').replace(/~0/g, '~');
+
+    if (patch.op === 'replace' && patch.path === '') {
+      serverQueue = { ...patch.value };
+      Object.keys(serverQueue).forEach((sid) => changed.add(sid));
+    } else if (patch.op === 'remove') {
+      delete serverQueue[key];
+      changed.delete(key);
+    } else {
+      serverQueue[key] = patch.value;
+      changed.add(key);
+    }
+  });
+
+  changed.delete('sample_order');
+
+  return changed;
+}
+
+
+function applyQueueDeltaRecord(delta) {
+  return function (dispatch, getState) {
+    const changed = applyQueuePatches(delta.patches);
+    const currentSampleList = getState().sampleGrid.sampleList;
+    const sampleList = { ...currentSampleList };
+
+    serverQueueVersion = delta.version;
+
+    // The samples of the grid also hold the LIMS and sample changer data
+    changed.forEach((sid) => {
+      sampleList[sid] = { ...currentSampleList[sid], ...serverQueue[sid] };
+    });
+
+    dispatch(setQueue({ sampleOrder: serverQueue.sample_order || [], sampleList }));
+  };
+}
+
+
+export function fetchQueueDelta() {
+  return function (dispatch) {
+    fetchingQueueDelta = true;
+
+    return fetch(`mxcube/api/v0.1/queue/delta?since=${serverQueueVersion || 0}`, {
+      method: 'GET',
+      credentials: 'include',
+      headers: {
+        Accept: 'application/json',
+        'Content-type': 'application/json'
+      }
+    }).then(response => response.json()).then((delta) => {
+      fetchingQueueDelta = false;
+
+      if (delta.since === (serverQueueVersion || 0)) {
+        dispatch(applyQueueDeltaRecord(delta));
+      }
+
+      // Messages received during the request were not applied
+      if (latestQueueVersion > serverQueueVersion) {
+        dispatch(fetchQueueDelta());
+      }
+    }).catch(() => {
+      fetchingQueueDelta = false;
+    });
+  };
+}
+
+
+export function applyQueueDelta(delta) {
+  return function (dispatch) {
+    latestQueueVersion = Math.max(latestQueueVersion || 0, delta.version);
+
+    if (fetchingQueueDelta) {
+      return;
+    }
+
+    if (delta.since === serverQueueVersion) {
+      dispatch(applyQueueDeltaRecord(delta));
+    } else {
+      // Messages were missed (or this is the first one), get the patches
+      // from the version we have, the complete queue if it is too old
+      dispatch(fetchQueueDelta());
+    }
+  };
+}
+
+
 export function setCentringMethod(centringMethod) {
   return { type: 'SET_CENTRING_METHOD', centringMethod };
 }
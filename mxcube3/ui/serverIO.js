@@ -8,6 +8,7 @@ import {
   setBeamInfo,
   startClickCentring,
   updateShapes,
+  deleteShape,
   setPixelsPerMm,
   videoMessageOverlay,
   setCurrentPhase
@@ -32,7 +33,8 @@ import {
   setCurrentSample,
   addDiffractionPlanAction,
   setSampleAttribute,
-  setRootPath
+  setRootPath,
+  applyQueueDelta
 } from './actions/queue';
 import {
   collapseItem,
@@ -117,12 +119,25 @@ class ServerIO {
     this.hwrSocket.emit('setRaObserver', { master: true, name }, cb);
   }
 
+  unpackFrames(socket) {
+    // Messages batched by the server (emit_bus) are sent as one frame,
+    // a list of [event, data], dispatched to the handlers of each event
+    socket.on('frame', (frame) => {
+      frame.forEach(([event, data]) => {
+        socket.listeners(event).forEach((handler) => handler(data));
+      });
+    });
+  }
+
   listen(store) {
     this.dispatch = store.dispatch;
 
     this.hwrSocket = io.connect(`//${document.domain}:${location.port}/hwr`);
     this.loggingSocket = io.connect(`//${document.domain}:${location.port}/logging`);
 
+    this.unpackFrames(this.hwrSocket);
+    this.unpackFrames(this.loggingSocket);
+
     this.loggingSocket.on('log_record', (record) => {
       this.dispatch(addUserMessage(record));
       this.dispatch(addLogRecord(record));
@@ -148,6 +163,16 @@ class ServerIO {
       this.dispatch(setShapes(record.shapes));
     });
 
+    this.hwrSocket.on('shapes_delta', (record) => {
+      const shapes = Object.values(record.shapes);
+
+      if (shapes.length > 0) {
+        this.dispatch(updateShapes(shapes));
+      }
+
+      record.removed.forEach((id) => this.dispatch(deleteShape(id)));
+    });
+
     this.hwrSocket.on('update_pixels_per_mm', (record) => {
       this.dispatch(setPixelsPerMm(record.pixelsPerMm));
     });
@@ -211,6 +236,10 @@ class ServerIO {
       this.dispatch(addDiffractionPlanAction(record.tasks));
     });
 
+    this.hwrSocket.on('queue_delta', (record) => {
+      this.dispatch(applyQueueDelta(record));
+    });
+
     this.hwrSocket.on('queue', (record, callback) => {
       if (callback) {
         callback();
@@ -26,7 +26,7 @@ MXCUBE_ROOT = os.path.abspath(
 sys.path.append(MXCUBE_ROOT)
 sys.path.append("./")
 
-from mxcube3 import server, socketio
+from mxcube3 import server, socketio, mxcube
 
 _SIO_TEST_CLIENT = None
 
@@ -36,6 +36,10 @@ def client():
     global _SIO_TEST_CLIENT
     server.config["TESTING"] = True
 
+    # Each test starts from an empty queue, not from the queue stored by the
+    # previous test
+    mxcube.CONFIG.APP.QUEUE_STORE_RESTORE = False
+
     client = server.test_client()
 
     data = json.dumps({"proposal": "idtest0", "password": "sUpErSaFe"})
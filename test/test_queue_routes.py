@@ -17,6 +17,8 @@ from input_parameters import (
 
 from fixture import client
 
+from mxcube3.core import qutils
+
 
 def test_get_main(client):
     """Test if we can get the home page."""
@@ -69,6 +71,26 @@ def test_add_and_edit_task(client):
     )
 
 
+def test_edited_task_in_queue(client):
+    """Test that an edited task is updated in the (cached) queue representation."""
+    resp = client.get("/mxcube/api/v0.1/queue")
+    queue_id = json.loads(resp.data).get("1:05")["queueID"]
+    task_queue_id = json.loads(resp.data).get("1:05")["tasks"][0]["queueID"]
+
+    task_to_update = copy.deepcopy(test_edit_task)
+    task_to_update["parameters"]["num_images"] = 42
+    resp = client.post(
+        ("/mxcube/api/v0.1/queue/{}/{}").format(queue_id, task_queue_id),
+        data=json.dumps(task_to_update),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    task = json.loads(resp.data).get("1:05")["tasks"][0]
+    assert resp.status_code == 200 and task["parameters"]["num_images"] == 42
+
+
 def test_queue_start(client):
     """
     Test if we can start the queue.
@@ -194,6 +216,198 @@ def test_queue_delete_item(client):
     )
 
 
+def test_queue_checkpoint(client):
+    """Test if a queue checkpoint restores the deleted task."""
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/checkpoint",
+        data=json.dumps({"name": "test"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200 and json.loads(resp.data)["name"] == "test"
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/delete",
+        data=json.dumps([["1:05", 0]]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.post("/mxcube/api/v0.1/queue/checkpoint/test/restore")
+    queue = json.loads(resp.data)
+    assert resp.status_code == 200 and len(queue["1:05"]["tasks"]) == 1
+    assert queue["sample_order"] == ["1:01", "1:05"]
+
+    resp = client.delete("/mxcube/api/v0.1/queue/checkpoint/test")
+    assert resp.status_code == 200
+
+    resp = client.post("/mxcube/api/v0.1/queue/checkpoint/test/restore")
+    assert resp.status_code == 409
+
+
+def test_queue_task_index_after_delete(client):
+    """Test that the task index of the remaining tasks is updated after a delete."""
+    resp = client.get("/mxcube/api/v0.1/queue")
+    queue_id = json.loads(resp.data).get("1:05")["queueID"]
+    task_to_add = copy.deepcopy(test_task)
+    task_to_add["queueID"] = queue_id
+    task_to_add["tasks"][0]["sampleQueueID"] = queue_id
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue",
+        data=json.dumps([task_to_add]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/delete",
+        data=json.dumps([["1:05", 0]]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    tasks = json.loads(resp.data).get("1:05")["tasks"]
+    assert len(tasks) == 1 and tasks[0]["taskIndex"] == 0
+
+
+def test_queue_batch(client):
+    """Test if we can add and delete tasks with one batch request."""
+    resp = client.get("/mxcube/api/v0.1/queue")
+    queue_id = json.loads(resp.data).get("1:05")["queueID"]
+    task_to_add = copy.deepcopy(test_task)
+    task_to_add["queueID"] = queue_id
+    task_to_add["tasks"][0]["sampleQueueID"] = queue_id
+
+    operations = [
+        {"op": "add", "items": [task_to_add]},
+        {"op": "add", "items": [copy.deepcopy(task_to_add)]},
+        {"op": "delete", "items": [["1:05", 0]]},
+    ]
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/batch",
+        data=json.dumps(operations),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    assert (
+        resp.status_code == 200 and len(json.loads(resp.data).get("1:05")["tasks"]) == 2
+    )
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/batch",
+        data=json.dumps([{"op": "add", "items": []}, {"op": "unknown"}]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 409
+
+    # The add is rolled back when the delete of an unknown task fails
+    operations = [
+        {"op": "add", "items": [copy.deepcopy(task_to_add)]},
+        {"op": "delete", "items": [["1:05", 10]]},
+    ]
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/batch",
+        data=json.dumps(operations),
+        content_type="application/json",
+    )
+    assert resp.status_code == 409
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    assert len(json.loads(resp.data).get("1:05")["tasks"]) == 2
+
+
+def test_queue_import(client):
+    """Test if we can import samples and tasks."""
+    data = "sampleID,sampleName,location\n1:06,Sample-106,1:6\n1:08,,1:8\n"
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/import", data=data, content_type="text/csv"
+    )
+    assert resp.status_code == 200 and "1:06" in json.loads(resp.data)["sampleOrder"]
+
+    task = copy.deepcopy(test_task["tasks"][0])
+    task["sampleID"] = "1:06"
+    task.pop("sampleQueueID", None)
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/import",
+        data=json.dumps(task),
+        content_type="application/x-ndjson",
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    queue = json.loads(resp.data)
+    assert len(queue["1:06"]["tasks"]) == 1
+    assert queue["1:08"]["sampleName"] == "1:08"
+
+    task["sampleID"] = "1:07"
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/import",
+        data=json.dumps(task),
+        content_type="application/x-ndjson",
+    )
+    assert resp.status_code == 409
+
+
+def test_queue_journal(client):
+    """Test if we can get the queue journal and the queue at a journal position."""
+    resp = client.get("/mxcube/api/v0.1/queue/journal")
+    position = json.loads(resp.data)["position"]
+    assert resp.status_code == 200 and position > 0
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    queue = json.loads(resp.data)
+
+    client.post(
+        "/mxcube/api/v0.1/queue/delete",
+        data=json.dumps([["1:05", 0]]),
+        content_type="application/json",
+    )
+
+    resp = client.get("/mxcube/api/v0.1/queue/journal?since=%s" % position)
+    entries = json.loads(resp.data)["entries"]
+    assert resp.status_code == 200 and entries[0]["op"] == "delete"
+
+    resp = client.get("/mxcube/api/v0.1/queue/journal/%s" % position)
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data)["1:05"]["tasks"]) == len(queue["1:05"]["tasks"])
+
+    resp = client.get("/mxcube/api/v0.1/queue/journal/%s" % (position + 1000))
+    assert resp.status_code == 409
+
+
+def test_queue_delta(client):
+    """Test if we can get the changes to the queue since a given version."""
+    resp = client.get("/mxcube/api/v0.1/queue/delta")
+    delta = json.loads(resp.data)
+    version = delta["version"]
+    assert resp.status_code == 200
+
+    # A client without queue gets the complete queue
+    assert [(p["op"], p["path"]) for p in delta["patches"]] == [("replace", "")]
+
+    client.post(
+        "/mxcube/api/v0.1/queue/delete",
+        data=json.dumps([["1:05", 0]]),
+        content_type="application/json",
+    )
+
+    resp = client.get("/mxcube/api/v0.1/queue/delta?since=%s" % version)
+    delta = json.loads(resp.data)
+    patches = {patch["path"]: patch for patch in delta["patches"]}
+
+    assert resp.status_code == 200 and delta["version"] > version
+    assert patches["/1:05"]["value"]["tasks"] == []
+    assert "/sample_order" in patches
+
+
 def test_queue_enable_item(client):
     """Test if we can disable a task in the sample in queue."""
     resp = client.get("/mxcube/api/v0.1/queue")
@@ -215,6 +429,29 @@ def test_queue_enable_item(client):
     )
 
 
+def test_queue_enable_propagation(client):
+    """Test if enabling a task enables its sample, and disabling a sample
+    disables its tasks."""
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/set_enabled",
+        data=json.dumps({"puck": 1, "enabled": False}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    queue = json.loads(client.get("/mxcube/api/v0.1/queue").data)
+    assert not queue["1:01"]["checked"] and not queue["1:05"]["checked"]
+    assert not queue["1:05"]["tasks"][0]["checked"]
+
+    task_id = queue["1:05"]["tasks"][0]["queueID"]
+    resp = client.put("/mxcube/api/v0.1/queue/%s/toggle" % task_id)
+    assert resp.status_code == 200
+
+    queue = json.loads(client.get("/mxcube/api/v0.1/queue").data)
+    assert queue["1:05"]["checked"] and queue["1:05"]["tasks"][0]["checked"]
+    assert not queue["1:01"]["checked"]
+
+
 def test_queue_swap_task_item(client):
     """Test if we can swap tasks in a sample in queue. Two tasks are added with a different param and then swaped and tested"""
     resp = client.get("/mxcube/api/v0.1/queue")
@@ -253,6 +490,53 @@ def test_queue_swap_task_item(client):
     )
 
 
+def test_queue_add_interleaved(client):
+    """Test if an interleaved collection replaces the collections used as
+    wedges, at the position of the first wedge."""
+    queue_id = json.loads(client.get("/mxcube/api/v0.1/queue").data)["1:05"][
+        "queueID"
+    ]
+
+    task_to_add = copy.deepcopy(test_task)
+    task_to_add["queueID"] = queue_id
+    task_to_add["tasks"][0]["sampleQueueID"] = queue_id
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue",
+        data=json.dumps([task_to_add]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    wedge = copy.deepcopy(test_task["tasks"][0])
+    interleaved = copy.deepcopy(test_task)
+    interleaved["queueID"] = queue_id
+    interleaved["tasks"] = [
+        {
+            "type": "Interleaved",
+            "label": "Interleaved",
+            "sampleID": "1:05",
+            "sampleQueueID": queue_id,
+            "parameters": {
+                "taskIndexList": [0, 1],
+                "wedges": [wedge, copy.deepcopy(wedge)],
+                "swNumImages": 10,
+            },
+        }
+    ]
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue",
+        data=json.dumps([interleaved]),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    tasks = json.loads(client.get("/mxcube/api/v0.1/queue").data)["1:05"]["tasks"]
+    assert [t["type"] for t in tasks] == ["Interleaved"]
+    assert len(tasks[0]["parameters"]["wedges"]) == 2
+
+
 def test_queue_move_task_item(client):
     """Test if we can move tasks in a sample in queue.
     Three tasks are added with a different param and then moved and tested."""
@@ -387,6 +671,123 @@ def test_queue_set_sample_order(client):
     )
 
 
+def test_queue_schedule_samples(client):
+    """Test if we can schedule the sample order with a pinned sample."""
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/schedule",
+        data=json.dumps({"pinned": {"1:05": 0}}),
+        content_type="application/json",
+    )
+    schedule = json.loads(resp.data)
+
+    assert resp.status_code == 200
+    assert schedule["sampleOrder"][0] == "1:05" and "saving" in schedule
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/schedule",
+        data=json.dumps({"pinned": {"1:05": 0}, "apply": True}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/mxcube/api/v0.1/queue")
+    assert json.loads(resp.data)["sample_order"] == ["1:05", "1:01"]
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/schedule",
+        data=json.dumps({"pinned": {"1:05": 5}}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 409
+
+
+def test_queue_query(client):
+    """Test if we can look up queue nodes by type, sample and protein."""
+    resp = client.get("/mxcube/api/v0.1/queue/query?type=DataCollection")
+    nodes = json.loads(resp.data)["nodes"]
+
+    assert resp.status_code == 200
+    assert len(nodes) == 1 and nodes[0]["sampleID"] == "1:05"
+
+    resp = client.get("/mxcube/api/v0.1/queue/query?type=Sample&checked=true")
+    nodes = json.loads(resp.data)["nodes"]
+    assert sorted(node["sampleID"] for node in nodes) == ["1:01", "1:05"]
+
+    resp = client.get("/mxcube/api/v0.1/queue/query?sampleID=1:05")
+    nodes = json.loads(resp.data)["nodes"]
+    assert sorted(node["type"] for node in nodes) == ["DataCollection", "Sample"]
+
+    resp = client.get("/mxcube/api/v0.1/queue/query?color=blue")
+    assert resp.status_code == 409
+
+
+def test_queue_query_after_stop(client):
+    """Test that the state and enabled flag of the index follow a stopped queue."""
+    resp = client.put(
+        "/mxcube/api/v0.1/queue/start",
+        data=json.dumps({"sid": "1:05"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    resp = client.put("/mxcube/api/v0.1/queue/unpause")
+    assert resp.status_code == 200
+
+    resp = client.put("/mxcube/api/v0.1/queue/stop")
+    assert resp.status_code == 200
+
+    time.sleep(2)
+    resp = client.get("/mxcube/api/v0.1/queue")
+    sample = json.loads(resp.data)["1:05"]
+    expected = {sample["queueID"]: (sample["state"], sample["checked"])}
+    expected.update(
+        {task["queueID"]: (task["state"], task["checked"]) for task in sample["tasks"]}
+    )
+
+    resp = client.get("/mxcube/api/v0.1/queue/query?sampleID=1:05")
+    nodes = json.loads(resp.data)["nodes"]
+    assert {
+        node["queueID"]: (node["state"], node["checked"]) for node in nodes
+    } == expected
+
+    for (state, checked) in set(expected.values()):
+        resp = client.get(
+            "/mxcube/api/v0.1/queue/query?sampleID=1:05&state=%s&checked=%s"
+            % (state, checked)
+        )
+        nodes = json.loads(resp.data)["nodes"]
+        assert {node["queueID"] for node in nodes} == {
+            qid for qid, value in expected.items() if value == (state, checked)
+        }
+
+
+def test_queue_dry_run(client):
+    """Test if we can predict the execution time of the queue."""
+    client.get("/mxcube/api/v0.1/queue")
+    cache = dict(qutils.NODE_DICT_CACHE)
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/dry_run",
+        data=json.dumps({"timeModel": {"mount": 10, "centring": 5}}),
+        content_type="application/json",
+    )
+    report = json.loads(resp.data)
+
+    assert resp.status_code == 200
+    assert qutils.NODE_DICT_CACHE == cache
+    assert [s["sampleID"] for s in report["samples"]] == ["1:01", "1:05"]
+    assert report["samples"][1]["steps"][0]["name"] == "mount"
+    assert report["totalTime"] == report["samples"][-1]["end"]
+    assert report["overhead"]["tasks"] == 1
+
+    resp = client.post(
+        "/mxcube/api/v0.1/queue/dry_run",
+        data=json.dumps({"timeModel": {"mount": -1}}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 409
+
+
 def test_get_default_dc_params(client):
     """Test if we get the right default data collection params."""
 
@@ -402,6 +803,20 @@ def test_get_default_dc_params(client):
     assert resp.status_code == 200 and actual == default_dc_params
 
 
+def test_get_default_params_etag(client):
+    """Test if the default parameters are revalidated with their ETag."""
+    resp = client.get("/mxcube/api/v0.1/queue/dc")
+    etag = resp.headers["ETag"]
+
+    assert resp.status_code == 200 and etag
+
+    resp = client.get("/mxcube/api/v0.1/queue/dc", headers={"If-None-Match": etag})
+    assert resp.status_code == 304 and resp.headers["ETag"] == etag
+
+    resp = client.get("/mxcube/api/v0.1/queue/mesh", headers={"If-None-Match": etag})
+    assert resp.status_code == 200 and resp.headers["ETag"] != etag
+
+
 def test_get_default_char_acq_params(client):
     """Test if we get the right default characterisation acq params."""
     resp = client.get("/mxcube/api/v0.1/queue/char_acq")
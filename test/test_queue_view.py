@@ -0,0 +1,73 @@
+import json
+import tracemalloc
+
+from mxcube3.core import queue_view
+
+NUM_TASKS = 1000
+
+# The keys are literals in the handlers, shared by all tasks
+PARAMETER_KEYS = ["param_%s" % n for n in range(50)]
+
+
+def _task(i):
+    """A task on the format returned by qutils._handle_dc"""
+    parameters = {key: n * 0.5 for n, key in enumerate(PARAMETER_KEYS)}
+    parameters.update(
+        {
+            "prefix": "test_prefix",
+            "path": "/data/visitor/mx0000/id00/test/RAW_DATA/test_prefix",
+            "run_number": i,
+            "first_image": 1,
+            "num_images": 100,
+            "exp_time": 0.01,
+            "osc_range": 0.1,
+            "shutterless": True,
+        }
+    )
+
+    return {
+        "label": "Data Collection",
+        "type": "DataCollection",
+        "parameters": parameters,
+        "sampleID": "1:%02d" % (i % 10),
+        "sampleQueueID": i,
+        "taskIndex": i,
+        "queueID": 1000 + i,
+        "checked": True,
+        "state": 0,
+        "limsResultData": {},
+    }
+
+
+def _allocated(func):
+    tracemalloc.start()
+    t0 = tracemalloc.take_snapshot()
+    res = func()
+    t1 = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in t1.compare_to(t0, "filename"))
+
+    return res, size
+
+
+def test_queue_view_memory():
+    """Test the memory used by 1000 tasks stored as views and as dictionaries."""
+    dicts, dict_size = _allocated(lambda: [_task(i) for i in range(NUM_TASKS)])
+    views, view_size = _allocated(
+        lambda: [queue_view.compact(_task(i)) for i in range(NUM_TASKS)]
+    )
+
+    assert view_size < dict_size
+    assert [queue_view.to_dict(view) for view in views] == dicts
+
+
+def test_queue_view_encoding():
+    """Test that the views are encoded as the dictionaries they were made from."""
+    task = _task(1)
+    view = queue_view.compact(task)
+
+    assert json.loads(queue_view.dumps(view)) == task
+    assert json.dumps(queue_view.to_dict(view), sort_keys=True) == json.dumps(
+        task, sort_keys=True
+    )
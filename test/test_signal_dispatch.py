@@ -0,0 +1,31 @@
+import gevent
+
+from mxcube3 import blcontrol
+from mxcube3.core import signal_dispatch
+
+from fixture import client
+
+
+def test_signal_dispatch(client):
+    """Test that a signal connected through a dispatcher reaches its handler."""
+    calls = []
+
+    def loaded_sample_changed(sample):
+        calls.append(sample)
+
+    sc = blcontrol.beamline.sample_changer
+    handler = signal_dispatch.dispatcher(loaded_sample_changed, signal_dispatch.QUEUE)
+    sc.connect("testLoadedSampleChanged", handler)
+
+    try:
+        sc.emit("testLoadedSampleChanged", ("1:01",))
+        sc.emit("testLoadedSampleChanged", ("1:05",))
+        gevent.sleep(0.1)
+    finally:
+        sc.disconnect("testLoadedSampleChanged", handler)
+
+    metrics = signal_dispatch.get_metrics()["handlers"]
+    name = "test_signal_dispatch.loaded_sample_changed"
+
+    assert calls == ["1:01", "1:05"]
+    assert metrics[name]["executed"] == 2 and metrics[name]["errors"] == 0